@@ -1,34 +1,402 @@
 # TODO
 # change to pyfs
+import copy
+import csv
 import hashlib
+import heapq
+import io
+import json
+import mmap
 import os
+import pickle
+import posixpath
+import queue
 import re
-from collections import defaultdict
+import string
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime
 from os.path import join as pjoin, splitext as psplitext, exists as pexists
 
 import sqlalchemy as sqla
 import stringcase
+try:
+    import fs as pyfs
+    from fs.enums import ResourceType as FSResourceType
+    from fs.errors import FSError, ResourceNotFound
+    from fs.path import join as fs_join
+except ImportError:
+    pyfs = None
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import relationship, scoped_session, sessionmaker
 
 Base = declarative_base()
 db_sessionmaker = sessionmaker()
 
 DEBUG_LEVEL = 0
 
+## read buffer size for streaming hashes
+HASH_CHUNK_SIZE = 1 << 20
+## bytes read from each end of a file for the duplicate cascade's sample hash
+SAMPLE_SIZE = 1 << 16
 
-def init_db(DB_PATH):
-    global db_session
 
-    dsn_db = "sqlite:///%s" % DB_PATH
-    db_engine = sqla.create_engine(dsn_db, echo=DEBUG_LEVEL > 0)
+class Signal(object):
+    """
+    minimal observer list. in-process indexes connect to these to stay in
+    step with writes made elsewhere
+    """
 
-    Base.metadata.create_all(db_engine)
-    db_session = db_sessionmaker(bind=db_engine)
+    def __init__(self):
+        self.receivers = []
+
+    def connect(self, receiver):
+        self.receivers.append(receiver)
+        return receiver
+
+    def send(self, *args):
+        for receiver in list(self.receivers):
+            receiver(*args)
+
+
+class Stats(object):
+    """
+    where the time goes. phases are named timers, accumulated over every
+    time they run, from any thread; counters are named totals.
+
+    phases can nest and overlap across threads, so they do not add up to
+    the wall time: e.g. 'walk' includes 'stat' unless the storage
+    prefetches, and 'hash' runs on several workers at once
+
+    sql statements and their time are counted by watch_engine, and cache
+    lookups by cache_lookup, as <cache>.hits and <cache>.misses. work done
+    in other processes (reindex's $use_processes) is not counted
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.time_started = time.time()
+            ## name -> [seconds, times run]
+            self.phases = defaultdict(lambda: [0.0, 0])
+            self.counters = defaultdict(int)
+
+    def add_time(self, name, seconds, count=1):
+        with self._lock:
+            phase = self.phases[name]
+            phase[0] += seconds
+            phase[1] += count
+
+    def phase(self, name):
+        """
+        context manager timing its block as phase $name
+        """
+        return _PhaseTimer(self, name)
+
+    def timed_iter(self, name, iterable):
+        """
+        yield from $iterable, timing each step as phase $name
+        """
+        iterator = iter(iterable)
+        while True:
+            time_start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(name, time.perf_counter() - time_start, 0)
+                return
+            self.add_time(name, time.perf_counter() - time_start)
+            yield item
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def cache_lookup(self, cache, hit):
+        self.count(cache + (hit and '.hits' or '.misses'))
+
+    def hit_rate(self, cache):
+        hits = self.counters.get(cache + '.hits', 0)
+        total = hits + self.counters.get(cache + '.misses', 0)
+        return hits / total if total else None
+
+    def watch_engine(self, engine):
+        """
+        count the sql statements $engine runs, and time them as phase 'sql'
+        """
+        local = threading.local()
+
+        @sqla.event.listens_for(engine, 'before_cursor_execute')
+        def before(conn, cursor, statement, parameters, context, executemany):
+            local.time_start = time.perf_counter()
+
+        @sqla.event.listens_for(engine, 'after_cursor_execute')
+        def after(conn, cursor, statement, parameters, context, executemany):
+            self.add_time('sql', time.perf_counter() - local.time_start)
+            if executemany:
+                self.count('sql.rows', len(parameters))
+
+    def snapshot(self):
+        """
+        the phases as {name: {'seconds', 'count'}}, the counters, and the
+        hit rate of every cache, as plain dicts for e.g. json
+        """
+        with self._lock:
+            phases = dict((name, {'seconds': seconds, 'count': count})
+                          for name, (seconds, count) in self.phases.items())
+            counters = dict(self.counters)
+        caches = set(name.rsplit('.', 1)[0] for name in counters if name.endswith(('.hits', '.misses')))
+        return {
+            'elapsed': time.time() - self.time_started,
+            'phases': phases,
+            'counters': counters,
+            'hit_rates': dict((cache, self.hit_rate(cache)) for cache in caches),
+        }
+
+    def summary(self):
+        ## one line, for progress output
+        snapshot = self.snapshot()
+        return ', '.join('%s %.2fs' % (name, phase['seconds'])
+                         for name, phase in sorted(snapshot['phases'].items())) or 'nothing timed yet'
+
+    def report(self):
+        snapshot = self.snapshot()
+        lline = ['elapsed %.2fs' % snapshot['elapsed']]
+        for name, phase in sorted(snapshot['phases'].items()):
+            lline.append('  %-12s %10.3fs %10d' % (name, phase['seconds'], phase['count']))
+        for name, value in sorted(snapshot['counters'].items()):
+            lline.append('  %-24s %10d' % (name, value))
+        for cache, rate in sorted(snapshot['hit_rates'].items()):
+            lline.append('  %-24s %9.1f%%' % (cache + ' hit rate', 100 * rate))
+        return '\n'.join(lline)
+
+
+class _PhaseTimer(object):
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.time_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.add_time(self.name, time.perf_counter() - self.time_start)
+
+
+## process wide, see Stats. reset() it to measure a single run
+stats = Stats()
+
+
+## sent with a list of (tag_id, text) for newly inserted tags
+tag_created = Signal()
+## sent with lists of added and removed (blob_id, tag_id) pairs
+blob_tags_changed = Signal()
+
+## held by in-process writers from their first write to their commit,
+## e.g. BulkWriter.flush, BlobEntry.bulk_tag and DefaultMixin.save, so a
+## GUI tag edit waits for a background reindex's batch instead of racing
+## its id allocation, or finding its snapshot stale
+write_lock = threading.RLock()
+
+
+## applied to every connection. WAL lets readers, like the GUI, query
+## while an indexer writes, and with it synchronous=NORMAL only risks the
+## last transactions on power loss, never corruption
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('mmap_size', 1 << 28),
+    ## in KiB when negative
+    ('cache_size', -(1 << 16)),
+    ('temp_store', 'MEMORY'),
+)
+
+
+def init_db(DB_PATH, hash_algorithm=None, extra_hash_algorithms=None, pragmas=SQLITE_PRAGMAS,
+            pool_size=None):
+    """
+    open the index at $DB_PATH, creating it if needed, or upgrading it to
+    SCHEMA_VERSION, see migrate.
+
+    $hash_algorithm names the HashEntry type blobs are identified by. it is
+    fixed when the index is created, by default to DEFAULT_HASH_ALGORITHM.
+    $extra_hash_algorithms, if given, replaces the index's list of digests
+    computed alongside it, see configure_hashes
+
+    $pragmas are (name, value) pairs set on every connection
+
+    by default each session opens its own connection. with $pool_size, up
+    to that many stay open and are handed to whichever thread needs one,
+    for long running processes with many threads, e.g. Server.py
+    """
+    global db_session, tag_search_index, tag_posting_index, tag_suggester
 
-    algo = HashAlgorithm.ensure(name=Sha256Entry.NAME)
-    algo.save()
+    dsn_db = "sqlite:///%s" % DB_PATH
+    engine_kw = {}
+    if pool_size:
+        engine_kw = dict(poolclass=sqla.pool.QueuePool, pool_size=pool_size, max_overflow=0,
+                         connect_args={'check_same_thread': False})
+    db_engine = sqla.create_engine(dsn_db, echo=DEBUG_LEVEL > 0, **engine_kw)
+    _set_pragmas(db_engine, pragmas)
+    stats.watch_engine(db_engine)
+
+    is_new = not sqla.inspect(db_engine).get_table_names()
+    Base.metadata.create_all(db_engine)
+    ## one session per thread, so the GUI can query from a worker thread
+    db_sessionmaker.configure(bind=db_engine)
+    db_session = scoped_session(db_sessionmaker)
+    ## in-process caches and indexes belong to the previous database
+    Tag._cache.clear()
+    tag_search_index = None
+    tag_posting_index = None
+    tag_suggester = None
+
+    if is_new:
+        ## create_all made it at the current schema
+        set_schema_version(db_engine, SCHEMA_VERSION)
+    else:
+        migrate(db_engine)
+    configure_hashes(hash_algorithm, extra_hash_algorithms)
+
+
+def _set_pragmas(db_engine, pragmas):
+    @sqla.event.listens_for(db_engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+
+## (version, function) pairs. each function takes the engine and upgrades an
+## index file from the version before it; see migrate
+MIGRATIONS = []
+
+
+def migration(version):
+    """
+    register the decorated function as the migration to schema $version
+    """
+    def register(func):
+        MIGRATIONS.append((version, func))
+        MIGRATIONS.sort(key=lambda migration: migration[0])
+        return func
+    return register
+
+
+def get_schema_version(db_engine):
+    return db_engine.execute('PRAGMA user_version').scalar()
+
+
+def set_schema_version(db_engine, version):
+    db_engine.execute('PRAGMA user_version = %d' % version)
+
+
+def migrate(db_engine):
+    """
+    run the MIGRATIONS newer than the index file's schema version, which is
+    kept in sqlite's user_version, in order. the version is stamped after
+    each one, and each one can be rerun, so an interrupted upgrade picks up
+    where it stopped
+
+    returns the versions migrated to
+    """
+    current = get_schema_version(db_engine)
+    lversion = []
+    for version, func in MIGRATIONS:
+        if version <= current:
+            continue
+        func(db_engine)
+        set_schema_version(db_engine, version)
+        lversion.append(version)
+    return lversion
+
+
+@migration(1)
+def _add_missing_columns(db_engine):
+    ## create_all leaves existing tables alone, so columns added to a model
+    ## after an index file was created are patched in here
+    inspector = sqla.inspect(db_engine)
+    for table in Base.metadata.sorted_tables:
+        existing = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                db_engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    table.name, column.name, column.type.compile(db_engine.dialect)))
+
+
+@migration(2)
+def _migrate_legacy_sha1(db_engine):
+    ## Sha256Entry used to compute sha1. those digests are 40 hex digits to
+    ## sha256's 64, so they are moved to Sha1Entry by length, keeping their
+    ## ids, and their BlobEntryHash links relabeled
+    S = Sha256Entry.__table__
+    legacy = sqla.select([S.c.id]).where(sqla.func.length(S.c.value) == 40)
+    if db_session.execute(legacy.limit(1)).first() is None:
+        return
+    S1 = Sha1Entry.__table__
+    H = BlobEntryHash.__table__
+    sha256 = HashAlgorithm.ensure(name=Sha256Entry.NAME)
+    sha1 = HashAlgorithm.ensure(name=Sha1Entry.NAME)
+    db_session.execute(S1.insert().from_select(
+        ['id', 'value'], sqla.select([S.c.id, S.c.value]).where(sqla.func.length(S.c.value) == 40)))
+    db_session.execute(H.update()
+                       .where(H.c.hash_algorithm_id == sha256.id)
+                       .where(H.c.hash_entry_id.in_(legacy))
+                       .values(hash_algorithm_id=sha1.id))
+    db_session.execute(S.delete().where(sqla.func.length(S.c.value) == 40))
+    db_session.commit()
+
+
+@migration(3)
+def _add_indexes(db_engine):
+    ## the indexes declared on the models, for files made before they were
+    inspector = sqla.inspect(db_engine)
+    for table in Base.metadata.sorted_tables:
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db_engine)
+    db_engine.execute('ANALYZE')
+
+
+@migration(4)
+def _add_time_scrubbed(db_engine):
+    ## LocalFilePathHistoryEntry.time_scrubbed, which scrubs used to keep
+    ## in time_verified
+    _add_missing_columns(db_engine)
+
+
+## Setting left by migration 5 for Indexer.split_merged_blobs
+MERGED_BLOBS_SETTING = 'split_merged_blobs'
+
+
+@migration(5)
+def _find_merged_blobs(db_engine):
+    ## indexes made before blobs were matched by hash put every file of a
+    ## size on one blob, linked to each file's digest. telling the files
+    ## apart takes reading them, which is left to the next reindex
+    H = BlobEntryHash.__table__
+    merged = sqla.select([H.c.blob_id]).group_by(H.c.blob_id, H.c.hash_algorithm_id).having(
+        sqla.func.count(H.c.hash_entry_id.distinct()) > 1)
+    if db_session.execute(merged.limit(1)).first() is not None:
+        Setting.set_value(MERGED_BLOBS_SETTING, '1')
+
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
 
 
 class DefaultMixin(object):
@@ -43,8 +411,9 @@ class DefaultMixin(object):
         return db_session.query(cls).filter_by(**kw).first()
 
     def save(self):
-        db_session.add(self)
-        db_session.commit()
+        with write_lock:
+            db_session.add(self)
+            db_session.commit()
 
     @classmethod
     def ensure(cls, **kw):
@@ -62,18 +431,244 @@ class HashAlgorithm(Base, DefaultMixin):
 
 
 class HashEntry(object):
+    """
+    a digest of blob content. each algorithm keeps its values in a table of
+    its own and is registered in HASH_ENTRY_TYPES under its NAME
+    """
+    NAME = None
+
     value = sqla.Column(sqla.String(64), unique=True)
 
+    @classmethod
+    def new_hasher(cls):
+        raise NotImplementedError
+
+    @classmethod
+    def get_hash(cls, content):
+        hasher = cls.new_hasher()
+        hasher.update(content)
+        return hasher.hexdigest()
+
+
+class Sha1Entry(Base, HashEntry, DefaultMixin):
+    ## what older indexes stored as sha256, see _migrate_legacy_sha1
+    NAME = 'sha1'
+
+    @classmethod
+    def new_hasher(cls):
+        return hashlib.sha1()
+
 
 class Sha256Entry(Base, HashEntry, DefaultMixin):
     NAME = 'sha256'
 
     @classmethod
-    def get_hash(cls, content):
-        return hashlib.sha1(content).hexdigest()
+    def new_hasher(cls):
+        return hashlib.sha256()
+
+
+class Blake2bEntry(Base, HashEntry, DefaultMixin):
+    NAME = 'blake2b-128'
+
+    @classmethod
+    def new_hasher(cls):
+        return hashlib.blake2b(digest_size=16)
+
+
+class Xxh3Entry(Base, HashEntry, DefaultMixin):
+    ## not cryptographic, but several times faster than anything in hashlib
+    NAME = 'xxh3-128'
+
+    @classmethod
+    def new_hasher(cls):
+        if xxhash is None:
+            raise ImportError('%s needs the xxhash package' % cls.NAME)
+        return xxhash.xxh3_128()
+
+
+HASH_ENTRY_TYPES = dict((cls.NAME, cls) for cls in (Sha1Entry, Sha256Entry, Blake2bEntry, Xxh3Entry))
+
+## for new indexes; the fastest algorithm available
+DEFAULT_HASH_ALGORITHM = xxhash is not None and Xxh3Entry.NAME or Blake2bEntry.NAME
+
+## the open index's algorithm blobs are identified by, and the ones computed
+## in the same read pass for integrity checks. set by configure_hashes
+index_hash_algorithm = DEFAULT_HASH_ALGORITHM
+index_extra_hash_algorithms = ()
+
+
+class Setting(Base, DefaultMixin):
+    """
+    per index configuration, as strings by key
+    """
+    key = sqla.Column(sqla.String, unique=True)
+    value = sqla.Column(sqla.String)
+
+    @classmethod
+    def get_value(cls, key, default=None):
+        setting = cls.get(key=key)
+        return default if setting is None else setting.value
+
+    @classmethod
+    def set_value(cls, key, value):
+        setting = cls.get(key=key) or cls(key=key)
+        setting.value = value
+        setting.save()
+
+
+def get_hash_entry_type(name=None):
+    """
+    the HashEntry type of the algorithm $name, by default the one blobs are
+    identified by in the open index
+    """
+    try:
+        return HASH_ENTRY_TYPES[name or index_hash_algorithm]
+    except KeyError:
+        raise ValueError('unknown hash algorithm %s, expected one of %s' % (
+            name, ', '.join(sorted(HASH_ENTRY_TYPES))))
+
+
+def configure_hashes(hash_algorithm=None, extra_hash_algorithms=None):
+    """
+    load the open index's hash algorithms into index_hash_algorithm and
+    index_extra_hash_algorithms, storing them as Settings the first time.
+
+    an index that already has hashes keeps identifying blobs by the
+    algorithm they were made with; asking for another one is an error.
+    $extra_hash_algorithms replaces the stored list if given
+    """
+    global index_hash_algorithm, index_extra_hash_algorithms
+
+    stored = Setting.get_value('hash_algorithm')
+    if stored is None:
+        link = db_session.query(BlobEntryHash).first()
+        stored = link is not None and link.hash_algorithm.name or hash_algorithm or DEFAULT_HASH_ALGORITHM
+    if hash_algorithm is not None and hash_algorithm != stored:
+        raise ValueError('this index identifies blobs by %s, not %s' % (stored, hash_algorithm))
+    if extra_hash_algorithms is None:
+        extra_hash_algorithms = [name for name in Setting.get_value('extra_hash_algorithms', '').split(',') if name]
+    extra_hash_algorithms = tuple(name for name in extra_hash_algorithms if name != stored)
+
+    for name in (stored,) + extra_hash_algorithms:
+        ## fails early for unknown or unavailable algorithms
+        get_hash_entry_type(name).new_hasher()
+        HashAlgorithm.ensure(name=name)
+    Setting.set_value('hash_algorithm', stored)
+    Setting.set_value('extra_hash_algorithms', ','.join(extra_hash_algorithms))
+    index_hash_algorithm = stored
+    index_extra_hash_algorithms = extra_hash_algorithms
+
+
+def friendly_size(size):
+    for divisor, sizechar in (
+            (1e9, "G"),
+            (1e6, "M"),
+            (1e3, "K"),
+            (1e0, "B")):
+        ## potentially bad?
+        ## this is to avert size = 0 files. though, we should really just forbid empty files
+        if size + 1 >= divisor:
+            return "%3d%s" % (size / divisor, sizechar)
+
+
+def hash_file(path, chunk_size=HASH_CHUNK_SIZE, use_mmap=False, algorithm=None):
+    """
+    hash the file at $path in a single pass over $chunk_size buffers, so
+    memory use stays the same however big the file is.
+
+    with $use_mmap the file is mapped instead of read, and the hasher is
+    fed slices of the mapping
+
+    $algorithm is a HashEntry NAME, by default the open index's
+
+    returns (hexdigest, size)
+    """
+    algorithm = algorithm or index_hash_algorithm
+    digests, size = hash_file_multi(path, [algorithm], chunk_size, use_mmap)
+    return digests[algorithm], size
+
+
+def hash_file_multi(path, algorithms, chunk_size=HASH_CHUNK_SIZE, use_mmap=False):
+    """
+    hash_file with every algorithm in $algorithms, reading the file once
+
+    returns ({algorithm: hexdigest}, size)
+    """
+    lhasher = [get_hash_entry_type(name).new_hasher() for name in algorithms]
+    size = 0
+    with open(path, 'rb') as ifile:
+        if use_mmap and os.fstat(ifile.fileno()).st_size > 0:
+            with mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mapped, 'madvise'):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                view = memoryview(mapped)
+                try:
+                    ## pages are read in as the hashers touch them
+                    with stats.phase('hash'):
+                        for offset in range(0, len(mapped), chunk_size):
+                            for hasher in lhasher:
+                                hasher.update(view[offset:offset + chunk_size])
+                    size = len(mapped)
+                    stats.count('bytes_read', size)
+                finally:
+                    view.release()
+        else:
+            size = _feed_hashers(ifile, lhasher, chunk_size)
+    return dict(zip(algorithms, (hasher.hexdigest() for hasher in lhasher))), size
+
+
+def hash_stream(ifile, chunk_size=HASH_CHUNK_SIZE, algorithm=None):
+    """
+    hash_file for an open binary file object, read to its end
+
+    returns (hexdigest, size)
+    """
+    algorithm = algorithm or index_hash_algorithm
+    digests, size = hash_stream_multi(ifile, [algorithm], chunk_size)
+    return digests[algorithm], size
+
+
+def hash_stream_multi(ifile, algorithms, chunk_size=HASH_CHUNK_SIZE):
+    """
+    hash_file_multi for an open binary file object, read to its end
+
+    returns ({algorithm: hexdigest}, size)
+    """
+    lhasher = [get_hash_entry_type(name).new_hasher() for name in algorithms]
+    size = _feed_hashers(ifile, lhasher, chunk_size)
+    return dict(zip(algorithms, (hasher.hexdigest() for hasher in lhasher))), size
+
+
+def _feed_hashers(ifile, lhasher, chunk_size):
+    ## one buffer, refilled in place and handed to every hasher in turn
+    size = 0
+    time_read = time_hash = 0.0
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    while True:
+        time_start = time.perf_counter()
+        nread = ifile.readinto(buf)
+        time_read += time.perf_counter() - time_start
+        if not nread:
+            break
+        time_start = time.perf_counter()
+        for hasher in lhasher:
+            hasher.update(view[:nread])
+        time_hash += time.perf_counter() - time_start
+        size += nread
+    stats.add_time('read', time_read)
+    stats.add_time('hash', time_hash)
+    stats.count('bytes_read', size)
+    return size
 
 
 class BlobEntryHash(Base, DefaultMixin):
+    __table_args__ = (
+        ## a blob's digest of an algorithm, and the blob of a digest
+        sqla.Index('ix_blob_entry_hash_blob_id', 'blob_id', 'hash_algorithm_id'),
+        sqla.Index('ix_blob_entry_hash_hash_entry_id', 'hash_algorithm_id', 'hash_entry_id', 'blob_id'),
+    )
+
     blob_id = sqla.Column(sqla.Integer, sqla.ForeignKey('blob_entry.id'))
     blob = relationship('BlobEntry', backref='hashes')
     hash_algorithm_id = sqla.Column(sqla.Integer, sqla.ForeignKey('hash_algorithm.id'))
@@ -82,10 +677,7 @@ class BlobEntryHash(Base, DefaultMixin):
     hash_entry_id = sqla.Column(sqla.Integer)
 
     def get_hash(self) -> HashEntry:
-        if self.hash_algorithm.name == Sha256Entry.NAME:
-            return Sha256Entry.get(id=self.hash_entry_id)
-        else:
-            raise NotImplementedError
+        return get_hash_entry_type(self.hash_algorithm.name).get(id=self.hash_entry_id)
 
     def __repr__(self):
         return '<{}:{}> ({})'.format(
@@ -95,13 +687,26 @@ class BlobEntryHash(Base, DefaultMixin):
 class LocalFilePathHistoryEntry(Base, DefaultMixin):
     RELATIVE_BASE_DIR = None
 
+    __table_args__ = (
+        ## a blob's latest existing file, and the paths of existing files
+        sqla.Index('ix_local_file_path_history_entry_blob_id', 'blob_id', 'file_exists', 'id'),
+        sqla.Index('ix_local_file_path_history_entry_file_exists', 'file_exists', 'path'),
+    )
+
     blob_id = sqla.Column(sqla.Integer, sqla.ForeignKey('blob_entry.id'), nullable=False)
     blob = relationship('BlobEntry')
     path = sqla.Column(sqla.String, unique=True)
     time_created = sqla.Column(sqla.DateTime(), default=datetime.utcnow())
     time_verified = sqla.Column(sqla.Float)
+    ## when Indexer.scrub last found the file matching its digests
+    time_scrubbed = sqla.Column(sqla.Float)
     # "exists" seems to conflict with reserved word
     file_exists = sqla.Column(sqla.Boolean)
+    ## stat signature, see FileSignature
+    size = sqla.Column(sqla.Integer)
+    mtime_ns = sqla.Column(sqla.Integer)
+    inode = sqla.Column(sqla.Integer)
+    device = sqla.Column(sqla.Integer)
 
     _is_valid = None
 
@@ -129,10 +734,28 @@ class LocalFilePathHistoryEntry(Base, DefaultMixin):
         else:
             return self.path
 
-    def get_content(self):
-        with open(self.path, 'rb') as ifile:
+    def get_storage_path(self, storage):
+        return storage.join(storage.basedir, self.path)
+
+    def open(self, storage=None):
+        ## through $storage if given, see Storage, else the local file
+        if storage is not None:
+            return storage.open(self.get_storage_path(storage))
+        return open(self.get_realpath(), 'rb')
+
+    def get_content(self, storage=None):
+        with self.open(storage) as ifile:
             return ifile.read()
 
+    def get_hash(self, storage=None, **kw):
+        '''
+        returns (hexdigest, size) of the file, read through $storage if
+        given, else from the local file system; see hash_file
+        '''
+        if storage is not None:
+            return storage.hash_file(self.get_storage_path(storage), **kw)
+        return hash_file(self.get_realpath(), **kw)
+
     def is_match(self, fcheck):
         '''
         @type fcheck: LocalFilePathHistoryEntry
@@ -149,7 +772,16 @@ class LocalFilePathHistoryEntry(Base, DefaultMixin):
     def get_relpath(cls, path):
         return os.path.relpath(path, cls.RELATIVE_BASE_DIR)
 
+    def update_stat(self, stat):
+        self.size = stat.st_size
+        self.time_verified = stat.st_mtime
+        self.mtime_ns = stat.st_mtime_ns
+        self.inode = stat.st_ino
+        self.device = stat.st_dev
+
     def __init__(self, **kw):
+        ## pass stat=os.stat_result to avoid stat'ing the file again
+        stat = kw.pop('stat', None)
         super(LocalFilePathHistoryEntry, self).__init__(**kw)
 
         path = kw['path']
@@ -158,15 +790,454 @@ class LocalFilePathHistoryEntry(Base, DefaultMixin):
         else:
             self.path = path
 
-        if self.is_valid:
+        if stat is None and self.is_valid:
             stat = os.stat(self.get_realpath())
-            self.size = stat.st_size
-            self.time_verified = stat.st_mtime
+        if stat is not None:
+            self.update_stat(stat)
         else:
             self.size = -1
             self.time_verified = -1
 
 
+class FileSignature(namedtuple('FileSignature', 'id blob_id size mtime_ns inode device time_verified file_exists',
+                               defaults=(True,))):
+    """
+    the stat fields of an indexed path, as cached in Indexer.dfile.
+
+    a file whose current stat matches its signature is assumed unchanged,
+    so it never needs to be opened or looked up in the database. paths
+    marked gone (file_exists False) never count as unchanged, see
+    Indexer.lookup
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_stat(cls, stat, id=None, blob_id=None):
+        return cls(id, blob_id, stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_dev, stat.st_mtime)
+
+    def matches(self, stat):
+        if self.mtime_ns is None:
+            ## indexed before the stat signature was stored
+            return self.time_verified == stat.st_mtime
+        return self.size == stat.st_size \
+            and self.mtime_ns == stat.st_mtime_ns \
+            and self.inode == stat.st_ino \
+            and self.device == stat.st_dev
+
+
+FileStat = namedtuple('FileStat', 'st_size st_mtime st_mtime_ns st_ino st_dev')
+
+
+class Storage(object):
+    """
+    where the indexed files live. an Indexer only lists, stats and reads
+    files through its storage, so the same index code runs over the local
+    file system (LocalStorage), a PyFilesystem FS (FSStorage) or plain
+    bytes (MemoryStorage)
+
+    filepaths are whatever the storage uses under self.basedir, and the
+    index stores them relative to it. stats only need the fields of
+    FileStat
+
+    scan() lists directories $prefetch at a time on a thread pool, ahead of
+    the walk, so a file system with slow round trips is not listed one
+    directory after another. reads are spread over threads by
+    Indexer.reindex_pipelined
+    """
+
+    basedir = None
+    ## what listing, stat'ing and reading can raise for a file that is gone
+    ## or unreadable, and the part of that which means gone
+    ERRORS = (IOError, OSError)
+    MISSING = (FileNotFoundError,)
+
+    def __init__(self, prefetch=0):
+        self.prefetch = prefetch
+
+    def location(self):
+        """
+        a string identifying this storage, see ScanCheckpoint
+        """
+        return self.basedir
+
+    def join(self, dirpath, name):
+        return pjoin(dirpath, name)
+
+    def listdir(self, dirpath):
+        """
+        yield (name, filepath, is_dir, get_stat) for the entries of $dirpath,
+        where get_stat() returns a file's stat
+        """
+        raise NotImplementedError
+
+    def stat(self, filepath):
+        raise NotImplementedError
+
+    def open(self, filepath):
+        """
+        open $filepath for reading bytes
+        """
+        raise NotImplementedError
+
+    def hash_file(self, filepath, algorithm=None):
+        with self.open(filepath) as ifile:
+            return hash_stream(ifile, algorithm=algorithm)
+
+    def hash_file_multi(self, filepath, algorithms):
+        with self.open(filepath) as ifile:
+            return hash_stream_multi(ifile, algorithms)
+
+    def sample_hash(self, filepath, size, sample_size=SAMPLE_SIZE):
+        with self.open(filepath) as ifile:
+            return sample_hash_stream(ifile, size, sample_size)
+
+    def _list(self, dirpath, resume, depth):
+        ## one directory of scan(): its (filepath, stat) sorted, and its
+        ## subdirectories sorted, each with its depth along $resume
+        lsubdir = []
+        lsubfile = []
+        try:
+            for name, filepath, is_dir, get_stat in self.listdir(dirpath):
+                try:
+                    if is_dir:
+                        if depth is None or depth == len(resume) - 1:
+                            lsubdir.append((filepath, None))
+                        elif name == resume[depth]:
+                            lsubdir.append((filepath, depth + 1))
+                        elif name > resume[depth]:
+                            lsubdir.append((filepath, None))
+                    else:
+                        if depth is not None and (
+                                depth < len(resume) - 1 or name <= resume[-1]):
+                            continue
+                        with stats.phase('stat'):
+                            lsubfile.append((filepath, get_stat()))
+                except self.ERRORS:
+                    continue
+        except self.ERRORS:
+            pass
+        lsubfile.sort()
+        lsubdir.sort()
+        return lsubfile, lsubdir
+
+    def scan(self, resume_after=None):
+        """
+        walk self.basedir and yield (filepath, stat) for every file, in
+        sorted order
+
+        $resume_after is the path of a file, relative to self.basedir, that
+        an earlier walk got to. the walk picks up right after it:
+        directories that were already done are not listed again, and files
+        that were are not stat'ed
+
+        unreadable directories and entries are skipped, like os.walk does
+        """
+        ## the walk order is: a directory's files, then its subdirectories,
+        ## both sorted. entries on the stack carry how many components of
+        ## $resume_after they lie on, or None once past it, and the future
+        ## of their listing once it has been prefetched
+        resume = resume_after and resume_after.split(os.sep) or []
+        stack = [[self.basedir, 0 if resume else None, None]]
+        pool = self.prefetch > 0 and ThreadPoolExecutor(max_workers=self.prefetch) or None
+        try:
+            while stack:
+                if pool is not None:
+                    for item in stack[-self.prefetch:]:
+                        if item[2] is None:
+                            item[2] = pool.submit(self._list, item[0], resume, item[1])
+                dirpath, depth, future = stack.pop()
+                if future is not None:
+                    lsubfile, lsubdir = future.result()
+                else:
+                    lsubfile, lsubdir = self._list(dirpath, resume, depth)
+                for item in lsubfile:
+                    yield item
+                stack.extend([filepath, depth, None] for filepath, depth in reversed(lsubdir))
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=False)
+
+
+class LocalStorage(Storage):
+    """
+    the local file system under $basedir. filepaths are OS paths, and
+    stats are the os.stat_result of the file
+    """
+
+    def __init__(self, basedir=None, prefetch=0):
+        super(LocalStorage, self).__init__(prefetch=prefetch)
+        self.basedir = basedir and os.path.expanduser(basedir)
+
+    def location(self):
+        return os.path.abspath(self.basedir)
+
+    def listdir(self, dirpath):
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    yield entry.name, entry.path, True, None
+                elif entry.is_file():
+                    ## the stat cached on the DirEntry, where there is one
+                    yield entry.name, entry.path, False, entry.stat
+
+    def stat(self, filepath):
+        return os.stat(filepath)
+
+    def open(self, filepath):
+        return open(filepath, 'rb')
+
+    def hash_file(self, filepath, algorithm=None):
+        return hash_file(filepath, algorithm=algorithm)
+
+    def hash_file_multi(self, filepath, algorithms):
+        return hash_file_multi(filepath, algorithms)
+
+    def sample_hash(self, filepath, size, sample_size=SAMPLE_SIZE):
+        return sample_hash(filepath, size, sample_size)
+
+
+def scan_tree(basedir, resume_after=None, prefetch=0):
+    """
+    walk $basedir on the local file system and yield (filepath, stat) for
+    every file, in sorted order; see Storage.scan
+    """
+    return LocalStorage(basedir, prefetch=prefetch).scan(resume_after)
+
+
+class FSStorage(Storage):
+    """
+    the files of a PyFilesystem FS, or of the FS URL $filesystem opens
+    (e.g. 'osfs:///archive', 's3://bucket', 'mem://'). filepaths are FS
+    paths from the root of the FS
+
+    listings come with the file details, so stat'ing a file costs no round
+    trip of its own
+    """
+
+    NAMESPACES = ['details', 'stat']
+
+    def __init__(self, filesystem, prefetch=8):
+        if pyfs is None:
+            raise Exception("FSStorage needs PyFilesystem: pip install fs")
+        super(FSStorage, self).__init__(prefetch=prefetch)
+        if isinstance(filesystem, str):
+            filesystem = pyfs.open_fs(filesystem)
+        self.fs = filesystem
+        self.basedir = '/'
+        self.ERRORS = (IOError, OSError, FSError)
+        self.MISSING = (FileNotFoundError, ResourceNotFound)
+
+    def location(self):
+        return repr(self.fs)
+
+    def join(self, dirpath, name):
+        return fs_join(dirpath, name)
+
+    @staticmethod
+    def _stat(info):
+        modified = info.modified
+        mtime = modified is not None and modified.timestamp() or 0.0
+        return FileStat(
+            info.size,
+            mtime,
+            info.get('stat', 'st_mtime_ns', int(mtime * 1e9)),
+            info.get('stat', 'st_ino'),
+            info.get('stat', 'st_dev'))
+
+    def listdir(self, dirpath):
+        for info in self.fs.scandir(dirpath, namespaces=self.NAMESPACES):
+            filepath = self.join(dirpath, info.name)
+            if info.is_dir:
+                yield info.name, filepath, True, None
+            elif info.type == FSResourceType.file:
+                stat = self._stat(info)
+                yield info.name, filepath, False, lambda stat=stat: stat
+
+    def stat(self, filepath):
+        return self._stat(self.fs.getinfo(filepath, namespaces=self.NAMESPACES))
+
+    def open(self, filepath):
+        return self.fs.openbin(filepath)
+
+
+class MemoryStorage(Storage):
+    """
+    files held in memory, as {filepath: bytes} with '/'-separated paths
+    under '/'. mostly for tests
+    """
+
+    def __init__(self, files=None, prefetch=0):
+        super(MemoryStorage, self).__init__(prefetch=prefetch)
+        self.basedir = '/'
+        self.files = {}
+        self.mtimes = {}
+        for filepath, content in (files or {}).items():
+            self.write(filepath, content)
+
+    def location(self):
+        return 'memory:%x' % id(self)
+
+    def join(self, dirpath, name):
+        return posixpath.join(dirpath, name)
+
+    def write(self, filepath, content):
+        self.files[filepath] = content
+        self.mtimes[filepath] = time.time_ns()
+
+    def remove(self, filepath):
+        del self.files[filepath]
+        del self.mtimes[filepath]
+
+    def listdir(self, dirpath):
+        prefix = dirpath.rstrip('/') + '/'
+        lsubdir = set()
+        for filepath in list(self.files):
+            if not filepath.startswith(prefix):
+                continue
+            name, sep, _ = filepath[len(prefix):].partition('/')
+            if sep:
+                lsubdir.add(name)
+            else:
+                yield name, filepath, False, lambda filepath=filepath: self.stat(filepath)
+        for name in lsubdir:
+            yield name, prefix + name, True, None
+
+    def stat(self, filepath):
+        if filepath not in self.files:
+            raise FileNotFoundError(filepath)
+        mtime_ns = self.mtimes[filepath]
+        return FileStat(len(self.files[filepath]), mtime_ns / 1e9, mtime_ns, None, None)
+
+    def open(self, filepath):
+        if filepath not in self.files:
+            raise FileNotFoundError(filepath)
+        return io.BytesIO(self.files[filepath])
+
+
+def sample_hash(path, size, sample_size=SAMPLE_SIZE):
+    """
+    cheap pre-filter: hash of the first and last $sample_size bytes of the
+    file at $path. two files of the same size with different sample hashes
+    cannot be identical
+    """
+    with open(path, 'rb') as ifile:
+        return sample_hash_stream(ifile, size, sample_size)
+
+
+def sample_hash_stream(ifile, size, sample_size=SAMPLE_SIZE):
+    """
+    sample_hash for an open, seekable binary file object of $size bytes
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    with stats.phase('sample_hash'):
+        head = ifile.read(sample_size)
+        hasher.update(head)
+        stats.count('bytes_read', len(head))
+        if size > sample_size:
+            ifile.seek(max(sample_size, size - sample_size))
+            tail = ifile.read(sample_size)
+            hasher.update(tail)
+            stats.count('bytes_read', len(tail))
+    return hasher.hexdigest()
+
+
+## module level so ProcessPoolExecutor can pickle them. unreadable files
+## come back as None instead of stopping the whole map
+
+def _try_sample_hash(item):
+    storage, path, size, sample_size = item
+    try:
+        return storage.sample_hash(path, size, sample_size)
+    except storage.ERRORS:
+        return None
+
+
+def _try_hash_file(item):
+    storage, path, algorithm = item
+    try:
+        return storage.hash_file(path, algorithm)[0]
+    except storage.ERRORS:
+        return None
+
+
+def cascade_hashes(items, known_sizes=(), sample_size=SAMPLE_SIZE, map=map, storage=None,
+                   algorithm=None):
+    """
+    work out which of $items, (path, size) pairs, could be duplicates while
+    reading as little as possible:
+
+    1. a file whose size no other file has is unique and is never opened
+    2. files of up to 2 * $sample_size bytes are fully hashed straight away
+    3. bigger ones get a sample_hash, and only those sharing their sample
+       with another file of the same size are fully hashed
+
+    sizes in $known_sizes (e.g. blobs already in the index) always count as
+    colliding. $map can be a pool's map to hash in parallel. unreadable
+    files are left out
+
+    files are read from $storage, by default the local file system, and
+    hashed with $algorithm, by default the index's
+
+    returns {path: hexdigest} for the files that were fully hashed
+    """
+    if storage is None:
+        storage = LocalStorage()
+    algorithm = algorithm or index_hash_algorithm
+    by_size = defaultdict(list)
+    for path, size in items:
+        by_size[size].append(path)
+
+    lfull = []
+    lsample = []
+    for size, lpath in by_size.items():
+        if len(lpath) == 1 and size not in known_sizes:
+            continue
+        if size <= 2 * sample_size or size in known_sizes:
+            lfull.extend(lpath)
+        else:
+            lsample.extend((storage, path, size, sample_size) for path in lpath)
+
+    by_sample = defaultdict(list)
+    for (_, path, size, _), sample in zip(lsample, map(_try_sample_hash, lsample)):
+        if sample is not None:
+            by_sample[(size, sample)].append(path)
+    for lpath in by_sample.values():
+        if len(lpath) > 1:
+            lfull.extend(lpath)
+
+    return dict(
+        (path, hash)
+        for path, hash in zip(lfull, map(_try_hash_file, [(storage, path, algorithm) for path in lfull]))
+        if hash is not None)
+
+
+class DuplicateGroup(namedtuple('DuplicateGroup', 'hash size paths')):
+    __slots__ = ()
+
+    @property
+    def reclaimable(self):
+        ## bytes freed by keeping only one copy
+        return self.size * (len(self.paths) - 1)
+
+
+def find_duplicates(items, **kw):
+    """
+    group $items, (path, size) pairs, into sets of identical files using
+    cascade_hashes
+
+    returns a list of DuplicateGroup, most reclaimable bytes first
+    """
+    dsize = dict(items)
+    groups = defaultdict(list)
+    for path, hash in cascade_hashes(dsize.items(), **kw).items():
+        groups[(hash, dsize[path])].append(path)
+    return sorted(
+        (DuplicateGroup(hash, size, sorted(lpath))
+         for (hash, size), lpath in groups.items()
+         if len(lpath) > 1),
+        key=lambda group: (-group.reclaimable, group.paths))
+
+
 class PosixFilePermissionEntry(Base, DefaultMixin):
     file_id = sqla.Column(sqla.Integer, sqla.ForeignKey('local_file_path_history_entry.id'))
     file = relationship('LocalFilePathHistoryEntry', backref='posix_file_permission')
@@ -176,7 +1247,11 @@ class PosixFilePermissionEntry(Base, DefaultMixin):
 Blob__Tag = sqla.Table("blob__tag", Base.metadata,
                        sqla.Column('blob_entry_id', sqla.Integer, sqla.ForeignKey('blob_entry.id')),
                        sqla.Column('tag_id', sqla.Integer, sqla.ForeignKey('tag.id')),
-                       sqla.Column('rank', sqla.Float))
+                       sqla.Column('rank', sqla.Float),
+                       ## both directions are covering: blobs of a tag for
+                       ## queries, tags of a blob for display and bulk writes
+                       sqla.Index('ix_blob__tag_tag_id_blob_entry_id', 'tag_id', 'blob_entry_id'),
+                       sqla.Index('ix_blob__tag_blob_entry_id_tag_id', 'blob_entry_id', 'tag_id'))
 
 
 class Tag(Base, DefaultMixin):
@@ -192,6 +1267,7 @@ class Tag(Base, DefaultMixin):
         if it doesn't exist, create it and return it
         
         """
+        stats.cache_lookup('tag_cache', text in Tag._cache)
         if text in Tag._cache:
             return Tag._cache[text]
         res = db_session.query(Tag).filter_by(text=text).first()
@@ -212,10 +1288,199 @@ class Tag(Base, DefaultMixin):
         return self.text
 
 
+@sqla.event.listens_for(Tag, 'after_insert')
+def _tag_inserted(mapper, connection, target):
+    tag_created.send([(target.id, target.text)])
+
+
+## sqlite's LIKE only folds ASCII case
+_LIKE_FOLD = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+class TagSearchIndex(object):
+    """
+    in-process bigram index over Tag.text. match() gives the same tags as
+    Tag.text.like('%token%') without scanning the tag table: the postings of
+    the token's bigrams are intersected and only the survivors are checked
+    """
+
+    def __init__(self):
+        self.texts = {}
+        self.grams = defaultdict(set)
+
+    @classmethod
+    def load(cls):
+        index = cls()
+        index.add(db_session.query(Tag.id, Tag.text))
+        return index
+
+    def add(self, pairs):
+        '''
+        @param pairs: iterable of (tag_id, text)
+        '''
+        for tag_id, text in pairs:
+            if text is None:
+                continue
+            folded = text.translate(_LIKE_FOLD)
+            self.texts[tag_id] = folded
+            for i in range(len(folded) - 1):
+                self.grams[folded[i:i + 2]].add(tag_id)
+
+    def match(self, token):
+        """
+        returns the set of ids of tags containing $token
+        """
+        token = token.translate(_LIKE_FOLD)
+        if len(token) < 2:
+            return set(tag_id for tag_id, text in self.texts.items() if token in text)
+        lposting = sorted(
+            (self.grams.get(token[i:i + 2], ()) for i in range(len(token) - 1)),
+            key=len)
+        if not lposting[0]:
+            return set()
+        candidates = set(lposting[0]).intersection(*lposting[1:])
+        return set(tag_id for tag_id in candidates if token in self.texts[tag_id])
+
+
+tag_search_index = None
+
+
+def get_tag_search_index():
+    global tag_search_index
+    if tag_search_index is None:
+        tag_search_index = TagSearchIndex.load()
+    return tag_search_index
+
+
+@tag_created.connect
+def _update_tag_search_index(pairs):
+    if tag_search_index is not None:
+        tag_search_index.add(pairs)
+
+
+class TagSuggester(object):
+    """
+    in-process prefix index over Tag.text for autocompletion. tags are kept
+    in a list sorted by folded text, so the tags starting with a prefix are
+    one bisect away, and ranked by how many blobs carry them.
+
+    kept current by the tag_created and blob_tags_changed signals. the top
+    completions of prefixes shorter than CACHED_PREFIX_LENGTH, whose ranges
+    span a large part of the list, are cached until the next change
+    """
+    CACHED_PREFIX_LENGTH = 3
+    DEFAULT_LIMIT = 10
+
+    def __init__(self):
+        self.texts = {}
+        self.counts = defaultdict(int)
+        ## (folded text, tag_id), sorted
+        self.keys = []
+        self._top = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls):
+        suggester = cls()
+        suggester.add_tags(db_session.query(Tag.id, Tag.text))
+        T = Blob__Tag.c
+        suggester.counts.update((tag_id, count) for tag_id, count in db_session.execute(
+            sqla.select([T.tag_id, sqla.func.count(T.blob_entry_id.distinct())]).group_by(T.tag_id)))
+        return suggester
+
+    def add_tags(self, pairs):
+        '''
+        @param pairs: iterable of (tag_id, text)
+        '''
+        lkey = []
+        with self._lock:
+            for tag_id, text in pairs:
+                if text is None or tag_id in self.texts:
+                    continue
+                self.texts[tag_id] = text
+                lkey.append((text.translate(_LIKE_FOLD), tag_id))
+            if len(lkey) == 1:
+                insort(self.keys, lkey[0])
+            elif lkey:
+                ## a reindex creates tags in batches; one sort beats an insort each
+                self.keys.extend(lkey)
+                self.keys.sort()
+            if lkey:
+                self._top.clear()
+
+    def update_counts(self, added, removed):
+        '''
+        @param added, removed: lists of (blob_id, tag_id)
+        '''
+        if not added and not removed:
+            return
+        with self._lock:
+            for _, tag_id in added:
+                self.counts[tag_id] += 1
+            for _, tag_id in removed:
+                self.counts[tag_id] = max(0, self.counts[tag_id] - 1)
+            self._top.clear()
+
+    def _ranked(self, prefix, limit):
+        start = bisect_left(self.keys, (prefix,))
+        end = bisect_left(self.keys, (prefix + '\U0010ffff',), start)
+        ltag_id = [tag_id for _, tag_id in self.keys[start:end]]
+        return heapq.nsmallest(limit, ltag_id, key=lambda tag_id: (-self.counts[tag_id], self.texts[tag_id]))
+
+    def suggest(self, prefix, limit=DEFAULT_LIMIT, exclude=()):
+        """
+        returns up to $limit (text, blob count) of the tags starting with
+        $prefix, most used first, leaving out the texts in $exclude
+        """
+        prefix = prefix.translate(_LIKE_FOLD)
+        exclude = set(exclude)
+        want = limit + len(exclude)
+        with self._lock:
+            if len(prefix) < self.CACHED_PREFIX_LENGTH:
+                ltag_id = self._top.get(prefix)
+                if ltag_id is None or len(ltag_id) < want:
+                    ltag_id = self._top[prefix] = self._ranked(prefix, max(want, self.DEFAULT_LIMIT))
+            else:
+                ltag_id = self._ranked(prefix, want)
+            lsuggestion = [(self.texts[tag_id], self.counts[tag_id]) for tag_id in ltag_id
+                           if self.texts[tag_id] not in exclude]
+        return lsuggestion[:limit]
+
+
+tag_suggester = None
+
+
+def get_tag_suggester():
+    global tag_suggester
+    if tag_suggester is None:
+        tag_suggester = TagSuggester.load()
+    return tag_suggester
+
+
+def suggest_tags(prefix, limit=TagSuggester.DEFAULT_LIMIT, exclude=()):
+    """
+    up to $limit (text, blob count) completions of $prefix, see TagSuggester
+    """
+    return get_tag_suggester().suggest(prefix, limit, exclude)
+
+
+@tag_created.connect
+def _update_tag_suggester(pairs):
+    if tag_suggester is not None:
+        tag_suggester.add_tags(pairs)
+
+
+@blob_tags_changed.connect
+def _update_tag_suggester_counts(added, removed):
+    if tag_suggester is not None:
+        tag_suggester.update_counts(added, removed)
+
+
 class BlobEntry(Base, DefaultMixin):
     id = sqla.Column(sqla.Integer, primary_key=True)
 
-    size = sqla.Column(sqla.Integer)
+    ## duplicate candidates are found by size
+    size = sqla.Column(sqla.Integer, index=True)
     tags = relationship('Tag', backref='blobs', secondary=Blob__Tag, lazy='dynamic')
 
     def get_local_files(self):
@@ -224,26 +1489,91 @@ class BlobEntry(Base, DefaultMixin):
             file_exists=True,
         ).order_by(LocalFilePathHistoryEntry.id.desc()).all()
 
-    def get_content(self):
+    def get_content(self, storage=None):
+        for file in self.get_local_files():
+            return file.get_content(storage)
+
+    def get_realpath(self):
+        ## of the blob's first existing file, see get_local_files. None if
+        ## all of them are gone
         for file in self.get_local_files():
-            return file.get_content()
+            return file.get_realpath()
+
+    @classmethod
+    def ensure_for_hash(cls, hash_entry, hash_algorithm, size):
+        """
+        return the blob whose content hashes to $hash_entry, creating it and
+        its BlobEntryHash if there is none yet
+        """
+        link = BlobEntryHash.get(hash_algorithm_id=hash_algorithm.id, hash_entry_id=hash_entry.id)
+        if link is not None:
+            return link.blob
+        blob = cls(size=size)
+        blob.save()
+        BlobEntryHash(
+            blob_id=blob.id,
+            hash_algorithm_id=hash_algorithm.id,
+            hash_entry_id=hash_entry.id,
+        ).save()
+        return blob
+
+    def get_hash(self, algorithm=None):
+        """
+        return this blob's HashEntry of $algorithm, by default the index's,
+        or None if it was never computed
+        """
+        algo = HashAlgorithm.get(name=algorithm or index_hash_algorithm)
+        link = algo is not None and BlobEntryHash.get(blob_id=self.id, hash_algorithm_id=algo.id)
+        if link:
+            return link.get_hash()
+
+    def set_hash(self, algorithm, value):
+        """
+        link this blob to the $algorithm digest $value, unless it already
+        has a digest of that algorithm
+
+        returns the linked HashEntry
+        """
+        existing = self.get_hash(algorithm)
+        if existing is not None:
+            return existing
+        chk = get_hash_entry_type(algorithm).ensure(value=value)
+        BlobEntryHash(
+            blob_id=self.id,
+            hash_algorithm_id=HashAlgorithm.ensure(name=algorithm).id,
+            hash_entry_id=chk.id,
+        ).save()
+        return chk
+
+    def ensure_hash(self, algorithm=None, storage=None):
+        """
+        return this blob's HashEntry of $algorithm, by default the index's.
+        blobs indexed without a hash (see cascade_hashes), and digests that
+        were not computed at indexing time, are hashed from the blob's first
+        readable file here, read through $storage if given (see Storage),
+        else from the local file system
+
+        returns None if there is no hash and no file left to compute it from
+        """
+        algorithm = algorithm or index_hash_algorithm
+        existing = self.get_hash(algorithm)
+        if existing is not None:
+            return existing
+        errors = storage is not None and storage.ERRORS or (IOError, OSError)
+        for file in self.get_local_files():
+            try:
+                hash, _ = file.get_hash(storage, algorithm=algorithm)
+            except errors:
+                continue
+            return self.set_hash(algorithm, hash)
 
     def get_checksum(self):
-        content = open(self.get_realpath(), 'rb').read()
         if not self.sha1:
-            self.sha1 = hashlib.sha1(content).hexdigest()
+            self.sha1, _ = hash_file(self.get_realpath())
         return (self.sha1)
 
     def friendly_size(self):
-        for divisor, sizechar in (
-                (1e9, "G"),
-                (1e6, "M"),
-                (1e3, "K"),
-                (1e0, "B")):
-            ## potentially bad?
-            ## this is to avert size = 0 files. though, we should really just forbid empty files
-            if self.size + 1 >= divisor:
-                return "%3d%s" % (self.size / divisor, sizechar)
+        return friendly_size(self.size)
 
     def __repr__(self):
         local_files = self.get_local_files()
@@ -255,16 +1585,93 @@ class BlobEntry(Base, DefaultMixin):
         )
 
     def add_tag(self, *ltag):
-        exclude = dict([(tag.id, True) for tag in self.tags])
-        self.tags += [tag for tag in ltag if tag.id not in exclude]
-        db_session.add(self)
-        db_session.commit()
+        BlobEntry.bulk_tag([self.id], add=[tag.text for tag in ltag])
 
     def del_tag(self, *ltag):
-        exclude = dict((tag.id, True) for tag in ltag)
-        self.tags = [tagold for tagold in self.tags if tagold.id not in exclude]
-        db_session.add(self)
+        BlobEntry.bulk_tag([self.id], remove=[tag.text for tag in ltag])
+
+    @staticmethod
+    def bulk_tag(lblob_id, add=(), remove=()):
+        """
+        tag every blob in $lblob_id with the tag texts in $add and untag it
+        from those in $remove, in one transaction. missing tags are created.
+
+        the pairs are written with INSERT ... SELECT and DELETE statements
+        over the selection, instead of loading each blob's tags
+
+        returns (added, removed) lists of (blob_id, tag_id) pairs
+        """
+        add = set(add)
+        remove = set(remove) - add
+        if not add and not remove:
+            return [], []
+        with write_lock:
+            return BlobEntry._bulk_tag(lblob_id, add, remove)
+
+    @staticmethod
+    def _bulk_tag(lblob_id, add, remove):
+        ## end the session's read transaction first: in WAL mode one whose
+        ## snapshot predates another writer's commit can't start writing
         db_session.commit()
+        selection = _select_blobs(lblob_id)
+        T = Blob__Tag.c
+        try:
+            dtag, lcreated = ensure_tags(add)
+            add_ids = sorted(dtag.values())
+            remove_ids = [id for id, in db_session.execute(
+                sqla.select([Tag.id]).where(Tag.text.in_(sorted(remove))))] if remove else []
+
+            added = []
+            if add_ids:
+                missing = sqla.select([selection.c.id, Tag.id]).where(sqla.and_(
+                    Tag.id.in_(add_ids),
+                    ~sqla.exists().where(sqla.and_(
+                        T.blob_entry_id == selection.c.id, T.tag_id == Tag.id))))
+                added = [tuple(row) for row in db_session.execute(missing)]
+                db_session.execute(Blob__Tag.insert().from_select([T.blob_entry_id, T.tag_id], missing))
+
+            removed = []
+            if remove_ids:
+                cond = sqla.and_(T.blob_entry_id.in_(sqla.select([selection.c.id])), T.tag_id.in_(remove_ids))
+                removed = [tuple(row) for row in db_session.execute(
+                    sqla.select([T.blob_entry_id, T.tag_id]).where(cond).distinct())]
+                db_session.execute(Blob__Tag.delete().where(cond))
+            db_session.commit()
+        except sqla.exc.SQLAlchemyError:
+            db_session.rollback()
+            raise
+        tag_created.send(lcreated)
+        blob_tags_changed.send(added, removed)
+        return added, removed
+
+    @staticmethod
+    def shared_tags(lblob_id):
+        """
+        texts of the tags that every blob in $lblob_id has, sorted, from one
+        GROUP BY query per _chunked slice of ids
+
+        only reads, so unlike _select_blobs it leaves no transaction open
+        that would keep the session on an old snapshot
+        """
+        lblob_id = sorted(set(lblob_id))
+        if not lblob_id:
+            return []
+        T = Blob__Tag.c
+        ## tag text -> number of blobs so far having it
+        dcount = None
+        for chunk in _chunked(lblob_id):
+            counts = dict((text, n) for text, n in db_session.execute(
+                sqla.select([Tag.text, sqla.func.count(T.blob_entry_id.distinct())])
+                    .select_from(Blob__Tag.join(Tag.__table__, T.tag_id == Tag.id))
+                    .where(T.blob_entry_id.in_(chunk))
+                    .group_by(Tag.id)))
+            if dcount is None:
+                dcount = counts
+            else:
+                dcount = dict((text, n + counts[text]) for text, n in dcount.items() if text in counts)
+            if not dcount:
+                break
+        return sorted(text for text, n in dcount.items() if n == len(lblob_id))
 
     def open(self):
         print('open %s' % self.get_realpath())
@@ -272,21 +1679,143 @@ class BlobEntry(Base, DefaultMixin):
     OP_AND = 1
     OP_OR = 2
 
+    ## past this many matching tags, IN (...) would hit sqlite's bound
+    ## variable limit, so the LIKE query is used instead
+    MAX_TAG_IDS = 900
+
     @staticmethod
-    def findall(OP, ltoken):
+    def match_tags(token):
+        """
+        returns the set of ids of the tags containing $token
+        """
+        if '%' in token or '_' in token:
+            ## LIKE wildcards, leave those to sqlite
+            return set(tag_id for tag_id, in db_session.query(Tag.id).filter(
+                Tag.text.like('%%%s%%' % token)))
+        return get_tag_search_index().match(token)
+
+    @staticmethod
+    def get_all(ids):
+        """
+        load the blobs with the given ids, ordered by id
+        """
+        lblob = []
+        for chunk in _chunked(sorted(ids)):
+            lblob.extend(db_session.query(BlobEntry)
+                         .filter(BlobEntry.id.in_(chunk))
+                         .order_by(BlobEntry.id))
+        return lblob
+
+    @staticmethod
+    def _parse_query(OP, ltoken, exclude):
         if isinstance(ltoken, str):
             ltoken = [ltoken]
-        likecond = [Tag.text.like('%%%s%%' % token) for token in ltoken]
-        if OP is BlobEntry.OP_AND:
-            qr = db_session.query(BlobEntry).join((Tag, BlobEntry.tags)) \
-                .filter(sqla.or_(*likecond)) \
-                .group_by(BlobEntry.id) \
-                .having(sqla.func.count(Tag.id) == len(likecond))
-        elif OP is BlobEntry.OP_OR:
-            qr = db_session.query(BlobEntry).filter(BlobEntry.tags.any(sqla.or_(*likecond)))
-        else:
+        if isinstance(exclude, str):
+            exclude = [exclude]
+        if OP not in (BlobEntry.OP_AND, BlobEntry.OP_OR):
             raise Exception("unsupported operation: [%s]" % OP)
-        return qr.all()
+        return list(ltoken), list(exclude)
+
+    @staticmethod
+    def findall(OP, ltoken, within=None, exclude=()):
+        """
+        find blobs with tags containing all (OP_AND) or any (OP_OR) of the
+        tokens in $ltoken, and none containing a token in $exclude. for
+        OP_AND, every token has to be part of at least one of the blob's tags
+
+        tags are matched through the TagSearchIndex. blobs are looked up in
+        the TagPostingIndex if one is enabled, else queried from blob__tag
+
+        $within is an optional collection of blob ids to narrow down, e.g.
+        the results of a previous, broader query
+        """
+        ltoken, exclude = BlobEntry._parse_query(OP, ltoken, exclude)
+        if within is not None:
+            within = set(within)
+        if not ltoken or within is not None and not within:
+            return []
+
+        if tag_posting_index is not None:
+            ids = BlobEntry._posting_ids(OP, ltoken, exclude)
+            if within is not None:
+                ids &= within
+            return BlobEntry.get_all(ids)
+
+        qr = db_session.query(BlobEntry).filter(BlobEntry.match_condition(OP, ltoken, exclude))
+        if within is not None and len(within) <= BlobEntry.MAX_TAG_IDS:
+            qr = qr.filter(BlobEntry.id.in_(sorted(within)))
+        return BlobEntry._narrow(qr.order_by(BlobEntry.id).all(), within)
+
+    @staticmethod
+    def _posting_ids(OP, ltoken, exclude):
+        ltag_ids = [BlobEntry.match_tags(token) for token in ltoken]
+        exclude_ids = set()
+        for token in exclude:
+            exclude_ids.update(BlobEntry.match_tags(token))
+        return tag_posting_index.query(OP, ltag_ids, exclude_ids)
+
+    @staticmethod
+    def match_condition(OP, ltoken, exclude=()):
+        """
+        the SQL condition on BlobEntry that findall matches blobs with, for
+        queries that need the matches in SQL (e.g. to sort or page them)
+
+        if the TagPostingIndex is enabled and the result is small enough to
+        pass as an IN list, the ids come from there
+        """
+        ltoken, exclude = BlobEntry._parse_query(OP, ltoken, exclude)
+        if not ltoken:
+            return sqla.false()
+
+        if tag_posting_index is not None:
+            ids = BlobEntry._posting_ids(OP, ltoken, exclude)
+            if len(ids) <= BlobEntry.MAX_TAG_IDS:
+                return BlobEntry.id.in_(sorted(ids))
+
+        ltag_ids = [BlobEntry.match_tags(token) for token in ltoken]
+        exclude_ids = set()
+        for token in exclude:
+            exclude_ids.update(BlobEntry.match_tags(token))
+        if any(len(ids) > BlobEntry.MAX_TAG_IDS for ids in ltag_ids + [exclude_ids]):
+            return BlobEntry.like_condition(OP, ltoken, exclude)
+
+        def tagged(tag_ids):
+            return BlobEntry.id.in_(
+                sqla.select([Blob__Tag.c.blob_entry_id])
+                    .where(Blob__Tag.c.tag_id.in_(sorted(tag_ids))))
+
+        combine = OP is BlobEntry.OP_AND and sqla.and_ or sqla.or_
+        cond = combine(*[tagged(ids) for ids in ltag_ids])
+        if exclude_ids:
+            cond = sqla.and_(cond, ~tagged(exclude_ids))
+        return cond
+
+    @staticmethod
+    def _narrow(lblob, within):
+        if within is None:
+            return lblob
+        return [blob for blob in lblob if blob.id in within]
+
+    @staticmethod
+    def like_condition(OP, ltoken, exclude=()):
+        """
+        match_condition with LIKE '%token%' conditions, scanning the tag table
+        """
+        ltoken, exclude = BlobEntry._parse_query(OP, ltoken, exclude)
+        likecond = [BlobEntry.tags.any(Tag.text.like('%%%s%%' % token)) for token in ltoken]
+        combine = OP is BlobEntry.OP_AND and sqla.and_ or sqla.or_
+        cond = combine(*likecond)
+        for token in exclude:
+            cond = sqla.and_(cond, ~BlobEntry.tags.any(Tag.text.like('%%%s%%' % token)))
+        return cond
+
+    @staticmethod
+    def findall_like(OP, ltoken, exclude=()):
+        """
+        findall with LIKE '%token%' conditions, scanning the tag table
+        """
+        return db_session.query(BlobEntry).filter(
+            BlobEntry.like_condition(OP, ltoken, exclude)).order_by(BlobEntry.id).all()
 
     def __init__(self, tags=None, **kw):
         super(BlobEntry, self).__init__(**kw)
@@ -294,130 +1823,1844 @@ class BlobEntry(Base, DefaultMixin):
             self.tags = [isinstance(item, Tag) and item or Tag(item) for item in tags]
 
 
+class ResultRow(namedtuple('ResultRow', 'id size path taglist')):
+
+    def __str__(self):
+        return "(%s) @ %s" % (friendly_size(self.size or 0).rjust(4), self.path)
+
+
+class ResultPager(object):
+    """
+    the results of a findall query, loaded a page at a time instead of all
+    at once. rows come out sorted by $sort_key in SQL, and each page
+    continues after the last row of the previous one (keyset pagination on
+    the sort value and the blob id), so later pages cost the same as the
+    first and only rows that get looked at are ever loaded
+
+    rows are ResultRow tuples: the blob's id and size, the path of its most
+    recent existing file (or None), and its sorted list of tag texts
+
+    $within is a hint for refinements of an earlier query: the blob ids
+    that query found. unlike for findall it is only applied while it is
+    small enough to pass as an IN list, so the query itself has to imply it
+    """
+
+    PAGE_SIZE = 200
+    SORT_KEYS = ('id', 'size', 'path', 'tags')
+    FACET_LIMIT = 20
+
+    def __init__(self, OP, ltoken, exclude=(), within=None, sort_key='id', descending=False,
+                 page_size=PAGE_SIZE):
+        if sort_key not in self.SORT_KEYS:
+            raise Exception("unsupported sort key: [%s]" % sort_key)
+        self.ltoken, _ = BlobEntry._parse_query(OP, ltoken, exclude)
+        self.condition = BlobEntry.match_condition(OP, ltoken, exclude)
+        if within is not None and len(within) <= BlobEntry.MAX_TAG_IDS:
+            self.condition = sqla.and_(self.condition, BlobEntry.id.in_(sorted(within)))
+        self.sort_key = sort_key
+        self.descending = descending
+        self.page_size = page_size
+        self.exhausted = False
+        ## (sort value, blob id) of the last row handed out
+        self._last = None
+
+    @staticmethod
+    def _columns():
+        F = LocalFilePathHistoryEntry
+        T = Blob__Tag.c
+        path = (sqla.select([F.path])
+                .where(F.blob_id == BlobEntry.id)
+                .where(F.file_exists == True)
+                .order_by(F.id.desc())
+                .limit(1)
+                .as_scalar())
+        tagged = sqla.select([Tag.text]).where(Tag.id == T.tag_id).where(T.blob_entry_id == BlobEntry.id)
+        tags = tagged.with_only_columns([sqla.func.group_concat(Tag.text, '\n')]).as_scalar()
+        ## blobs are sorted by their alphabetically first tag
+        first_tag = tagged.with_only_columns([sqla.func.min(Tag.text)]).as_scalar()
+        return path, tags, {
+            'id': BlobEntry.id,
+            'size': sqla.func.coalesce(BlobEntry.size, 0),
+            'path': sqla.func.coalesce(path, ''),
+            'tags': sqla.func.coalesce(first_tag, ''),
+        }
+
+    def count(self):
+        """
+        the total number of matching blobs
+        """
+        return db_session.query(sqla.func.count(BlobEntry.id)).filter(self.condition).scalar()
+
+    def facets(self, limit=FACET_LIMIT):
+        """
+        up to $limit (tag text, number of matching blobs) of the tags the
+        matching blobs carry, most common first, from one aggregate over
+        blob__tag. adding one of them to the query narrows it, so tags
+        matching a query token, and tags every match has, are left out
+        """
+        T = Blob__Tag.c
+        nblob = sqla.func.count(T.blob_entry_id.distinct())
+        matched = sqla.select([BlobEntry.id]).where(self.condition)
+        total = sqla.select([sqla.func.count(BlobEntry.id)]).where(self.condition).as_scalar()
+        qr = (sqla.select([Tag.text, nblob])
+              .select_from(Blob__Tag.join(Tag.__table__, T.tag_id == Tag.id))
+              .where(T.blob_entry_id.in_(matched)))
+        for token in self.ltoken:
+            qr = qr.where(~Tag.text.like('%%%s%%' % token))
+        qr = qr.group_by(Tag.id).having(nblob < total).order_by(nblob.desc(), Tag.text).limit(limit)
+        return [(text, count) for text, count in db_session.execute(qr)]
+
+    def fetch(self, limit=None):
+        """
+        the next $limit (default: page_size) rows, or [] once all have been
+        fetched
+        """
+        if self.exhausted:
+            return []
+        limit = limit or self.page_size
+        path, tags, sort_columns = self._columns()
+        key = sort_columns[self.sort_key]
+        qr = db_session.query(BlobEntry.id, BlobEntry.size, path, tags, key).filter(self.condition)
+        if self._last is not None:
+            last_key, last_id = self._last
+            if self.descending:
+                after = sqla.or_(key < last_key, sqla.and_(key == last_key, BlobEntry.id < last_id))
+            else:
+                after = sqla.or_(key > last_key, sqla.and_(key == last_key, BlobEntry.id > last_id))
+            qr = qr.filter(after)
+        if self.descending:
+            qr = qr.order_by(key.desc(), BlobEntry.id.desc())
+        else:
+            qr = qr.order_by(key, BlobEntry.id)
+        lrow = qr.limit(limit).all()
+        if len(lrow) < limit:
+            self.exhausted = True
+        if lrow:
+            self._last = (lrow[-1][4], lrow[-1][0])
+        return [ResultRow(id, size, path, sorted(tags.split('\n')) if tags else [])
+                for id, size, path, tags, _ in lrow]
+
+    def reordered(self, sort_key, descending=False):
+        """
+        a new pager over the same results, from the first row, sorted by
+        $sort_key instead
+        """
+        if sort_key not in self.SORT_KEYS:
+            raise Exception("unsupported sort key: [%s]" % sort_key)
+        pager = copy.copy(self)
+        pager.sort_key = sort_key
+        pager.descending = descending
+        pager.exhausted = False
+        pager._last = None
+        return pager
+
+    def __iter__(self):
+        while True:
+            lrow = self.fetch()
+            if not lrow:
+                return
+            for row in lrow:
+                yield row
+
+
+class ExportRow(namedtuple('ExportRow', 'hash size time_verified path taglist')):
+
+    def as_dict(self):
+        return {
+            'hash': self.hash,
+            'size': self.size,
+            'time_verified': self.time_verified,
+            'path': self.path,
+            'tags': self.taglist,
+        }
+
+
+def iter_export_rows(batch_size=1000):
+    """
+    yield an ExportRow for every blob in the index, ordered by blob id.
+
+    everything comes from a single query: the blob's hash, of the index's
+    hash algorithm, and its most recent existing file are joined in, one
+    each, even for blobs linked to several hashes by old indexes, and
+    its tags are concatenated by sqlite. rows are fetched $batch_size at a
+    time while the query runs, so memory use does not grow with the size
+    of the index
+
+    blobs indexed without a hash (see cascade_hashes) have hash None
+    """
+    F = LocalFilePathHistoryEntry
+    H = BlobEntryHash.__table__
+    T = Blob__Tag.c
+    E = get_hash_entry_type()
+    algo = HashAlgorithm.get(name=E.NAME)
+    Fi = F.__table__.alias()
+    Hi = H.alias()
+    first_hash = (sqla.select([sqla.func.min(Hi.c.id)])
+                  .where(Hi.c.blob_id == BlobEntry.id)
+                  .where(Hi.c.hash_algorithm_id == algo.id)
+                  .correlate(BlobEntry.__table__)
+                  .as_scalar())
+    latest_file = (sqla.select([sqla.func.max(Fi.c.id)])
+                   .where(Fi.c.blob_id == BlobEntry.id)
+                   .where(Fi.c.file_exists == True)
+                   .correlate(BlobEntry.__table__)
+                   .as_scalar())
+    tags = (sqla.select([sqla.func.group_concat(Tag.text, '\n')])
+            .where(Tag.id == T.tag_id)
+            .where(T.blob_entry_id == BlobEntry.id)
+            .as_scalar())
+    qr = sqla.select([E.value, BlobEntry.size, F.time_verified, F.path, tags]).select_from(
+        BlobEntry.__table__
+        .outerjoin(H, H.c.id == first_hash)
+        .outerjoin(E, E.id == H.c.hash_entry_id)
+        .outerjoin(F, F.id == latest_file)
+    ).order_by(BlobEntry.id)
+
+    result = db_session.connection().execution_options(stream_results=True).execute(qr)
+    try:
+        while True:
+            lrow = result.fetchmany(batch_size)
+            if not lrow:
+                break
+            for hash, size, time_verified, path, tags in lrow:
+                yield ExportRow(hash, size, time_verified, path, sorted(tags.split('\n')) if tags else [])
+    finally:
+        result.close()
+
+
+EXPORT_FORMATS = ('tsv', 'csv', 'jsonl')
+
+
+def export_index(ofile, format='tsv', rows=None, header=True):
+    """
+    write $rows (default: iter_export_rows()) to the text stream $ofile,
+    one line per blob as they come in, as 'tsv', 'csv' or 'jsonl'. leave
+    out the column names with $header False, e.g. to write in parts
+
+    returns the number of rows written
+    """
+    if format not in EXPORT_FORMATS:
+        raise Exception("unsupported export format: [%s]" % format)
+    if rows is None:
+        rows = iter_export_rows()
+    header = header and ("hash", "size", "time_verified", "path", "tags")
+    if format == 'tsv':
+        def writerow(ls):
+            ofile.write("\t".join(map(str, ls)) + "\n")
+
+        def format_row(row):
+            return row[:-1] + ('"%s"' % ",".join(row.taglist),)
+    elif format == 'csv':
+        writerow = csv.writer(ofile).writerow
+
+        def format_row(row):
+            return row[:-1] + (",".join(row.taglist),)
+    else:
+        header = None
+
+        def writerow(ls):
+            ofile.write(json.dumps(ls) + "\n")
+
+        format_row = ExportRow.as_dict
+
+    if header:
+        writerow(header)
+    count = 0
+    for row in rows:
+        writerow(format_row(row))
+        count += 1
+    return count
+
+
+class TagPostingIndex(object):
+    """
+    optional in-process posting lists built from blob__tag: tag id -> sorted
+    array of blob ids. findall then answers AND / OR / exclude queries with
+    set operations instead of queries.
+
+    the index can be kept in a snapshot file. a snapshot is only reused if
+    its fingerprint of blob__tag still matches the database, otherwise the
+    index is rebuilt
+    """
+
+    SNAPSHOT_VERSION = 1
+    TYPECODE = 'q'
+
+    def __init__(self, snapshot_path=None):
+        self.snapshot_path = snapshot_path
+        self.postings = {}
+
+    @staticmethod
+    def get_fingerprint():
+        c = Blob__Tag.c
+        return tuple(db_session.execute(sqla.select([
+            sqla.func.count(),
+            sqla.func.total(c.blob_entry_id),
+            sqla.func.total(c.tag_id),
+            sqla.func.total(c.blob_entry_id * c.tag_id),
+        ])).first())
+
+    @classmethod
+    def build(cls, snapshot_path=None):
+        index = cls(snapshot_path)
+        lists = defaultdict(set)
+        for blob_id, tag_id in db_session.execute(
+                sqla.select([Blob__Tag.c.blob_entry_id, Blob__Tag.c.tag_id])):
+            lists[tag_id].add(blob_id)
+        for tag_id, sblob_id in lists.items():
+            index.postings[tag_id] = array(cls.TYPECODE, sorted(sblob_id))
+        return index
+
+    @classmethod
+    def load(cls, snapshot_path=None):
+        """
+        load the index from $snapshot_path if it is still current, else
+        build it from the database and write a new snapshot
+        """
+        if snapshot_path and pexists(snapshot_path):
+            try:
+                with open(snapshot_path, 'rb') as ifile:
+                    data = pickle.load(ifile)
+            except (IOError, OSError, EOFError, pickle.UnpicklingError):
+                data = None
+            if isinstance(data, dict) \
+                    and data.get('version') == cls.SNAPSHOT_VERSION \
+                    and data.get('fingerprint') == cls.get_fingerprint():
+                index = cls(snapshot_path)
+                index.postings = data['postings']
+                return index
+        index = cls.build(snapshot_path)
+        if snapshot_path:
+            index.save()
+        return index
+
+    def save(self, snapshot_path=None):
+        snapshot_path = snapshot_path or self.snapshot_path
+        tmp_path = snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as ofile:
+            pickle.dump(dict(
+                version=self.SNAPSHOT_VERSION,
+                fingerprint=self.get_fingerprint(),
+                postings=self.postings,
+            ), ofile, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, snapshot_path)
+
+    def add(self, pairs):
+        for blob_id, tag_id in pairs:
+            posting = self.postings.get(tag_id)
+            if posting is None:
+                self.postings[tag_id] = array(self.TYPECODE, [blob_id])
+                continue
+            i = bisect_left(posting, blob_id)
+            if i == len(posting) or posting[i] != blob_id:
+                posting.insert(i, blob_id)
+
+    def remove(self, pairs):
+        for blob_id, tag_id in pairs:
+            posting = self.postings.get(tag_id)
+            if posting is None:
+                continue
+            i = bisect_left(posting, blob_id)
+            if i < len(posting) and posting[i] == blob_id:
+                del posting[i]
+                if not posting:
+                    del self.postings[tag_id]
+
+    def get_blobs(self, tag_ids):
+        ## ids of the blobs carrying any of $tag_ids
+        sblob_id = set()
+        for tag_id in tag_ids:
+            sblob_id.update(self.postings.get(tag_id, ()))
+        return sblob_id
+
+    def query(self, OP, ltag_ids, exclude_ids=()):
+        """
+        @param ltag_ids: one set of matching tag ids per search token
+        @param exclude_ids: tag ids whose blobs are removed from the result
+
+        returns the set of matching blob ids
+        """
+        lsets = [self.get_blobs(tag_ids) for tag_ids in ltag_ids]
+        if not lsets:
+            return set()
+        if OP is BlobEntry.OP_AND:
+            lsets.sort(key=len)
+            result = lsets[0].intersection(*lsets[1:])
+        else:
+            result = set().union(*lsets)
+        if exclude_ids and result:
+            result -= self.get_blobs(exclude_ids)
+        return result
+
+
+tag_posting_index = None
+
+
+def enable_posting_index(snapshot_path=None):
+    """
+    make findall use a TagPostingIndex, loaded from or saved to
+    $snapshot_path if given
+    """
+    global tag_posting_index
+    tag_posting_index = TagPostingIndex.load(snapshot_path)
+    return tag_posting_index
+
+
+def save_posting_snapshot():
+    if tag_posting_index is not None and tag_posting_index.snapshot_path:
+        tag_posting_index.save()
+
+
+@blob_tags_changed.connect
+def _update_tag_posting_index(added, removed):
+    if tag_posting_index is not None:
+        tag_posting_index.add(added)
+        tag_posting_index.remove(removed)
+
+
+def _chunked(seq, size=500):
+    ## keep IN (...) lists under sqlite's bound variable limit
+    seq = list(seq)
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+## per connection scratch table holding the blob ids of a selection, so
+## statements can join against it instead of binding one IN (...) list per
+## _chunked slice of ids
+_blob_selection = sqla.table('_blob_selection', sqla.column('id', sqla.Integer))
+
+
+def _select_blobs(lblob_id):
+    """
+    fill the _blob_selection table on the current transaction's connection
+    with $lblob_id and return it. this writes, so the caller has to commit
+    or roll back the transaction it opens
+    """
+    db_session.execute('CREATE TEMP TABLE IF NOT EXISTS _blob_selection (id INTEGER PRIMARY KEY)')
+    db_session.execute(_blob_selection.delete())
+    rows = [dict(id=id) for id in set(lblob_id)]
+    if rows:
+        db_session.execute(_blob_selection.insert(), rows)
+    return _blob_selection
+
+
+def ensure_tags(ltext):
+    """
+    return ({text: tag id}, [(tag id, text) of the inserted tags]) for the
+    tag texts in $ltext, inserting the tags that don't exist yet. doesn't
+    commit, so tag_created is left to the caller
+    """
+    dtag = {}
+    for chunk in _chunked(set(ltext)):
+        dtag.update((text, id) for id, text in db_session.execute(
+            sqla.select([Tag.id, Tag.text]).where(Tag.text.in_(chunk))))
+    lnew = sorted(set(ltext) - set(dtag))
+    lcreated = []
+    if lnew:
+        db_session.execute(Tag.__table__.insert(), [dict(text=text) for text in lnew])
+        for chunk in _chunked(lnew):
+            lcreated.extend(tuple(row) for row in db_session.execute(
+                sqla.select([Tag.id, Tag.text]).where(Tag.text.in_(chunk))))
+        dtag.update((text, id) for id, text in lcreated)
+    return dtag, lcreated
+
+
+class ScanCheckpoint(Base, DefaultMixin):
+    """
+    how far an unfinished bulk reindex of base_dir got: last_path is the
+    last file committed, in walk order (see scan_tree's $resume_after).
+
+    the row is updated in the same transaction as each BulkWriter batch, so
+    it never claims more than is in the index, and deleted once a reindex
+    completes its walk
+    """
+    base_dir = sqla.Column(sqla.String, unique=True)
+    last_path = sqla.Column(sqla.String)
+    files_done = sqla.Column(sqla.Integer, default=0)
+    bytes_done = sqla.Column(sqla.Integer, default=0)
+    time_started = sqla.Column(sqla.Float)
+    time_updated = sqla.Column(sqla.Float)
+
+    def advance(self, batch):
+        """
+        move the checkpoint past $batch, a list of BulkWriter records, within
+        the current transaction
+        """
+        table = self.__table__
+        db_session.execute(table.update().where(table.c.id == self.id).values(
+            last_path=batch[-1]['path'],
+            files_done=table.c.files_done + len(batch),
+            bytes_done=table.c.bytes_done + sum(record['size'] or 0 for record in batch),
+            time_updated=time.time()))
+
+
+class ReindexCancelled(Exception):
+    pass
+
+
+class ReindexProgress(object):
+    """
+    counters of a running reindex, for display. they are only ever
+    incremented, each by one thread, so other threads can read them
+
+    files_seen: files walked
+    files_changed, bytes_changed: the walked files that need indexing
+    files_done, bytes_done: the changed files indexed so far
+
+    while the walk is still going (walk_finished is False), the totals
+    keep growing and eta() is a lower bound
+
+    $callback, if given, is called with the progress every $interval
+    seconds while files get done
+
+    cancel() stops the reindex counting on it from another thread: the
+    next file walked or done raises ReindexCancelled. batches committed
+    by then stay, and a bulk reindex resumes after them
+    """
+
+    def __init__(self, callback=None, interval=1.0):
+        self.callback = callback
+        self.interval = interval
+        self.time_started = time.time()
+        self._time_reported = self.time_started
+        self.files_seen = 0
+        self.files_changed = 0
+        self.bytes_changed = 0
+        self.files_done = 0
+        self.bytes_done = 0
+        self.walk_finished = False
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def seen(self, stat, changed):
+        if self.cancelled:
+            raise ReindexCancelled()
+        self.files_seen += 1
+        if changed:
+            self.files_changed += 1
+            self.bytes_changed += stat.st_size
+
+    def done(self, size):
+        if self.cancelled:
+            raise ReindexCancelled()
+        self.files_done += 1
+        self.bytes_done += size or 0
+        if self.callback is not None and time.time() - self._time_reported >= self.interval:
+            self._time_reported = time.time()
+            self.callback(self)
+
+    def finish(self):
+        self.walk_finished = True
+        if self.callback is not None:
+            self.callback(self)
+
+    def elapsed(self):
+        return time.time() - self.time_started
+
+    def eta(self):
+        """
+        seconds left at the rate bytes got done so far, or None before
+        anything is
+        """
+        elapsed = self.elapsed()
+        if not self.bytes_done or not elapsed:
+            return None
+        return max(0, self.bytes_changed - self.bytes_done) / (self.bytes_done / elapsed)
+
+    def __str__(self):
+        eta = self.eta()
+        return '%d/%d%s files, %s/%s, %s' % (
+            self.files_done, self.files_changed, not self.walk_finished and '+' or '',
+            friendly_size(self.bytes_done).strip(), friendly_size(self.bytes_changed).strip(),
+            eta is None and 'ETA unknown' or 'ETA %ds%s' % (eta, not self.walk_finished and '+' or ''))
+
+
+class RateLimiter(object):
+    """
+    caps the combined rate of reads reported to consume() at $bytes_per_sec,
+    across threads. each read reserves the next slot of time its size
+    takes at that rate, and its thread sleeps until the slot starts
+    """
+
+    def __init__(self, bytes_per_sec):
+        self.bytes_per_sec = float(bytes_per_sec)
+        self._lock = threading.Lock()
+        self._time_free = time.time()
+
+    def consume(self, nbytes):
+        with self._lock:
+            now = time.time()
+            start = max(now, self._time_free)
+            self._time_free = start + nbytes / self.bytes_per_sec
+        if start > now:
+            time.sleep(start - now)
+
+
+class ThrottledReader(object):
+    """
+    the readinto of the binary file object $ifile, paced by the RateLimiter
+    $limiter. enough of a file for hash_stream
+    """
+
+    def __init__(self, ifile, limiter):
+        self.ifile = ifile
+        self.limiter = limiter
+
+    def readinto(self, buf):
+        nread = self.ifile.readinto(buf)
+        if nread:
+            self.limiter.consume(nread)
+        return nread
+
+
+class ScrubReport(object):
+    """
+    what Indexer.scrub found. paths are relative to the indexed tree
+
+    mismatched: dicts of path, size, algorithm, expected and actual digest,
+                and stat_changed, False if the file's stat still matches
+                what was indexed, i.e. the content changed behind the
+                file system's back
+    missing: paths of files that are no longer there
+    failed: dicts of path and error, for files that could not be read
+    """
+
+    def __init__(self):
+        self.time_started = time.time()
+        self.time_finished = None
+        self.files_checked = 0
+        self.bytes_checked = 0
+        self.files_ok = 0
+        ## files whose blob has no digest to check against
+        self.files_unhashed = 0
+        self.mismatched = []
+        self.missing = []
+        self.failed = []
+
+    def as_dict(self):
+        return {
+            'time_started': self.time_started,
+            'time_finished': self.time_finished,
+            'files_checked': self.files_checked,
+            'bytes_checked': self.bytes_checked,
+            'files_ok': self.files_ok,
+            'files_unhashed': self.files_unhashed,
+            'mismatched': self.mismatched,
+            'missing': self.missing,
+            'failed': self.failed,
+        }
+
+    def write_json(self, ofile):
+        json.dump(self.as_dict(), ofile, indent=2, sort_keys=True)
+        ofile.write('\n')
+
+    def __str__(self):
+        return '%d files checked, %s: %d ok, %d mismatched, %d missing, %d failed, %d without a hash' % (
+            self.files_checked, friendly_size(self.bytes_checked).strip(), self.files_ok,
+            len(self.mismatched), len(self.missing), len(self.failed), self.files_unhashed)
+
+
+class BulkWriter(object):
+    """
+    buffer new index rows and write them as multi-row INSERTs, one
+    transaction per batch of $batch_size files.
+
+    ids are allocated here instead of by the database so rows can be linked
+    to each other before anything is written. this is only safe while the
+    writer is the only thing inserting into the index, so each batch is
+    written holding write_lock, which in-process writers share.
+
+    if a batch fails to commit, it is rolled back and replayed one file per
+    transaction so a single bad file only loses itself
+
+    $cache is an Indexer.dfile style dict; the ids of committed file rows
+    are written back into it, and files that fail are dropped from it
+
+    $checkpoint is a ScanCheckpoint to advance with every committed batch
+
+    blobs are matched on their digest of $hash_algorithm. digests of other
+    algorithms staged with a file are linked to its blob as well
+    """
+
+    DEFAULT_BATCH_SIZE = 1000
+
+    def __init__(self, hash_algorithm, batch_size=DEFAULT_BATCH_SIZE, cache=None, checkpoint=None):
+        self.hash_algorithm_id = hash_algorithm.id
+        self.hash_table = get_hash_entry_type(hash_algorithm.name).__table__
+        ## algorithm name -> HashAlgorithm.id, for the extra digests
+        self._algorithm_ids = {}
+        self.batch_size = batch_size
+        self.cache = cache
+        self.checkpoint = checkpoint
+        self._pending = []
+
+        self.nfiles = 0
+        self.nrows = 0
+        self.time_spent = 0.0
+        ## list of (path, exception)
+        self.failed = []
+
+    def stage(self, file, hash, size, tags=None):
+        '''
+        @type file: LocalFilePathHistoryEntry
+        '''
+        self.stage_record(file.path, hash, size, file.time_verified,
+                          file_exists=file.file_exists, id=file.id, tags=tags,
+                          mtime_ns=file.mtime_ns, inode=file.inode, device=file.device)
+
+    def stage_record(self, path, hash, size, time_verified, file_exists=True, id=None, tags=None,
+                     mtime_ns=None, inode=None, device=None, blob_id=None, extra_hashes=None):
+        '''
+        stage a file by its column values. $id is the existing
+        LocalFilePathHistoryEntry.id if the path is already indexed.
+        $blob_id binds the file to a known blob, instead of the one matching
+        $hash. $extra_hashes maps other algorithms to the file's digests
+        '''
+        for algorithm in extra_hashes or ():
+            if algorithm not in self._algorithm_ids:
+                ## outside of _write, since ensure commits
+                self._algorithm_ids[algorithm] = HashAlgorithm.ensure(name=algorithm).id
+        self._pending.append(dict(
+            id=id,
+            known_blob_id=blob_id,
+            path=path,
+            file_exists=file_exists,
+            time_verified=time_verified,
+            mtime_ns=mtime_ns,
+            inode=inode,
+            device=device,
+            hash=hash,
+            extra_hashes=extra_hashes or {},
+            size=size,
+            tags=[getattr(tag, 'text', tag) for tag in (tags or [])],
+        ))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def fail(self, path, error):
+        self.failed.append((path, error))
+        stats.count('files_failed')
+
+    def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        time_start = time.time()
+        with write_lock:
+            self._flush(batch)
+        self.time_spent += time.time() - time_start
+
+    def _flush(self, batch):
+        try:
+            with stats.phase('db_write'):
+                self.nrows += self._write(batch)
+                if self.checkpoint is not None:
+                    self.checkpoint.advance(batch)
+            with stats.phase('db_commit'):
+                db_session.commit()
+            self.nfiles += len(batch)
+            self._committed(batch)
+        except sqla.exc.SQLAlchemyError:
+            db_session.rollback()
+            for record in batch:
+                try:
+                    self.nrows += self._write([record])
+                    if self.checkpoint is not None:
+                        self.checkpoint.advance([record])
+                    db_session.commit()
+                    self.nfiles += 1
+                    self._committed([record])
+                except sqla.exc.SQLAlchemyError as e:
+                    db_session.rollback()
+                    self.fail(record['path'], e)
+                    if self.cache is not None:
+                        self.cache.pop(record['path'], None)
+
+    def _committed(self, batch):
+        tag_created.send(self._new_tags)
+        blob_tags_changed.send(self._new_blob_tags, [])
+        if self.cache is None:
+            return
+        for record in batch:
+            signature = self.cache.get(record['path'])
+            if signature is not None:
+                self.cache[record['path']] = signature._replace(
+                    id=record['file_id'], blob_id=record['blob_id'])
+
+    def rows_per_sec(self):
+        if not self.time_spent:
+            return 0.0
+        return self.nrows / self.time_spent
+
+    def report(self):
+        return 'wrote %d rows for %d files in %.2fs (%.0f rows/sec), %d failed' % (
+            self.nrows, self.nfiles, self.time_spent, self.rows_per_sec(), len(self.failed))
+
+    @staticmethod
+    def _next_id(table):
+        return (db_session.query(sqla.func.max(table.c.id)).scalar() or 0) + 1
+
+    def _write(self, batch):
+        hash_table = self.hash_table
+        blob_table = BlobEntry.__table__
+        blobhash_table = BlobEntryHash.__table__
+        file_table = LocalFilePathHistoryEntry.__table__
+        tag_table = Tag.__table__
+
+        ## hash entries. records without a hash were indexed by the
+        ## duplicate cascade as unique, see cascade_hashes
+        lhash = set(r['hash'] for r in batch if r['hash'] is not None)
+        dhash = {}
+        for chunk in _chunked(lhash):
+            dhash.update((value, id) for id, value in db_session.execute(
+                sqla.select([hash_table.c.id, hash_table.c.value]).where(hash_table.c.value.in_(chunk))))
+
+        ## blobs are matched on content hash
+        dblob = {}
+        for chunk in _chunked(dhash.values()):
+            dblob.update((hash_entry_id, blob_id) for hash_entry_id, blob_id in db_session.execute(
+                sqla.select([blobhash_table.c.hash_entry_id, sqla.func.min(blobhash_table.c.blob_id)])
+                    .where(blobhash_table.c.hash_algorithm_id == self.hash_algorithm_id)
+                    .where(blobhash_table.c.hash_entry_id.in_(chunk))
+                    .group_by(blobhash_table.c.hash_entry_id)))
+        lblob_id_existing = set(dblob.values())
+        lblob_id_existing.update(r['known_blob_id'] for r in batch if r['known_blob_id'] is not None)
+
+        new_hash_rows = []
+        new_blob_rows = []
+        new_link_rows = []
+        next_hash_id = self._next_id(hash_table)
+        next_blob_id = self._next_id(blob_table)
+        for record in batch:
+            if record['known_blob_id'] is not None:
+                record['blob_id'] = record['known_blob_id']
+                continue
+            hash = record['hash']
+            if hash is not None and hash not in dhash:
+                dhash[hash] = next_hash_id
+                new_hash_rows.append(dict(id=next_hash_id, value=hash))
+                next_hash_id += 1
+            hash_entry_id = dhash.get(hash)
+            if hash_entry_id is None or hash_entry_id not in dblob:
+                blob_id = next_blob_id
+                next_blob_id += 1
+                new_blob_rows.append(dict(id=blob_id, size=record['size']))
+                if hash_entry_id is not None:
+                    dblob[hash_entry_id] = blob_id
+                    new_link_rows.append(dict(
+                        blob_id=blob_id,
+                        hash_algorithm_id=self.hash_algorithm_id,
+                        hash_entry_id=hash_entry_id))
+            else:
+                blob_id = dblob[hash_entry_id]
+            record['blob_id'] = blob_id
+
+        ## tags
+        dtag = {}
+        for chunk in _chunked(set(text for r in batch for text in r['tags'])):
+            dtag.update((text, id) for id, text in db_session.execute(
+                sqla.select([tag_table.c.id, tag_table.c.text]).where(tag_table.c.text.in_(chunk))))
+        new_tag_rows = []
+        next_id = self._next_id(tag_table)
+        for record in batch:
+            for text in record['tags']:
+                if text not in dtag:
+                    dtag[text] = next_id
+                    new_tag_rows.append(dict(id=next_id, text=text))
+                    next_id += 1
+
+        existing_blob_tags = set()
+        for chunk in _chunked(lblob_id_existing):
+            existing_blob_tags.update(tuple(row) for row in db_session.execute(
+                sqla.select([Blob__Tag.c.blob_entry_id, Blob__Tag.c.tag_id])
+                    .where(Blob__Tag.c.blob_entry_id.in_(chunk))))
+        new_blob_tag_rows = []
+        for record in batch:
+            for text in record['tags']:
+                pair = (record['blob_id'], dtag[text])
+                if pair not in existing_blob_tags:
+                    existing_blob_tags.add(pair)
+                    new_blob_tag_rows.append(dict(blob_entry_id=pair[0], tag_id=pair[1]))
+
+        ## file paths
+        new_file_rows = []
+        updated_file_rows = []
+        next_id = self._next_id(file_table)
+        for record in batch:
+            row = dict(
+                blob_id=record['blob_id'],
+                path=record['path'],
+                file_exists=record['file_exists'],
+                time_verified=record['time_verified'],
+                size=record['size'],
+                mtime_ns=record['mtime_ns'],
+                inode=record['inode'],
+                device=record['device'],
+            )
+            if record['id'] is None:
+                row['id'] = record['file_id'] = next_id
+                next_id += 1
+                new_file_rows.append(row)
+            else:
+                row['_id'] = record['file_id'] = record['id']
+                updated_file_rows.append(row)
+
+        self._new_tags = [(row['id'], row['text']) for row in new_tag_rows]
+        self._new_blob_tags = [(row['blob_entry_id'], row['tag_id']) for row in new_blob_tag_rows]
+        nrows = 0
+        for table, rows in (
+                (hash_table, new_hash_rows),
+                (blob_table, new_blob_rows),
+                (blobhash_table, new_link_rows),
+                (tag_table, new_tag_rows),
+                (Blob__Tag, new_blob_tag_rows),
+                (file_table, new_file_rows)):
+            if rows:
+                db_session.execute(table.insert(), rows)
+                nrows += len(rows)
+        if updated_file_rows:
+            db_session.execute(
+                file_table.update().where(file_table.c.id == sqla.bindparam('_id')),
+                updated_file_rows)
+            nrows += len(updated_file_rows)
+        return nrows + self._write_extra_hashes(batch)
+
+    def _write_extra_hashes(self, batch):
+        ## link the extra digests to blobs that have none of their algorithm
+        blobhash_table = BlobEntryHash.__table__
+        by_algorithm = defaultdict(dict)
+        for record in batch:
+            for algorithm, value in record['extra_hashes'].items():
+                by_algorithm[algorithm].setdefault(record['blob_id'], value)
+
+        nrows = 0
+        for algorithm, dvalue in sorted(by_algorithm.items()):
+            algorithm_id = self._algorithm_ids[algorithm]
+            hash_table = get_hash_entry_type(algorithm).__table__
+            for chunk in _chunked(list(dvalue)):
+                for blob_id, in db_session.execute(
+                        sqla.select([blobhash_table.c.blob_id])
+                            .where(blobhash_table.c.hash_algorithm_id == algorithm_id)
+                            .where(blobhash_table.c.blob_id.in_(chunk))):
+                    del dvalue[blob_id]
+            dhash = {}
+            for chunk in _chunked(set(dvalue.values())):
+                dhash.update((value, id) for id, value in db_session.execute(
+                    sqla.select([hash_table.c.id, hash_table.c.value]).where(hash_table.c.value.in_(chunk))))
+
+            new_hash_rows = []
+            new_link_rows = []
+            next_hash_id = self._next_id(hash_table)
+            for blob_id, value in sorted(dvalue.items()):
+                if value not in dhash:
+                    dhash[value] = next_hash_id
+                    new_hash_rows.append(dict(id=next_hash_id, value=value))
+                    next_hash_id += 1
+                new_link_rows.append(dict(
+                    blob_id=blob_id, hash_algorithm_id=algorithm_id, hash_entry_id=dhash[value]))
+            for table, rows in ((hash_table, new_hash_rows), (blobhash_table, new_link_rows)):
+                if rows:
+                    db_session.execute(table.insert(), rows)
+                    nrows += len(rows)
+        return nrows
+
+
 class Indexer:
 
-    def __init__(self, BASE_DIR):
-        self._BASE_DIR = os.path.expanduser(BASE_DIR)
-        self.default_hash_algo = HashAlgorithm.get(name=Sha256Entry.NAME)
+    def __init__(self, BASE_DIR=None, storage=None):
+        ## files are listed and read through self.storage, see Storage
+        self.storage = storage or LocalStorage(BASE_DIR)
+        self._BASE_DIR = self.storage.basedir
+        ## stored paths are relative to the indexed tree
+        LocalFilePathHistoryEntry.RELATIVE_BASE_DIR = self._BASE_DIR
+        ## blobs are identified by the first, the rest are computed in the
+        ## same read pass, see configure_hashes
+        self.hash_algorithms = (index_hash_algorithm,) + index_extra_hash_algorithms
+        self.default_hash_algo = HashAlgorithm.get(name=index_hash_algorithm)
         self.reload_cache()
 
     def reload_cache(self):
-        ## preload the entire index
-        self.dfile = dict((f.path, f) for f in db_session.query(LocalFilePathHistoryEntry).all())
-        ## preload tags
-        self.dtag = dict((t.text, t) for t in db_session.query(Tag).all())
+        ## the caches below are loaded on first use, in the thread using
+        ## them, so creating an Indexer stays cheap
+        self._dfile = None
+        self._dtag = None
+        self._hashless_sizes = None
 
-    def add_file(self, filepath, tags=None, verbose=False):
-        relpath = LocalFilePathHistoryEntry.get_relpath(filepath)
-        f_existing = LocalFilePathHistoryEntry.get(path=relpath)
-        if f_existing is not None:
-            file = f_existing
-        else:
-            file = LocalFilePathHistoryEntry(
-                path=relpath, file_exists=pexists(relpath))
-        # skip already processed files
-        if file.path in self.dfile and file.is_match(self.dfile[file.path]):
+    @property
+    def dfile(self):
+        ## the entire index, as path -> FileSignature
+        if self._dfile is None:
+            F = LocalFilePathHistoryEntry
+            self._dfile = dict(
+                (row[0], FileSignature(*row[1:]))
+                for row in db_session.query(
+                    F.path, F.id, F.blob_id, F.size, F.mtime_ns, F.inode, F.device, F.time_verified,
+                    F.file_exists))
+        return self._dfile
+
+    @property
+    def hashless_sizes(self):
+        ## sizes of the blobs indexed without a digest of the index's hash,
+        ## see hash_blobs_of_size
+        if self._hashless_sizes is None:
+            B = BlobEntry.__table__
+            H = BlobEntryHash.__table__
+            self._hashless_sizes = set(size for size, in db_session.execute(
+                sqla.select([B.c.size]).where(~sqla.exists().where(sqla.and_(
+                    H.c.blob_id == B.c.id,
+                    H.c.hash_algorithm_id == self.default_hash_algo.id))).distinct()))
+        return self._hashless_sizes
+
+    def hash_blobs_of_size(self, size):
+        """
+        hash the blobs of $size that were indexed without a digest (see
+        hash_candidates), so that a file of that size about to be matched
+        to a blob by its digest finds a copy indexed by a lazy reindex
+        """
+        if size not in self.hashless_sizes:
             return
-        else:
-            self.dfile[file.path] = file
+        self.hashless_sizes.discard(size)
+        B = BlobEntry.__table__
+        H = BlobEntryHash.__table__
+        for blob in db_session.query(BlobEntry).filter(BlobEntry.size == size).filter(~sqla.exists().where(
+                sqla.and_(H.c.blob_id == B.c.id, H.c.hash_algorithm_id == self.default_hash_algo.id))):
+            blob.ensure_hash(self.hash_algorithms[0], storage=self.storage)
+
+    @property
+    def dtag(self):
+        ## text -> Tag of every tag
+        if self._dtag is None:
+            self._dtag = dict((t.text, t) for t in db_session.query(Tag).all())
+        return self._dtag
+
+    def add_file(self, filepath, tags=None, verbose=False, writer=None, stat=None,
+                 hash=None, full_hash=True):
+        """
+        index the file at $filepath.
+
+        $hash is its hexdigest if the caller already has it. otherwise the
+        file is hashed with self.hash_algorithms, unless $full_hash is False,
+        in which case it gets a blob of its own without a hash (see
+        cascade_hashes)
+
+        $stat is the file's os.stat_result if the caller already has one.
+        if it matches the FileSignature cached in self.dfile the file is
+        skipped without a database query or opening the file
 
-        content = file.get_content()
-        hash = Sha256Entry.get_hash(content)
-        chk = Sha256Entry.ensure(value=hash)
-        blob = BlobEntry.ensure(size=len(content))
+        if a BulkWriter is given, the new rows are staged on it instead of
+        being committed one by one
+
+        returns True if the file was (re)indexed, False if it was skipped
+        """
+        relpath = LocalFilePathHistoryEntry.get_relpath(filepath)
+        if stat is None:
+            stat = self.storage.stat(filepath)
+        cached, unchanged = self.lookup(relpath, stat)
+        # skip already processed files
+        if unchanged:
+            return False
+        stats.count('files_indexed')
+
+        if self.is_restored(cached, stat):
+            return self.restore_file(filepath, stat, cached, writer=writer, verbose=verbose)
+
+        size = stat.st_size
+        extra_hashes = None
+        if hash is None and full_hash:
+            extra_hashes, size = self.storage.hash_file_multi(filepath, self.hash_algorithms)
+            hash = extra_hashes.pop(self.hash_algorithms[0])
+        if hash is not None:
+            self.hash_blobs_of_size(size)
+        elif self._hashless_sizes is not None:
+            self._hashless_sizes.add(size)
+
+        if writer is not None:
+            ## the writer fills in the ids once the batch is committed
+            self.dfile[relpath] = FileSignature.from_stat(stat)
+            writer.stage_record(
+                relpath, hash, size, stat.st_mtime,
+                id=cached is not None and cached.id or None, tags=tags,
+                mtime_ns=stat.st_mtime_ns, inode=stat.st_ino, device=stat.st_dev,
+                extra_hashes=extra_hashes)
+            if verbose:
+                print('STAGING %s ...' % (relpath))
+            return True
+
+        with stats.phase('db_write'):
+            if cached is not None:
+                file = LocalFilePathHistoryEntry.get(id=cached.id)
+                file.update_stat(stat)
+                file.file_exists = True
+            else:
+                file = LocalFilePathHistoryEntry(path=filepath, file_exists=True, stat=stat)
+
+            if hash is not None:
+                chk = get_hash_entry_type().ensure(value=hash)
+                blob = BlobEntry.ensure_for_hash(chk, self.default_hash_algo, size)
+            else:
+                blob = BlobEntry(size=size)
+                blob.save()
+            for algorithm, value in (extra_hashes or {}).items():
+                blob.set_hash(algorithm, value)
+            if tags:
+                ## a copy of an indexed file finds its blob already tagged
+                tagged = set(tag.id for tag in blob.tags)
+                tags = [tag for tag in tags if tag.id not in tagged]
+                blob.tags.extend(tags)
+
+            file.blob = blob
+            if verbose:
+                print('ADDING %s ...' % (file))
+            file.save()
         if tags:
-            blob.tags.extend(tags)
-        BlobEntryHash(
-            blob_id=blob.id,
-            hash_algorithm_id=self.default_hash_algo.id,
-            hash_entry_id=chk.id,
-        ).save()
+            blob_tags_changed.send([(blob.id, tag.id) for tag in tags], [])
+        self.dfile[relpath] = FileSignature.from_stat(stat, id=file.id, blob_id=blob.id)
+        return True
 
-        file.blob = blob
-        if verbose:
-            print('ADDING %s ...' % (file))
-        file.save()
+    @staticmethod
+    def is_restored(cached, stat):
+        ## a file marked gone is back as it was, so it keeps its blob
+        return cached is not None and cached.file_exists is False \
+            and cached.blob_id is not None and cached.matches(stat)
 
-    def reindex(self, verbose=False):
+    def restore_file(self, filepath, stat, cached, writer=None, verbose=False):
+        """
+        mark the path of $filepath, whose FileSignature $cached is gone,
+        as existing again and bound to the same blob, without reading it
+        """
+        if writer is not None:
+            self.stage_for_blob(filepath, stat, cached.blob_id, writer)
+            return True
+        relpath = LocalFilePathHistoryEntry.get_relpath(filepath)
+        with stats.phase('db_write'):
+            file = LocalFilePathHistoryEntry.get(id=cached.id)
+            file.update_stat(stat)
+            file.file_exists = True
+            if verbose:
+                print('RESTORING %s ...' % (file))
+            file.save()
+        self.dfile[relpath] = FileSignature.from_stat(stat, id=file.id, blob_id=cached.blob_id)
+        return True
+
+    def split_merged_blobs(self, verbose=False):
+        """
+        after migration 5 found blobs shared by files of the same size but
+        different content, hash their files and split them by digest: the
+        files matching a blob's first readable file stay on it, the others
+        move to the blob of their digest, made if needed. files that are
+        gone stay put.
+
+        the blob's tags that are path tokens (see get_path_tokens) of only
+        the files that moved go with them, tags that are no file's path
+        token are kept by both
+
+        each blob is split in one transaction, and only once all of its
+        existing files could be read; until every blob is split, the next
+        reindex tries again. does nothing unless migration 5 asked for it
+
+        returns the number of files moved
+        """
+        if Setting.get_value(MERGED_BLOBS_SETTING) is None:
+            return 0
+        H = BlobEntryHash.__table__
+        F = LocalFilePathHistoryEntry
+        algorithm = self.hash_algorithms[0]
+        lblob_id = [blob_id for blob_id, in db_session.execute(
+            sqla.select([H.c.blob_id]).group_by(H.c.blob_id, H.c.hash_algorithm_id).having(
+                sqla.func.count(H.c.hash_entry_id.distinct()) > 1).distinct())]
+        nmoved = 0
+        complete = True
+        for blob_id in lblob_id:
+            lfile = db_session.query(F).filter_by(blob_id=blob_id).order_by(F.id).all()
+            ## digest -> files, in file order
+            by_hash = {}
+            try:
+                for file in lfile:
+                    if file.file_exists:
+                        hash, _ = file.get_hash(self.storage, algorithm=algorithm)
+                        by_hash.setdefault(hash, []).append(file)
+            except self.storage.ERRORS:
+                ## left merged, and flagged, for the next reindex
+                complete = False
+                continue
+            if not by_hash:
+                continue
+            dtoken = dict((file.id, set(self.get_path_tokens(file.get_storage_path(self.storage))))
+                          for file in lfile)
+            lgroup = [(hash, set(file.id for file in lgroup_file)) for hash, lgroup_file in by_hash.items()]
+            with write_lock:
+                nmoved += self._split_blob(blob_id, lgroup, dtoken, algorithm)
+            if verbose:
+                for hash, lgroup_file in list(by_hash.items())[1:]:
+                    for file in lgroup_file:
+                        print('SPLITTING %s ...' % file)
+        if complete:
+            with write_lock:
+                db_session.query(Setting).filter_by(key=MERGED_BLOBS_SETTING).delete()
+                db_session.commit()
+        return nmoved
+
+    def _split_blob(self, blob_id, lgroup, dtoken, algorithm):
+        ## $lgroup is [(digest, file ids)], the first staying on the blob.
+        ## $dtoken maps each of the blob's file ids to its path tokens.
+        ## writes with Core statements in a single transaction, so the blob
+        ## is either split or still has all of its digests
+        B = BlobEntry.__table__
+        H = BlobEntryHash.__table__
+        F = LocalFilePathHistoryEntry.__table__
+        T = Blob__Tag.c
+        hash_table = get_hash_entry_type(algorithm).__table__
+        algorithm_id = self.default_hash_algo.id
+
+        def ensure_hash_id(value):
+            row = db_session.execute(sqla.select([hash_table.c.id]).where(hash_table.c.value == value)).first()
+            if row is not None:
+                return row[0]
+            return db_session.execute(hash_table.insert().values(value=value)).inserted_primary_key[0]
+
+        def tokens(lfile_id):
+            return set().union(*(dtoken[file_id] for file_id in lfile_id))
+
+        ## see _bulk_tag on ending the read transaction first
+        db_session.commit()
+        added = []
+        removed = []
+        try:
+            size = db_session.execute(sqla.select([B.c.size]).where(B.c.id == blob_id)).scalar()
+            ltag = [(tag_id, text) for tag_id, text in db_session.execute(
+                sqla.select([Tag.id, Tag.text]).select_from(Blob__Tag.join(Tag.__table__, T.tag_id == Tag.id))
+                    .where(T.blob_entry_id == blob_id))]
+            ## the blob's digests were a mix of its files'
+            db_session.execute(H.delete().where(H.c.blob_id == blob_id))
+            db_session.execute(H.insert().values(
+                blob_id=blob_id, hash_algorithm_id=algorithm_id, hash_entry_id=ensure_hash_id(lgroup[0][0])))
+            lmoved = set()
+            for hash, lfile_id in lgroup[1:]:
+                hash_id = ensure_hash_id(hash)
+                target_id = db_session.execute(sqla.select([H.c.blob_id]).where(sqla.and_(
+                    H.c.hash_algorithm_id == algorithm_id, H.c.hash_entry_id == hash_id))).scalar()
+                if target_id is None:
+                    target_id = db_session.execute(B.insert().values(size=size)).inserted_primary_key[0]
+                    db_session.execute(H.insert().values(
+                        blob_id=target_id, hash_algorithm_id=algorithm_id, hash_entry_id=hash_id))
+                moving = tokens(lfile_id)
+                staying = tokens(set(dtoken) - lfile_id)
+                has_tag = set(tag_id for tag_id, in db_session.execute(
+                    sqla.select([T.tag_id]).where(T.blob_entry_id == target_id)))
+                rows = [dict(blob_entry_id=target_id, tag_id=tag_id) for tag_id, text in ltag
+                        if tag_id not in has_tag and (text in moving or text not in staying)]
+                if rows:
+                    db_session.execute(Blob__Tag.insert(), rows)
+                    added.extend((target_id, row['tag_id']) for row in rows)
+                for chunk in _chunked(sorted(lfile_id)):
+                    db_session.execute(F.update().where(F.c.id.in_(chunk)).values(blob_id=target_id))
+                lmoved |= lfile_id
+            gone = tokens(lmoved) - tokens(set(dtoken) - lmoved)
+            lremove = [tag_id for tag_id, text in ltag if text in gone]
+            if lremove:
+                db_session.execute(Blob__Tag.delete().where(sqla.and_(
+                    T.blob_entry_id == blob_id, T.tag_id.in_(lremove))))
+                removed = [(blob_id, tag_id) for tag_id in lremove]
+            db_session.commit()
+        except sqla.exc.SQLAlchemyError:
+            db_session.rollback()
+            raise
+        blob_tags_changed.send(added, removed)
+        return len(lmoved)
+
+    def lookup(self, relpath, stat):
+        """
+        return (the FileSignature cached for $relpath or None, whether $stat
+        still matches it, i.e. the file can be skipped)
+        """
+        cached = self.dfile.get(relpath)
+        unchanged = cached is not None and cached.file_exists is not False and cached.matches(stat)
+        stats.cache_lookup('dfile', unchanged)
+        if unchanged:
+            stats.count('files_skipped')
+        return cached, unchanged
+
+    @staticmethod
+    def get_path_tokens(filepath):
+        ## add pathname tokens as tags, each once
+        with stats.phase('tokenize'):
+            basefilepath, ext = psplitext(filepath)
+            ltoken = [token.lower()
+                      for token in re.split(r'\W+', basefilepath) + [ext[1:]]
+                      if len(token) > 1]
+            return sorted(set(ltoken), key=ltoken.index)
+
+    def hash_candidates(self, candidates, workers=0, use_processes=False):
+        """
+        run the duplicate cascade over $candidates, (filepath, stat) pairs
+        about to be indexed. sizes already in the index count as colliding,
+        and blobs of those sizes that were indexed without a hash get one
+        now so the new files can be matched against them
+
+        returns {filepath: hexdigest} for the files that need a full hash.
+        only the digest blobs are identified by is computed; the index's
+        extra ones are left to BlobEntry.ensure_hash
+        """
+        sizes = set(stat.st_size for _, stat in candidates)
+        known_sizes = set()
+        for chunk in _chunked(sizes):
+            known_sizes.update(size for size, in db_session.query(BlobEntry.size)
+                               .filter(BlobEntry.size.in_(chunk)).distinct())
+        for chunk in _chunked(known_sizes):
+            for blob in db_session.query(BlobEntry).filter(BlobEntry.size.in_(chunk)):
+                blob.ensure_hash(self.hash_algorithms[0], storage=self.storage)
+
+        items = [(filepath, stat.st_size) for filepath, stat in candidates]
+        kw = dict(known_sizes=known_sizes, storage=self.storage, algorithm=self.hash_algorithms[0])
+        if workers <= 0:
+            return cascade_hashes(items, **kw)
+        Executor = use_processes and ProcessPoolExecutor or ThreadPoolExecutor
+        with Executor(max_workers=workers) as pool:
+            return cascade_hashes(items, map=pool.map, **kw)
+
+    def reindex(self, verbose=False, bulk=False, batch_size=BulkWriter.DEFAULT_BATCH_SIZE,
+                workers=0, use_processes=False, queue_size=None, lazy_hash=False,
+                resume=True, progress=None):
         """
         walk self._BASE_DIR and build the index into the database
 
         The "intelligent" reindexing right now just means that if the size,
-        time_verified, and filenames match, we assume they are not changed
+        mtime, inode and device of a path match its FileSignature in
+        self.dfile, we assume it is not changed and never open it
+
+        with $bulk, new rows are written through a BulkWriter in batches of
+        $batch_size files per transaction. the writer is kept on
+        self.bulk_writer for its report. each batch also advances a
+        ScanCheckpoint, and if a bulk reindex is interrupted, the next one
+        continues the walk from there, unless $resume is False
+
+        with $workers > 0, files are hashed by a pool of that many threads
+        (or processes, with $use_processes); see reindex_pipelined. this
+        implies $bulk
+
+        with $lazy_hash, the changed files are collected first and only the
+        ones hash_candidates says could be duplicates are fully hashed. the
+        rest are indexed without a hash until BlobEntry.ensure_hash needs one,
+        or a reindex without $lazy_hash finds a file of the same size
+
+        $progress is a ReindexProgress to count on, else a new one. either
+        way it is kept on self.progress
         
         returns number of files processed from reindexing
         """
+        self.split_merged_blobs(verbose=verbose)
         self.reload_cache()
+        progress = self.progress = progress or ReindexProgress()
+        bulk = bulk or workers > 0
+        checkpoint = bulk and self.get_checkpoint(resume) or None
+        resume_after = checkpoint is not None and checkpoint.last_path or None
+        if resume_after and verbose:
+            print('resuming after %s' % resume_after)
+
+        if workers > 0 and not lazy_hash:
+            return self.reindex_pipelined(
+                workers=workers, use_processes=use_processes,
+                queue_size=queue_size, batch_size=batch_size, verbose=verbose,
+                checkpoint=checkpoint, progress=progress)
 
         def cachedTag(text):
+            stats.cache_lookup('dtag', text in self.dtag)
             if text not in self.dtag:
                 self.dtag[text] = Tag(text)
             return self.dtag[text]
 
+        def walk_changed():
+            for filepath, stat in stats.timed_iter('walk', self.storage.scan(resume_after=resume_after)):
+                _, unchanged = self.lookup(LocalFilePathHistoryEntry.get_relpath(filepath), stat)
+                changed = not unchanged
+                progress.seen(stat, changed)
+                if changed:
+                    yield filepath, stat
+            progress.walk_finished = True
+
+        changed = walk_changed()
+        digests = None
+        if lazy_hash:
+            changed = list(changed)
+            digests = self.hash_candidates(changed, workers=workers, use_processes=use_processes)
+
+        writer = None
+        if bulk:
+            writer = self.bulk_writer = BulkWriter(
+                self.default_hash_algo, batch_size=batch_size, cache=self.dfile,
+                checkpoint=checkpoint)
+
         # input('press to start.')
         total_processed = 0
-        BlobEntry.RELATIVE_BASE_DIR = self._BASE_DIR
-        for basedir, lsubdir, lsubfile in os.walk(self._BASE_DIR):
-            for subfile in lsubfile:
-                filepath = pjoin(basedir, subfile)
-                ## add pathname tokens as tags
-                basefilepath, ext = psplitext(filepath)
-                tags = [cachedTag(token.lower())
-                        for token in re.split(r'\W+', basefilepath) + [ext[1:]]
-                        if len(token) > 1]
-                self.add_file(filepath, tags=tags, verbose=verbose)
-                total_processed += 1
+        for filepath, stat in changed:
+            tokens = self.get_path_tokens(filepath)
+            kw = dict(verbose=verbose, stat=stat)
+            if digests is not None:
+                kw.update(hash=digests.get(filepath), full_hash=False)
+            if writer is None:
+                tags = [cachedTag(token) for token in tokens]
+                processed = self.add_file(filepath, tags=tags, **kw)
+            else:
+                ## bulk rows refer to tags by text, so no transient Tag
+                ## objects end up in self.dtag
+                try:
+                    processed = self.add_file(filepath, tags=tokens, writer=writer, **kw)
+                except self.storage.ERRORS as e:
+                    writer.fail(filepath, e)
+                    processed = False
+            total_processed += processed
+            progress.done(stat.st_size)
+        if writer is not None:
+            writer.flush()
+            if verbose:
+                print(writer.report())
         db_session.commit()
+        self.clear_checkpoint()
+        progress.finish()
+        save_posting_snapshot()
 
         return total_processed
 
-    def resync_db(self):
+    def get_checkpoint(self, resume=True, base_dir=None):
+        """
+        the ScanCheckpoint of an unfinished reindex of self._BASE_DIR, or a
+        new one. with $resume False, an unfinished one is started over.
+
+        $base_dir overrides the checkpoint's key, e.g. for scrub
+        """
+        base_dir = base_dir or self.storage.location()
+        checkpoint = ScanCheckpoint.get(base_dir=base_dir)
+        if checkpoint is not None and not resume:
+            self.clear_checkpoint(base_dir)
+            checkpoint = None
+        if checkpoint is None:
+            checkpoint = ScanCheckpoint(
+                base_dir=base_dir, files_done=0, bytes_done=0, time_started=time.time())
+            checkpoint.save()
+        return checkpoint
+
+    def clear_checkpoint(self, base_dir=None):
+        with write_lock:
+            for checkpoint in db_session.query(ScanCheckpoint).filter_by(
+                    base_dir=base_dir or self.storage.location()):
+                db_session.delete(checkpoint)
+            db_session.commit()
+
+    def stage_for_blob(self, filepath, stat, blob_id, writer):
+        """
+        stage $filepath on $writer as a copy of the blob $blob_id, without
+        reading it
+        """
+        relpath = LocalFilePathHistoryEntry.get_relpath(filepath)
+        cached = self.dfile.get(relpath)
+        self.dfile[relpath] = FileSignature.from_stat(stat)
+        writer.stage_record(
+            relpath, None, stat.st_size, stat.st_mtime,
+            id=cached is not None and cached.id or None,
+            tags=self.get_path_tokens(filepath), blob_id=blob_id,
+            mtime_ns=stat.st_mtime_ns, inode=stat.st_ino, device=stat.st_dev)
+
+    def move_file(self, old_relpath, filepath, writer, stat=None):
+        """
+        stage $filepath on $writer as the file indexed at $old_relpath,
+        moved. if its inode, device, size and mtime still match the old
+        path's FileSignature it is bound to the same blob without reading
+        it, and True is returned. otherwise nothing is staged
+
+        the old path is left as it is, see mark_gone
+        """
+        if stat is None:
+            stat = self.storage.stat(filepath)
+        old = self.dfile.get(old_relpath)
+        if old is None or old.blob_id is None or old.mtime_ns is None:
+            return False
+        if (old.device, old.inode, old.size, old.mtime_ns) != \
+                (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns):
+            return False
+        self.stage_for_blob(filepath, stat, old.blob_id, writer)
+        return True
+
+    def mark_gone(self, lrelpath):
+        """
+        mark the indexed paths in $lrelpath as file_exists=False, with one
+        UPDATE per chunk. their blobs and tags are kept
+        """
+        lrelpath = sorted(lrelpath)
+        table = LocalFilePathHistoryEntry.__table__
+        for chunk in _chunked(lrelpath):
+            db_session.execute(table.update()
+                               .where(table.c.path.in_(chunk))
+                               .values(file_exists=False))
+        db_session.commit()
+        ## so the paths are indexed again if they come back
+        for relpath in lrelpath:
+            signature = self.dfile.get(relpath)
+            if signature is not None:
+                self.dfile[relpath] = signature._replace(file_exists=False)
+
+    def find_duplicates(self):
         """
-        verify all entries in the database have not changed on the filesystem.
+        list the identical files under self._BASE_DIR as DuplicateGroups,
+        see find_duplicates
+        """
+        return find_duplicates(
+            ((filepath, stat.st_size) for filepath, stat in self.storage.scan()),
+            storage=self.storage)
 
-        If attribute changes are detected, overwrite the value in the db
+    def reindex_pipelined(self, workers=4, use_processes=False, queue_size=None,
+                          batch_size=BulkWriter.DEFAULT_BATCH_SIZE, verbose=False,
+                          checkpoint=None, progress=None):
+        """
+        three stage reindex:
 
-        If the file is no longer found, in order to preserve work, look for the
-        first matched file with a matching hash, rebind all tags to that file,
-        and delete the entry
+        1. a walker thread lists self._BASE_DIR, drops files whose path and
+           stat matches self.dfile, and submits the rest to
+        2. a pool of $workers threads (or processes) that read and hash them.
+           the futures go into a queue of $queue_size, in walk order, to
+        3. the calling thread, which is the only one touching db_session and
+           stages each result on a BulkWriter in the same order
 
-        If no matches are found, assume the file is gone and just delete the
-        entry
-        
+        the bounded queue is the backpressure: the walker blocks once
+        $queue_size files are in flight, so neither the pool nor the
+        walker can run arbitrarily far ahead of the database
+
+        $checkpoint and $progress are as in reindex
+
+        returns number of files processed
         """
+        progress = self.progress = progress or ReindexProgress()
+        resume_after = checkpoint is not None and checkpoint.last_path or None
+        if queue_size is None:
+            queue_size = 4 * workers
+        inflight = queue.Queue(maxsize=queue_size)
+        stop = threading.Event()
+        DONE = object()
+        walker_error = []
+
+        Executor = use_processes and ProcessPoolExecutor or ThreadPoolExecutor
+        pool = Executor(max_workers=workers)
+
+        def walk():
+            try:
+                for filepath, stat in stats.timed_iter('walk', self.storage.scan(resume_after=resume_after)):
+                    if stop.is_set():
+                        return
+                    relpath = LocalFilePathHistoryEntry.get_relpath(filepath)
+                    cached, unchanged = self.lookup(relpath, stat)
+                    changed = not unchanged
+                    progress.seen(stat, changed)
+                    if self.is_restored(cached, stat):
+                        ## nothing to read
+                        inflight.put((filepath, relpath, stat, None))
+                    elif changed:
+                        inflight.put((filepath, relpath, stat, pool.submit(
+                            self.storage.hash_file_multi, filepath, self.hash_algorithms)))
+                progress.walk_finished = True
+            except BaseException as e:
+                walker_error.append(e)
+            finally:
+                inflight.put(DONE)
+
+        writer = self.bulk_writer = BulkWriter(
+            self.default_hash_algo, batch_size=batch_size, cache=self.dfile,
+            checkpoint=checkpoint)
+        walker = threading.Thread(target=walk, name='reindex-walker')
+        walker.daemon = True
+        walker.start()
+
+        total_processed = 0
+        try:
+            while True:
+                item = inflight.get()
+                if item is DONE:
+                    break
+                filepath, relpath, stat, future = item
+                progress.done(stat.st_size)
+                if future is None:
+                    total_processed += self.restore_file(filepath, stat, self.dfile[relpath], writer=writer)
+                    continue
+                try:
+                    extra_hashes, size = future.result()
+                except self.storage.ERRORS as e:
+                    writer.fail(filepath, e)
+                    continue
+                hash = extra_hashes.pop(self.hash_algorithms[0])
+                stats.count('files_indexed')
+                self.hash_blobs_of_size(size)
+                cached = self.dfile.get(relpath)
+                self.dfile[relpath] = FileSignature.from_stat(stat)
+                writer.stage_record(
+                    relpath, hash, size, stat.st_mtime,
+                    id=cached is not None and cached.id or None,
+                    tags=self.get_path_tokens(filepath),
+                    mtime_ns=stat.st_mtime_ns, inode=stat.st_ino, device=stat.st_dev,
+                    extra_hashes=extra_hashes)
+                if verbose:
+                    print('STAGING %s ...' % relpath)
+                total_processed += 1
+            writer.flush()
+        finally:
+            ## unblock the walker if we are bailing out early
+            stop.set()
+            while walker.is_alive():
+                try:
+                    inflight.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            pool.shutdown()
+        if walker_error:
+            raise walker_error[0]
+        if verbose:
+            print(writer.report())
+        self.clear_checkpoint()
+        progress.finish()
+        save_posting_snapshot()
 
-        self.reindex()
+        return total_processed
+
+    SCRUB_CHECKPOINT_PREFIX = 'scrub:'
+
+    def scrub(self, workers=4, bytes_per_sec=None, older_than_days=None, resume=True,
+              batch_size=BulkWriter.DEFAULT_BATCH_SIZE, progress=None):
+        """
+        re-read the existing files in the index and check them against every
+        digest stored for their blob (see BlobEntryHash), on a pool of
+        $workers threads.
+
+        $bytes_per_sec, if given, caps the combined read rate of the pool.
+        with $older_than_days, only files that were never scrubbed, or
+        whose time_scrubbed is older than that many days, are checked.
+        files that check out get time_scrubbed set to now, so a scrub that
+        keeps being run with $older_than_days works through the index bit
+        by bit
+
+        files are checked in path order, $batch_size at a time, with a
+        ScanCheckpoint keyed by SCRUB_CHECKPOINT_PREFIX and the storage
+        location advanced after each batch. an interrupted scrub carries on
+        after the last finished batch, unless $resume is False; it only
+        reports on the files it checked itself
+
+        $progress is a ReindexProgress
+
+        returns a ScrubReport
+        """
+        F = LocalFilePathHistoryEntry
+        report = ScrubReport()
+        progress = self.progress = progress or ReindexProgress()
+        checkpoint_key = self.SCRUB_CHECKPOINT_PREFIX + self.storage.location()
+        checkpoint = self.get_checkpoint(resume, base_dir=checkpoint_key)
+        limiter = bytes_per_sec and RateLimiter(bytes_per_sec) or None
+        now = time.time()
+
+        query = db_session.query(F).filter(F.file_exists == True)
+        if older_than_days is not None:
+            query = query.filter(sqla.or_(
+                F.time_scrubbed == None, F.time_scrubbed < now - older_than_days * 86400))
+        if checkpoint.last_path is not None:
+            query = query.filter(F.path > checkpoint.last_path)
+        nfile, nbyte = query.with_entities(sqla.func.count(F.id), sqla.func.sum(F.size)).one()
+        progress.files_seen = progress.files_changed = nfile
+        progress.bytes_changed = nbyte or 0
+        progress.walk_finished = True
+
+        def check(filepath, algorithms):
+            stat = self.storage.stat(filepath)
+            with self.storage.open(filepath) as ifile:
+                if limiter is not None:
+                    ifile = ThrottledReader(ifile, limiter)
+                digests, _ = hash_stream_multi(ifile, algorithms)
+            return stat, digests
+
+        last_path = checkpoint.last_path
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            while True:
+                batch_query = query.order_by(F.path)
+                if last_path is not None:
+                    batch_query = batch_query.filter(F.path > last_path)
+                lrow = batch_query.with_entities(
+                    F.path, F.id, F.blob_id, F.size, F.mtime_ns, F.inode, F.device, F.time_verified
+                ).limit(batch_size).all()
+                if not lrow:
+                    break
+                last_path = lrow[-1][0]
+                lfile = [(row[0], FileSignature(*row[1:])) for row in lrow]
+                dstored = self._stored_digests(signature.blob_id for _, signature in lfile)
+
+                lfuture = []
+                for relpath, signature in lfile:
+                    stored = dstored.get(signature.blob_id)
+                    lfuture.append(stored is not None and pool.submit(
+                        check, self.storage.join(self._BASE_DIR, relpath), sorted(stored)) or None)
+
+                lverified = []
+                time_scrubbed = time.time()
+                for (relpath, signature), future in zip(lfile, lfuture):
+                    progress.done(signature.size)
+                    if future is None:
+                        report.files_unhashed += 1
+                        continue
+                    try:
+                        stat, digests = future.result()
+                    except self.storage.MISSING:
+                        report.missing.append(relpath)
+                        continue
+                    except self.storage.ERRORS as e:
+                        report.failed.append(dict(path=relpath, error=str(e)))
+                        continue
+                    report.files_checked += 1
+                    report.bytes_checked += stat.st_size
+                    lmismatch = [
+                        dict(path=relpath, size=stat.st_size, algorithm=algorithm,
+                             expected=expected, actual=digests[algorithm],
+                             stat_changed=not signature.matches(stat))
+                        for algorithm, expected in sorted(dstored[signature.blob_id].items())
+                        if digests[algorithm] != expected]
+                    if lmismatch:
+                        report.mismatched.extend(lmismatch)
+                        continue
+                    report.files_ok += 1
+                    verified = dict(time_scrubbed=time_scrubbed)
+                    if signature.mtime_ns is None:
+                        ## indexed before the stat signature was stored, and
+                        ## just shown to be unchanged
+                        verified.update(mtime_ns=stat.st_mtime_ns, inode=stat.st_ino, device=stat.st_dev)
+                    lverified.append((relpath, signature, verified))
+
+                self._set_verified(lverified)
+                checkpoint.advance([dict(path=relpath, size=signature.size) for relpath, signature in lfile])
+                db_session.commit()
+
+        self.clear_checkpoint(checkpoint_key)
+        report.time_finished = time.time()
+        progress.finish()
+        return report
 
-        sha256model = HashAlgorithm.get(name=Sha256Entry.NAME)
+    @staticmethod
+    def _stored_digests(lblob_id):
+        ## blob_id -> {algorithm: hexdigest} of every digest linked to the
+        ## blobs $lblob_id
+        H = BlobEntryHash.__table__
+        dalgorithm = dict(db_session.query(HashAlgorithm.id, HashAlgorithm.name))
+        dentry = defaultdict(lambda: defaultdict(list))
+        for chunk in _chunked(set(lblob_id)):
+            for blob_id, algorithm_id, hash_entry_id in db_session.execute(
+                    sqla.select([H.c.blob_id, H.c.hash_algorithm_id, H.c.hash_entry_id])
+                        .where(H.c.blob_id.in_(chunk))):
+                dentry[dalgorithm[algorithm_id]][hash_entry_id].append(blob_id)
+
+        rtn = defaultdict(dict)
+        for algorithm, dblob in dentry.items():
+            table = get_hash_entry_type(algorithm).__table__
+            for chunk in _chunked(list(dblob)):
+                for hash_entry_id, value in db_session.execute(
+                        sqla.select([table.c.id, table.c.value]).where(table.c.id.in_(chunk))):
+                    for blob_id in dblob[hash_entry_id]:
+                        rtn[blob_id][algorithm] = value
+        return rtn
+
+    def _set_verified(self, lverified):
+        ## write scrub's (relpath, FileSignature, {column: value}) updates,
+        ## and keep self.dfile in step
+        table = LocalFilePathHistoryEntry.__table__
+        by_columns = defaultdict(list)
+        for relpath, signature, verified in lverified:
+            by_columns[tuple(sorted(verified))].append(dict(verified, _id=signature.id))
+            if relpath in self.dfile:
+                self.dfile[relpath] = signature._replace(**dict(
+                    (name, value) for name, value in verified.items() if name in FileSignature._fields))
+        for rows in by_columns.values():
+            db_session.execute(table.update().where(table.c.id == sqla.bindparam('_id')), rows)
+
+    def resync_db(self, verbose=False, batch_size=BulkWriter.DEFAULT_BATCH_SIZE):
+        """
+        bring the index in line with self._BASE_DIR, from one walk of the
+        tree diffed against the stored paths of existing files:
+
+        - a new path with the inode, device, size and mtime of a path that
+          is gone is that file moved, and is bound to its blob without
+          reading the file
+        - the other new paths are hashed and indexed like in reindex, which
+          binds them to any existing blob with the same content. if that is
+          the blob of a gone path, it is a move as well
+        - paths that are gone or moved away from are marked
+          file_exists=False. their blobs and tags are kept
+        - changed files at known paths are reindexed
+
+        all of it is written through a BulkWriter, and the gone paths with
+        one UPDATE per chunk
+
+        returns {'add': [(None, realpath)],
+                 'del': [(realpath, None)],
+                 'mov': [(old realpath, new realpath)]}
+        """
+        self.split_merged_blobs(verbose=verbose)
+        self.reload_cache()
+        F = LocalFilePathHistoryEntry
+        existing = set(path for path, in db_session.query(F.path).filter(F.file_exists == True))
+        seen = dict((F.get_relpath(filepath), (filepath, stat))
+                    for filepath, stat in stats.timed_iter('walk', self.storage.scan()))
+
+        gone = dict((relpath, self.dfile[relpath]) for relpath in existing if relpath not in seen)
+        ## moved paths are taken out of gone as they are found
+        vanished = sorted(gone)
+        gone_by_inode = dict(((signature.device, signature.inode), relpath)
+                             for relpath, signature in gone.items()
+                             if signature.inode is not None)
+
+        writer = self.bulk_writer = BulkWriter(
+            self.default_hash_algo, batch_size=batch_size, cache=self.dfile)
         rtn = defaultdict(list)
-        for blob_indb in db_session.query(BlobEntry).all():  # type: BlobEntry
-            for f_infs in blob_indb.get_local_files():  # type:LocalFilePathHistoryEntry
-                if not f_infs.is_valid:
-                    ## look for matching hash
-                    hash = Sha256Entry.get_hash(f_infs.get_content())
-                    hash_existing = BlobEntryHash.get(
-                        hash_algorithm_id=sha256model.id,
-                        hash_entry_id=hash.id,
-                    )
-                    blob_merge = BlobEntry.get(hash_entry_id=hash_existing.id)
-                    if blob_merge:
-                        blob_merge.tags.extend(blob_indb.tags)
-                        db_session.add(blob_merge)
-                        rtn['mov'].append((blob_indb.get_realpath(), blob_merge.get_realpath()))
-                    else:
-                        db_session.delete(blob_indb)
-                        rtn['del'].append((blob_indb.get_realpath(), None))
-
-            ## NOTE:
-            ## since we call self.reindex() above, and reindex walks the tree,
-            ## this branch is expected to never run, but we kind of like to see
-            ## rtn have DEL, MOV, and also ADD
-            # else:
-            #     if f_infs.is_match(f_indb):
-            #         continue
-            #     else:
-            #         db_session.add(f_infs)
-            #         rtn['add'].append((None, f_indb.get_realpath()))
+        moved = []
+        added = []
+
+        for relpath, (filepath, stat) in sorted(seen.items()):
+            cached = self.dfile.get(relpath)
+            if relpath not in existing:
+                if cached is not None and cached.matches(stat):
+                    ## a file that was gone is back
+                    self.stage_for_blob(filepath, stat, cached.blob_id, writer)
+                    added.append(relpath)
+                    continue
+                old = gone_by_inode.pop((stat.st_dev, stat.st_ino), None)
+                if old is not None and self.move_file(old, filepath, writer, stat=stat):
+                    del gone[old]
+                    moved.append((old, relpath))
+                    continue
+                added.append(relpath)
+            try:
+                self.add_file(filepath, tags=self.get_path_tokens(filepath), writer=writer,
+                              verbose=verbose, stat=stat)
+            except self.storage.ERRORS as e:
+                writer.fail(filepath, e)
+        writer.flush()
+        if verbose:
+            print(writer.report())
+
+        gone_by_blob = defaultdict(list)
+        for relpath, signature in sorted(gone.items()):
+            gone_by_blob[signature.blob_id].append(relpath)
+        for relpath in added:
+            signature = self.dfile.get(relpath)
+            if signature is None or signature.blob_id is None:
+                ## failed, see writer.failed
+                continue
+            lold = gone_by_blob.get(signature.blob_id)
+            if lold:
+                old = lold.pop(0)
+                del gone[old]
+                moved.append((old, relpath))
+            else:
+                rtn['add'].append((None, self.storage.join(self._BASE_DIR, relpath)))
+
+        self.mark_gone(vanished)
+        for relpath in sorted(gone):
+            rtn['del'].append((self.storage.join(self._BASE_DIR, relpath), None))
+        for old, new in sorted(moved):
+            rtn['mov'].append((self.storage.join(self._BASE_DIR, old), self.storage.join(self._BASE_DIR, new)))
+        save_posting_snapshot()
         return rtn
 
 
@@ -430,23 +3673,68 @@ if __name__ == "__main__":
 
     parser.add_argument('--basedir', nargs='?', default=".",
                         help='base directory to index and treat as root path')
+    parser.add_argument('--fs_url',
+                        help='index a PyFilesystem URL (e.g. s3://bucket, ftp://host/dir) instead of --basedir')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='number of directories to list ahead of the walk, for slow file systems')
 
     parser.add_argument('--reindex', action='store_true',
                         help='rebuild index using default "intelligent" method')
+    parser.add_argument('--resync', action='store_true',
+                        help='sync index with file tree, reporting added, deleted and moved files')
+    parser.add_argument('--scrub', nargs="?", const='-',
+                        help='re-hash indexed files against their stored hashes and write a JSON report '
+                             'of mismatched and missing files to FILE if given, else STDOUT')
+    parser.add_argument('--scrub_rate', type=float,
+                        help='cap --scrub reads at this many MB/s')
+    parser.add_argument('--older_than', type=float, metavar='DAYS',
+                        help='only --scrub files not scrubbed in this many days')
     parser.add_argument('--reindex_complete', action='store_true',
                         help='rebuild index, forcing revisit of all files in file tree')
     parser.add_argument('--reindex_from_scratch', action='store_true',
                         help='rebuild index from scratch. equivalent to deleting the index file then indexing')
+    parser.add_argument('--bulk', action='store_true',
+                        help='write new index rows in batched transactions while reindexing')
+    parser.add_argument('--batch_size', type=int, default=BulkWriter.DEFAULT_BATCH_SIZE,
+                        help='number of files per transaction in --bulk mode (default: %(default)s)')
+    parser.add_argument('--restart', action='store_true',
+                        help='start an interrupted --bulk reindex or --scrub over instead of resuming it')
+    parser.add_argument('--progress', action='store_true',
+                        help='print files and bytes done and the ETA to STDERR while reindexing or scrubbing')
+    parser.add_argument('--stats', nargs="?", const='-',
+                        help='time walking, stat, reading, hashing, tokenizing and sql, and count files, bytes '
+                             'and cache hits. printed to STDERR (with every --progress line too), or written '
+                             'as JSON to FILE if given')
+    parser.add_argument('--lazy_hash', action='store_true',
+                        help='only fully hash files that could be duplicates of another file while reindexing')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='hash files in a pool of this many workers while reindexing (implies --bulk) '
+                             'or scrubbing (default for --scrub: 4)')
+    parser.add_argument('--use_processes', action='store_true',
+                        help='use processes instead of threads for --workers')
+    parser.add_argument('--hash_algorithm', choices=sorted(HASH_ENTRY_TYPES),
+                        help='hash that identifies blobs in a new index (default: %s)' % DEFAULT_HASH_ALGORITHM)
+    parser.add_argument('--extra_hash_algorithms',
+                        help='COMMA separated hashes to compute in the same read pass while indexing, '
+                             'e.g. sha256 for integrity checks. empty to stop computing them')
 
     parser.add_argument('--tagmatchany', nargs="+",
                         help='list all entries matching any of the given tags (COMMA separated)')
     parser.add_argument('--tagmatchall', nargs="+",
                         help='list all entries matching all given tags (COMMA separated)')
+    parser.add_argument('--suggest', metavar='PREFIX',
+                        help='list the most used tags starting with PREFIX, with their file counts')
     parser.add_argument('--add', nargs="+",
                         help='dump list of all stored data in TSV compatible format to STDOUT')
+    parser.add_argument('--find_duplicates', action='store_true',
+                        help='list groups of identical files under the base directory and the bytes they waste')
     parser.add_argument('--dump', nargs="?", const='-',
                         help='dump list of all stored data in TSV compatible format to FILE if given, else STDOUT')
+    parser.add_argument('--dump_format', choices=EXPORT_FORMATS, default='tsv',
+                        help='format for --dump: tsv (default), csv or jsonl (one JSON object per line)')
 
+    parser.add_argument('--posting_index', action='store_true',
+                        help='answer tag queries from an in-memory posting index, kept in a snapshot next to the index file')
     parser.add_argument('--use_fakedb', action='store_true',
                         help='use in-memory database')
 
@@ -461,9 +3749,37 @@ if __name__ == "__main__":
         DB_PATH = ":memory:"
     else:
         DB_PATH = INDEXFILEPATH
-    init_db(DB_PATH)
+    extra_hash_algorithms = None
+    if args.extra_hash_algorithms is not None:
+        extra_hash_algorithms = [name for name in args.extra_hash_algorithms.split(',') if name]
+    init_db(DB_PATH, hash_algorithm=args.hash_algorithm, extra_hash_algorithms=extra_hash_algorithms)
+
+    if args.fs_url:
+        indexer = Indexer(storage=FSStorage(args.fs_url, prefetch=args.prefetch))
+    else:
+        indexer = Indexer(storage=LocalStorage(args.basedir, prefetch=args.prefetch))
+
+    if args.posting_index:
+        enable_posting_index(not args.use_fakedb and INDEXFILEPATH + '.postings' or None)
+
+
+    def make_progress():
+        if args.progress:
+            def report_progress(progress):
+                print(progress, file=sys.stderr)
+                if args.stats:
+                    print('  ' + stats.summary(), file=sys.stderr)
+            return ReindexProgress(report_progress)
+
+
+    def run_reindex():
+        progress = make_progress()
+        indexer.reindex(bulk=args.bulk, batch_size=args.batch_size,
+                        workers=args.workers, use_processes=args.use_processes,
+                        lazy_hash=args.lazy_hash, resume=not args.restart, progress=progress)
+        if args.bulk or args.workers:
+            print(indexer.bulk_writer.report())
 
-    indexer = Indexer(args.basedir)
 
     if not args.use_fakedb:
         if args.reindex_complete:
@@ -473,11 +3789,30 @@ if __name__ == "__main__":
             raise Exception("not completely implemented!")
         elif args.reindex:
             print('reindexing')
+            run_reindex()
 
-    if args.use_fakedb or not pexists(INDEXFILEPATH):
+    if args.use_fakedb:
         ## TODO
         ## this is redundant
-        indexer.reindex()
+        run_reindex()
+
+    if args.resync:
+        status = indexer.resync_db(batch_size=args.batch_size)
+        for kind in ('add', 'del', 'mov'):
+            for old, new in status[kind]:
+                print("%s\t%s\t%s" % (kind, old or '', new or ''))
+
+    if args.scrub:
+        report = indexer.scrub(
+            workers=args.workers or 4, bytes_per_sec=args.scrub_rate and args.scrub_rate * 1e6,
+            older_than_days=args.older_than, resume=not args.restart, batch_size=args.batch_size,
+            progress=make_progress())
+        print(report, file=sys.stderr)
+        if args.scrub == '-':
+            report.write_json(sys.stdout)
+        else:
+            with open(args.scrub, 'w') as ofile:
+                report.write_json(ofile)
 
     if args.add:
         indexer.add_file(args.add[0], tags=args.add[1:])
@@ -489,33 +3824,41 @@ if __name__ == "__main__":
 
 
     if args.tagmatchall:
-        for f in BlobEntry.findall(BlobEntry.OP_AND, proc_tag_arglist(args.tagmatchall)):
+        for f in ResultPager(BlobEntry.OP_AND, proc_tag_arglist(args.tagmatchall)):
             print(f)
 
     if args.tagmatchany:
-        for f in BlobEntry.findall(BlobEntry.OP_OR, proc_tag_arglist(args.tagmatchany)):
+        for f in ResultPager(BlobEntry.OP_OR, proc_tag_arglist(args.tagmatchany)):
             print(f)
 
+    if args.suggest:
+        for text, count in suggest_tags(args.suggest):
+            print("%s\t%s" % (text, count))
+
+    if args.find_duplicates:
+        total_reclaimable = 0
+        for group in indexer.find_duplicates():
+            print("%s\t%s\t%s copies\t%s reclaimable" % (
+                group.hash, group.size, len(group.paths), group.reclaimable))
+            for path in group.paths:
+                print("\t%s" % path)
+            total_reclaimable += group.reclaimable
+        print("%s bytes reclaimable" % total_reclaimable)
+
     if args.dump:
 
         if args.dump == '-':
             ofile = sys.stdout
         else:
-            ofile = open(args.dump, 'w')
+            ofile = open(args.dump, 'w', newline='')
 
-
-        def printrow(*ls):
-            ofile.write("\t".join(map(str, ls)) + "\n")
-
-
-        printrow("hash", "size", "time_verified", "path", "tags")
-        for blob in db_session.query(BlobEntry).all():  # type: BlobEntry
-            hash_entry = blob.hashes[0]  # type: BlobEntryHash
-            file = blob.get_local_files()[0]  # type: LocalFilePathHistoryEntry
-            printrow(hash_entry.get_hash().value,
-                     blob.size,
-                     file.time_verified,
-                     file.path, '"%s"' % (",".join(sorted(map(str, blob.tags)))))
+        export_index(ofile, args.dump_format)
 
         if args.dump != '-':
             ofile.close()
+
+    if args.stats == '-':
+        print(stats.report(), file=sys.stderr)
+    elif args.stats:
+        with open(args.stats, 'w') as ofile:
+            json.dump(stats.snapshot(), ofile, indent=2, sort_keys=True)
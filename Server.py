@@ -0,0 +1,408 @@
+"""
+answer index queries over HTTP from one long running process, so the
+database, tag indexes and recent results stay warm between queries.
+
+python Server.py --basedir /PATH/TO/YOUR/ARCHIVE/DIRECTORY
+python Server.py --client findall invoice 2019
+python Server.py --client lookup some/dir/file.pdf
+
+the server needs flask; --client only talks to a running server
+"""
+import io
+import itertools
+import json
+import os
+import sys
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+
+try:
+    import flask
+except ImportError:
+    flask = None
+
+import Indexing as IX
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8421
+
+OPERATORS = {'and': IX.BlobEntry.OP_AND, 'or': IX.BlobEntry.OP_OR}
+
+
+class QueryCache(object):
+    """
+    LRU cache of query results by request key, up to $maxsize of them.
+
+    writes to the index bump the generation, which drops everything cached
+    so far. a result computed while a write happened is not cached
+    """
+    MAXSIZE = 1000
+
+    def __init__(self, maxsize=MAXSIZE):
+        self.maxsize = maxsize
+        self.generation = 0
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def bump(self):
+        with self._lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def get(self, key, compute):
+        """
+        the cached result for $key, else the return value of $compute()
+        """
+        with self._lock:
+            generation = self.generation
+            hit = key in self.entries
+            IX.stats.cache_lookup('query_cache', hit)
+            if hit:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        value = compute()
+        with self._lock:
+            if generation == self.generation:
+                self.entries[key] = value
+                if len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+        return value
+
+
+class QueryService(object):
+    """
+    the queries the server answers, as JSON compatible values. expects
+    IX.init_db to have opened the index at $db_path.
+
+    the index file is stat'ed before each request (check_writes); if some
+    other process, e.g. a reindex or Watcher.py, wrote to it, cached results
+    and the in-process tag indexes are dropped and rebuilt on next use
+    """
+    DUMP_CHUNK_ROWS = 1000
+
+    def __init__(self, db_path, cache_size=QueryCache.MAXSIZE):
+        self.db_path = db_path
+        self.cache = QueryCache(cache_size)
+        ## tag edits are applied one at a time
+        self._write_lock = threading.Lock()
+        self.signature = self._db_signature()
+
+    def _db_signature(self):
+        ## commits append to the -wal file, and checkpoints move them into
+        ## the database file. an empty -wal file comes and goes with the
+        ## connections, so it counts as none
+        lsignature = []
+        for suffix in ('', '-wal'):
+            try:
+                stat = os.stat(self.db_path + suffix)
+            except OSError:
+                lsignature.append(None)
+                continue
+            lsignature.append(stat.st_size and (stat.st_mtime_ns, stat.st_size) or None)
+        return tuple(lsignature)
+
+    def warm(self):
+        """
+        load the in-process indexes before the first query needs them
+        """
+        IX.get_tag_search_index()
+        IX.get_tag_suggester()
+
+    def check_writes(self):
+        signature = self._db_signature()
+        if signature == self.signature:
+            return
+        with self._write_lock:
+            if signature == self.signature:
+                return
+            self.signature = signature
+            IX.Tag._cache.clear()
+            IX.tag_search_index = None
+            IX.tag_suggester = None
+            if IX.tag_posting_index is not None:
+                IX.enable_posting_index(IX.tag_posting_index.snapshot_path)
+            self.cache.bump()
+
+    def findall(self, ltoken, op='and', exclude=(), sort_key='id', descending=False,
+                limit=IX.ResultPager.PAGE_SIZE, facets=0):
+        """
+        the first $limit blobs matching the query, see IX.ResultPager, how
+        many match in total, and up to $facets co-occurring tags
+        """
+        if op not in OPERATORS:
+            raise ValueError('unknown operator %s, expected one of %s' % (op, ', '.join(sorted(OPERATORS))))
+        if sort_key not in IX.ResultPager.SORT_KEYS:
+            raise ValueError('unknown sort key %s, expected one of %s' % (
+                sort_key, ', '.join(IX.ResultPager.SORT_KEYS)))
+
+        def compute():
+            pager = IX.ResultPager(OPERATORS[op], ltoken, exclude, sort_key=sort_key, descending=descending)
+            return {
+                'count': pager.count(),
+                'rows': [row._asdict() for row in pager.fetch(limit)],
+                'facets': facets and pager.facets(facets) or [],
+            }
+
+        key = ('findall', tuple(ltoken), op, tuple(exclude), sort_key, descending, limit, facets)
+        return self.cache.get(key, compute)
+
+    def lookup(self, path=None, hash=None, algorithm=None):
+        """
+        the blob of the file at relative $path, or with the digest $hash of
+        $algorithm (default: the index's), as a dict of its id, size,
+        digests, existing paths and tags. None if there is no such blob
+        """
+        if hash is not None:
+            IX.get_hash_entry_type(algorithm)
+
+        def compute():
+            if path is not None:
+                file = IX.LocalFilePathHistoryEntry.get(path=path)
+                blob_id = file and file.blob_id
+            else:
+                blob_id = self._blob_id_for_hash(hash, algorithm)
+            return blob_id and self._describe(blob_id)
+
+        return self.cache.get(('lookup', path, hash, algorithm), compute)
+
+    @staticmethod
+    def _blob_id_for_hash(value, algorithm=None):
+        E = IX.get_hash_entry_type(algorithm)
+        H = IX.BlobEntryHash
+        return IX.db_session.query(H.blob_id).join(
+            IX.HashAlgorithm, IX.HashAlgorithm.id == H.hash_algorithm_id
+        ).join(E, E.id == H.hash_entry_id).filter(
+            IX.HashAlgorithm.name == E.NAME, E.value == value.lower()
+        ).scalar()
+
+    @staticmethod
+    def _describe(blob_id):
+        blob = IX.BlobEntry.get(id=blob_id)
+        if blob is None:
+            return None
+        return {
+            'id': blob.id,
+            'size': blob.size,
+            'hashes': IX.Indexer._stored_digests([blob.id]).get(blob.id, {}),
+            'paths': [file.path for file in blob.get_local_files()],
+            'tags': IX.BlobEntry.shared_tags([blob.id]),
+        }
+
+    def suggest(self, prefix, limit=IX.TagSuggester.DEFAULT_LIMIT):
+        return IX.suggest_tags(prefix, limit)
+
+    def edit_tags(self, lblob_id, add=(), remove=()):
+        """
+        IX.BlobEntry.bulk_tag, returning the number of added and removed
+        (blob, tag) pairs
+        """
+        with self._write_lock:
+            added, removed = IX.BlobEntry.bulk_tag(lblob_id, add, remove)
+            self.cache.bump()
+            ## our own write isn't news to check_writes
+            self.signature = self._db_signature()
+        return {'added': len(added), 'removed': len(removed)}
+
+    def dump(self, format='tsv'):
+        """
+        yield the IX.export_index text of the index in chunks of
+        DUMP_CHUNK_ROWS rows
+        """
+        if format not in IX.EXPORT_FORMATS:
+            raise ValueError('unknown dump format %s, expected one of %s' % (
+                format, ', '.join(IX.EXPORT_FORMATS)))
+        rows = IX.iter_export_rows()
+        header = True
+        while True:
+            ofile = io.StringIO()
+            nrow = IX.export_index(ofile, format, itertools.islice(rows, self.DUMP_CHUNK_ROWS), header=header)
+            if ofile.tell():
+                yield ofile.getvalue()
+            if nrow < self.DUMP_CHUNK_ROWS:
+                return
+            header = False
+
+
+def split_arg(value):
+    return [token for token in (value or '').split(',') if token]
+
+
+def make_app(service):
+    """
+    the flask app serving $service:
+
+    GET  /findall?q=TOKEN,...&op=and|or&exclude=TOKEN,...&sort=KEY&desc=1&limit=N&facets=N
+    GET  /lookup?path=RELPATH or /lookup?hash=HEX&algorithm=NAME
+    GET  /suggest?prefix=PREFIX&limit=N
+    POST /tags with JSON {"blobs": [ID, ...], "add": [TAG, ...], "remove": [TAG, ...]}
+    GET  /dump?format=tsv|csv|jsonl
+    """
+    if flask is None:
+        raise ImportError('the server needs the flask package')
+    app = flask.Flask(__name__)
+
+    @app.before_request
+    def check_writes():
+        service.check_writes()
+
+    @app.teardown_request
+    def release_connection(exc):
+        ## back to the pool for the next request thread
+        IX.db_session.remove()
+
+    @app.errorhandler(ValueError)
+    def bad_request(e):
+        return flask.jsonify(error=str(e)), 400
+
+    @app.route('/findall')
+    def findall():
+        args = flask.request.args
+        return flask.jsonify(service.findall(
+            split_arg(args.get('q')), op=args.get('op', 'and'), exclude=split_arg(args.get('exclude')),
+            sort_key=args.get('sort', 'id'), descending=args.get('desc') == '1',
+            limit=args.get('limit', IX.ResultPager.PAGE_SIZE, type=int),
+            facets=args.get('facets', 0, type=int)))
+
+    @app.route('/lookup')
+    def lookup():
+        args = flask.request.args
+        if not args.get('path') and not args.get('hash'):
+            raise ValueError('lookup needs a path or a hash')
+        blob = service.lookup(path=args.get('path'), hash=args.get('hash'), algorithm=args.get('algorithm'))
+        if blob is None:
+            return flask.jsonify(error='not found'), 404
+        return flask.jsonify(blob)
+
+    @app.route('/suggest')
+    def suggest():
+        args = flask.request.args
+        return flask.jsonify(service.suggest(
+            args.get('prefix', ''), args.get('limit', IX.TagSuggester.DEFAULT_LIMIT, type=int)))
+
+    @app.route('/tags', methods=['POST'])
+    def edit_tags():
+        ## only JSON: a page in the user's browser can post a form or
+        ## text/plain here cross-origin without a CORS preflight, but not that
+        if not flask.request.is_json:
+            return flask.jsonify(error='expected an application/json body'), 415
+        body = flask.request.get_json()
+        if not isinstance(body, dict):
+            raise ValueError('expected a JSON object')
+        return flask.jsonify(service.edit_tags(
+            [int(blob_id) for blob_id in body.get('blobs', [])], body.get('add', []), body.get('remove', [])))
+
+    @app.route('/dump')
+    def dump():
+        format = flask.request.args.get('format', 'tsv')
+        chunks = service.dump(format)
+        ## raise a bad format before the response starts
+        first = next(chunks, '')
+        return flask.Response(flask.stream_with_context(itertools.chain([first], chunks)),
+                              mimetype=format == 'jsonl' and 'application/x-ndjson' or 'text/plain')
+
+    return app
+
+
+class Client(object):
+    """
+    calls a running server at $url
+    """
+
+    def __init__(self, url='http://%s:%d' % (DEFAULT_HOST, DEFAULT_PORT)):
+        self.url = url.rstrip('/')
+
+    def request(self, path, params=None, body=None):
+        url = self.url + path
+        if params:
+            url += '?' + urllib.parse.urlencode(params)
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+        req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
+        return urllib.request.urlopen(req)
+
+    def get_json(self, path, params=None, body=None):
+        with self.request(path, params, body) as response:
+            return json.load(response)
+
+    def findall(self, ltoken, op='and', **params):
+        params.update(q=','.join(ltoken), op=op)
+        return self.get_json('/findall', params)
+
+    def lookup(self, path=None, hash=None):
+        return self.get_json('/lookup', path is not None and {'path': path} or {'hash': hash})
+
+    def suggest(self, prefix):
+        return self.get_json('/suggest', {'prefix': prefix})
+
+    def edit_tags(self, lblob_id, add=(), remove=()):
+        return self.get_json('/tags', body={'blobs': list(lblob_id), 'add': list(add), 'remove': list(remove)})
+
+    def dump(self, ofile, format='tsv'):
+        with self.request('/dump', {'format': format}) as response:
+            for line in response:
+                ofile.write(line.decode('utf-8'))
+
+
+def run_client(client, command, largs):
+    if command in ('findall', 'findany'):
+        result = client.findall(largs, op=command == 'findany' and 'or' or 'and')
+        for row in result['rows']:
+            print("%s\t%s\t%s" % (row['id'], row['path'] or '', ",".join(row['taglist'])))
+        print("%d matching" % result['count'], file=sys.stderr)
+    elif command == 'lookup':
+        print(json.dumps(client.lookup(path=largs[0]), indent=2))
+    elif command == 'lookup_hash':
+        print(json.dumps(client.lookup(hash=largs[0]), indent=2))
+    elif command == 'suggest':
+        for text, count in client.suggest(largs[0]):
+            print("%s\t%s" % (text, count))
+    elif command == 'tag':
+        lblob_id = [int(blob_id) for blob_id in largs[0].split(',')]
+        add = [arg[1:] for arg in largs[1:] if arg.startswith('+')]
+        remove = [arg[1:] for arg in largs[1:] if arg.startswith('-')]
+        print(json.dumps(client.edit_tags(lblob_id, add, remove)))
+    elif command == 'dump':
+        client.dump(sys.stdout, largs and largs[0] or 'tsv')
+    else:
+        raise ValueError('unknown command %s' % command)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--basedir', default=os.getcwd())
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--workers', type=int, default=4,
+                        help='database connections shared by the request threads')
+    parser.add_argument('--cache_size', type=int, default=QueryCache.MAXSIZE,
+                        help='query results kept in the LRU cache')
+    parser.add_argument('--posting_index', action='store_true',
+                        help='answer tag queries from an in-memory posting index, see Indexing.py')
+    parser.add_argument('--client', nargs='+', metavar='ARG',
+                        help='call a running server instead: findall TOKEN..., findany TOKEN..., '
+                             'lookup RELPATH, lookup_hash HEX, suggest PREFIX, '
+                             'tag ID,ID... +ADD -REMOVE..., dump [tsv|csv|jsonl]')
+    args = parser.parse_args()
+
+    if args.client:
+        try:
+            run_client(Client('http://%s:%d' % (args.host, args.port)), args.client[0], args.client[1:])
+        except urllib.error.HTTPError as e:
+            print('%s: %s' % (e.code, e.read().decode('utf-8')), file=sys.stderr)
+            sys.exit(1)
+        sys.exit(0)
+
+    INDEXFILEPATH = "_index.db"
+    IX.LocalFilePathHistoryEntry.RELATIVE_BASE_DIR = args.basedir
+    IX.init_db(INDEXFILEPATH, pool_size=args.workers)
+    if args.posting_index:
+        IX.enable_posting_index(INDEXFILEPATH + '.postings')
+    service = QueryService(INDEXFILEPATH, cache_size=args.cache_size)
+    service.warm()
+    make_app(service).run(host=args.host, port=args.port, threaded=True)
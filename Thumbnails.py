@@ -0,0 +1,251 @@
+"""
+thumbnails of indexed images, rendered in the background and cached on
+disk by content hash, so renamed and duplicated files share one.
+
+files are read through an Indexing.Storage, the local file system by
+default. rendering uses Pillow if it is installed; the GUI passes a Qt
+renderer
+"""
+import io
+import os
+import threading
+from collections import OrderedDict, deque
+from os.path import join as pjoin, splitext as psplitext
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+import Indexing as IX
+
+THUMBNAIL_SIZE = 96
+## what reading or decoding a file that isn't a usable image raises;
+## PIL's UnidentifiedImageError is an OSError
+RENDER_ERRORS = (IOError, OSError, ValueError, SyntaxError)
+IMAGE_EXTENSIONS = frozenset(('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.webp'))
+
+
+def is_image(path):
+    return psplitext(path)[1].lower() in IMAGE_EXTENSIONS
+
+
+def render_thumbnail(ifile, size=THUMBNAIL_SIZE):
+    """
+    PNG bytes of the image read from the binary file $ifile, scaled to fit
+    $size x $size pixels
+    """
+    if Image is None:
+        raise ImportError('rendering thumbnails needs the Pillow package, or a render function')
+    with Image.open(ifile) as image:
+        image.thumbnail((size, size))
+        if image.mode not in ('RGB', 'RGBA', 'L'):
+            image = image.convert('RGBA')
+        ofile = io.BytesIO()
+        image.save(ofile, 'PNG')
+    return ofile.getvalue()
+
+
+class ThumbnailCache(object):
+    """
+    thumbnail files under $cache_dir, by key. their total size is kept
+    under $max_bytes by deleting the least recently used ones.
+
+    recency is the file's mtime, which get() touches, so it carries over
+    to the next process using the cache
+    """
+    MAX_BYTES = 256 << 20
+
+    def __init__(self, cache_dir, max_bytes=MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        ## key -> size in bytes, least recently used first
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        lentry = []
+        for name in os.listdir(cache_dir):
+            if not name.endswith('.png'):
+                continue
+            stat = os.stat(pjoin(cache_dir, name))
+            lentry.append((stat.st_mtime_ns, name[:-len('.png')], stat.st_size))
+        for _, key, size in sorted(lentry):
+            self.entries[key] = size
+            self.total_bytes += size
+
+    def path_for(self, key):
+        return pjoin(self.cache_dir, key + '.png')
+
+    def get(self, key):
+        """
+        the path of the thumbnail for $key, or None if it isn't cached
+        """
+        with self._lock:
+            if key not in self.entries:
+                IX.stats.cache_lookup('thumbnail', False)
+                return None
+            IX.stats.cache_lookup('thumbnail', True)
+            self.entries.move_to_end(key)
+        path = self.path_for(key)
+        try:
+            os.utime(path)
+        except OSError:
+            ## deleted behind our back
+            with self._lock:
+                self.total_bytes -= self.entries.pop(key, 0)
+            return None
+        return path
+
+    def put(self, key, data):
+        """
+        store the PNG bytes $data as the thumbnail for $key and return its path
+        """
+        path = self.path_for(key)
+        tmppath = '%s.%d.tmp' % (path, threading.get_ident())
+        with open(tmppath, 'wb') as ofile:
+            ofile.write(data)
+        os.replace(tmppath, path)
+        with self._lock:
+            self.total_bytes += len(data) - self.entries.pop(key, 0)
+            self.entries[key] = len(data)
+            self._evict()
+        return path
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.unlink(self.path_for(key))
+            except OSError:
+                pass
+
+
+class Thumbnailer(object):
+    """
+    renders thumbnails for blobs on $workers background threads and keeps
+    them in the ThumbnailCache $cache, keyed by the blob's hash and $size.
+
+    request() returns at once. requests are served newest first, since the
+    rows the user is looking at were asked for last, and cancel_pending()
+    drops the ones not started yet, e.g. when the results change.
+
+    files are read through $storage, an Indexing.Storage, by default the
+    local file system. $render(ifile, size) returns PNG bytes, see
+    render_thumbnail. files that aren't images, or that fail to render
+    with one of RENDER_ERRORS, get no thumbnail; other errors, e.g. the
+    database being locked, only fail the request at hand
+
+    the workers don't write to the index: the digests they compute for
+    blobs indexed without one wait in self.new_hashes for save_hashes()
+    """
+
+    def __init__(self, cache, render=render_thumbnail, size=THUMBNAIL_SIZE, workers=2, storage=None):
+        if render is render_thumbnail and Image is None:
+            raise ImportError('rendering thumbnails needs the Pillow package, or a render function')
+        self.cache = cache
+        self.render = render
+        self.size = size
+        self.storage = storage or IX.LocalStorage()
+        ## (blob_id, filepath, callback)
+        self.pending = deque()
+        ## blob ids queued or being rendered
+        self.queued = set()
+        self.failed = set()
+        ## (blob_id, algorithm, hexdigest)
+        self.new_hashes = deque()
+        self._cond = threading.Condition()
+        self._stop = False
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def key_for(self, algorithm, value):
+        return '%s-%s-%d' % (algorithm, value, self.size)
+
+    def request(self, blob_id, filepath, callback):
+        """
+        call $callback(blob_id, thumbnail path or None) from a worker thread
+        once the thumbnail of blob $blob_id, read from $filepath in
+        self.storage if it has to be rendered, is ready
+        """
+        if not is_image(filepath) or blob_id in self.failed:
+            return
+        with self._cond:
+            if blob_id in self.queued:
+                return
+            self.queued.add(blob_id)
+            self.pending.append((blob_id, filepath, callback))
+            self._cond.notify()
+
+    def cancel_pending(self):
+        with self._cond:
+            for blob_id, _, _ in self.pending:
+                self.queued.discard(blob_id)
+            self.pending.clear()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self.pending and not self._stop:
+                    self._cond.wait()
+                if self._stop:
+                    return
+                blob_id, filepath, callback = self.pending.pop()
+            try:
+                path = self.thumbnail(blob_id, filepath)
+            except Exception:
+                ## may work when asked again
+                path = None
+            finally:
+                IX.db_session.remove()
+                with self._cond:
+                    self.queued.discard(blob_id)
+            callback(blob_id, path)
+
+    def thumbnail(self, blob_id, filepath):
+        """
+        the path of blob $blob_id's thumbnail, rendering it from $filepath
+        if it isn't cached. None if it can't be rendered
+        """
+        algorithm = IX.index_hash_algorithm
+        hash_entry = IX.BlobEntry.get(id=blob_id).get_hash(algorithm)
+        try:
+            if hash_entry is not None:
+                value = hash_entry.value
+            else:
+                ## indexed without a hash, see save_hashes
+                value, _ = self.storage.hash_file(filepath, algorithm=algorithm)
+                self.new_hashes.append((blob_id, algorithm, value))
+            key = self.key_for(algorithm, value)
+            path = self.cache.get(key)
+            if path is None:
+                with IX.stats.phase('thumbnail'), self.storage.open(filepath) as ifile:
+                    path = self.cache.put(key, self.render(ifile, self.size))
+            return path
+        except RENDER_ERRORS:
+            ## unreadable or not really an image; don't retry it
+            self.failed.add(blob_id)
+            return None
+
+    def save_hashes(self):
+        """
+        link the digests the workers computed to their blobs. call it from
+        the thread that writes to the index
+        """
+        while self.new_hashes:
+            blob_id, algorithm, value = self.new_hashes[0]
+            blob = IX.BlobEntry.get(id=blob_id)
+            if blob is not None:
+                blob.set_hash(algorithm, value)
+            ## only once it is written, so a failed write is tried again
+            self.new_hashes.popleft()
+
+    def close(self):
+        with self._cond:
+            self._stop = True
+            self.pending.clear()
+            self._cond.notify_all()
+        for thread in self.threads:
+            thread.join()
@@ -0,0 +1,340 @@
+"""
+keep an index current from Linux inotify events instead of full rescans.
+
+python Watcher.py --basedir /PATH/TO/YOUR/ARCHIVE/DIRECTORY
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import stat as pstat
+import struct
+import threading
+import time
+from os.path import join as pjoin
+
+import Indexing as IX
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE \
+    | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+
+_EVENT = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """
+    minimal ctypes binding of inotify(7)
+    """
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+
+    def _raise(self, path=None):
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno), path)
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            self._raise(path)
+        return wd
+
+    def rm_watch(self, wd):
+        ## fails harmlessly if the kernel already dropped the watch
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        """
+        wait up to $timeout seconds for events, and return them as a list
+        of (wd, mask, cookie, name)
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        levent = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            levent.append((wd, mask, cookie, os.fsdecode(name)))
+        return levent
+
+    def close(self):
+        os.close(self.fd)
+
+
+class IndexWatcher(object):
+    """
+    applies file system changes under the Indexer's base directory to the
+    index as they happen.
+
+    events are collected until none arrived for $quiet_period seconds (or
+    $max_delay seconds after the first one), so a burst of writes to a file
+    is indexed once. each burst is then applied in one go:
+
+    - created or changed files go through Indexer.add_file on a BulkWriter,
+      which skips files whose stat still matches their FileSignature, and
+      binds files moved out of the tree and back to their old blob
+    - moved files are bound to their old blob by Indexer.move_file without
+      being read, if their stat still matches
+    - deleted and moved away paths are marked gone by Indexer.mark_gone
+
+    if the kernel drops events (IN_Q_OVERFLOW), and every
+    $reconcile_interval seconds regardless, Indexer.resync_db catches up
+    with whatever the events missed
+
+    paths in $ignore, e.g. the index database and its journal, are not
+    indexed
+    """
+
+    QUIET_PERIOD = 0.5
+    MAX_DELAY = 5.0
+    RECONCILE_INTERVAL = 3600.0
+
+    UPDATE = 'update'
+    GONE = 'gone'
+
+    def __init__(self, indexer, quiet_period=QUIET_PERIOD, max_delay=MAX_DELAY,
+                 reconcile_interval=RECONCILE_INTERVAL, ignore=(), verbose=False):
+        self.indexer = indexer
+        self.base_dir = os.path.abspath(indexer._BASE_DIR)
+        self.quiet_period = quiet_period
+        self.max_delay = max_delay
+        self.reconcile_interval = reconcile_interval
+        self.ignore = set(os.path.abspath(path) for path in ignore)
+        self.verbose = verbose
+
+        self.inotify = Inotify()
+        self._stop = threading.Event()
+        ## wd -> directory path
+        self.dwatch = {}
+        ## path -> (UPDATE or GONE, path it was moved from or None)
+        self.pending = {}
+        ## cookie -> path, for IN_MOVED_FROM waiting for its IN_MOVED_TO
+        self.moved_from = {}
+        self.needs_reconcile = False
+
+    def watch_tree(self, dirpath):
+        """
+        watch $dirpath and every directory below it. returns the files found
+        """
+        lfile = []
+        for root, ldir, lname in os.walk(dirpath):
+            try:
+                self.dwatch[self.inotify.add_watch(root)] = root
+            except OSError:
+                ldir[:] = []
+                continue
+            lfile.extend(pjoin(root, name) for name in lname)
+        return lfile
+
+    def _relpath(self, path):
+        return IX.LocalFilePathHistoryEntry.get_relpath(path)
+
+    def _known_under(self, dirpath):
+        prefix = self._relpath(dirpath) + os.sep
+        return [relpath for relpath in self.indexer.dfile if relpath.startswith(prefix)]
+
+    def _forget_watches(self, dirpath):
+        prefix = dirpath + os.sep
+        for wd, path in list(self.dwatch.items()):
+            if path == dirpath or path.startswith(prefix):
+                self.inotify.rm_watch(wd)
+                del self.dwatch[wd]
+
+    def _rename_watches(self, old, new):
+        prefix = old + os.sep
+        for wd, path in list(self.dwatch.items()):
+            if path == old:
+                self.dwatch[wd] = new
+            elif path.startswith(prefix):
+                self.dwatch[wd] = new + path[len(old):]
+
+    def _gone(self, path, isdir):
+        if isdir:
+            self._forget_watches(path)
+            for relpath in self._known_under(path):
+                self.pending[pjoin(self.base_dir, relpath)] = (self.GONE, None)
+        else:
+            self.pending[path] = (self.GONE, None)
+
+    def _created(self, path, isdir):
+        if isdir:
+            ## files can land in it before the watch is in place
+            for filepath in self.watch_tree(path):
+                self.pending[filepath] = (self.UPDATE, None)
+        else:
+            self.pending[path] = (self.UPDATE, None)
+
+    def _moved(self, old, new, isdir):
+        if isdir:
+            self._rename_watches(old, new)
+            prefix = old + os.sep
+            for path in [path for path in self.pending if path.startswith(prefix)]:
+                self.pending[new + path[len(old):]] = self.pending.pop(path)
+            for relpath in self._known_under(old):
+                oldpath = pjoin(self.base_dir, relpath)
+                self.pending[new + oldpath[len(old):]] = (self.UPDATE, oldpath)
+                self.pending.setdefault(oldpath, (self.GONE, None))
+        else:
+            ## a file moved again within the burst keeps its first origin
+            _, origin = self.pending.get(old, (None, None))
+            self.pending[new] = (self.UPDATE, origin or old)
+            self.pending.setdefault(old, (self.GONE, None))
+
+    def handle(self, levent):
+        for wd, mask, cookie, name in levent:
+            if mask & IN_Q_OVERFLOW:
+                self.needs_reconcile = True
+                continue
+            if mask & IN_IGNORED:
+                self.dwatch.pop(wd, None)
+                continue
+            dirpath = self.dwatch.get(wd)
+            if dirpath is None or not name:
+                ## IN_DELETE_SELF; the parent reports the deletion
+                continue
+            path = pjoin(dirpath, name)
+            isdir = bool(mask & IN_ISDIR)
+            if mask & IN_MOVED_FROM:
+                self.moved_from[cookie] = (path, isdir)
+            elif mask & IN_MOVED_TO:
+                if cookie in self.moved_from:
+                    old, _ = self.moved_from.pop(cookie)
+                    self._moved(old, path, isdir)
+                else:
+                    self._created(path, isdir)
+            elif mask & IN_DELETE:
+                self._gone(path, isdir)
+            elif mask & (IN_CREATE | IN_CLOSE_WRITE | IN_ATTRIB):
+                self._created(path, isdir)
+
+    def flush(self):
+        """
+        apply the pending changes to the index
+        """
+        ## a move without a counterpart went in or out of the tree
+        for path, isdir in self.moved_from.values():
+            self._gone(path, isdir)
+        self.moved_from = {}
+        pending, self.pending = self.pending, {}
+
+        writer = IX.BulkWriter(self.indexer.default_hash_algo, cache=self.indexer.dfile)
+        lgone = []
+        for path, (_, old) in sorted(pending.items()):
+            if path in self.ignore:
+                continue
+            relpath = self._relpath(path)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            if stat is None or not pstat.S_ISREG(stat.st_mode):
+                if relpath in self.indexer.dfile:
+                    lgone.append(relpath)
+                continue
+            try:
+                if old is not None and self.indexer.move_file(self._relpath(old), path, writer, stat=stat):
+                    continue
+                self.indexer.add_file(path, tags=self.indexer.get_path_tokens(path),
+                                      writer=writer, stat=stat, verbose=self.verbose)
+            except (IOError, OSError) as e:
+                writer.fail(path, e)
+        writer.flush()
+        self.indexer.mark_gone(lgone)
+        if self.verbose:
+            print('%s, %d gone' % (writer.report(), len(lgone)))
+
+    def reconcile(self):
+        self.needs_reconcile = False
+        self.watch_tree(self.base_dir)
+        status = self.indexer.resync_db()
+        if self.verbose:
+            print('reconciled: %d added, %d deleted, %d moved' % (
+                len(status['add']), len(status['del']), len(status['mov'])))
+
+    def run(self, reconcile_first=True):
+        """
+        watch until stop() is called
+        """
+        self.watch_tree(self.base_dir)
+        if reconcile_first:
+            self.reconcile()
+        last_reconcile = time.time()
+        first_event = last_event = None
+        try:
+            while not self._stop.is_set():
+                levent = self.inotify.read(timeout=self.quiet_period)
+                now = time.time()
+                if levent:
+                    self.handle(levent)
+                    last_event = now
+                    first_event = first_event or now
+                if first_event is not None and (
+                        now - last_event >= self.quiet_period or now - first_event >= self.max_delay):
+                    self.flush()
+                    first_event = last_event = None
+                if self.needs_reconcile or now - last_reconcile >= self.reconcile_interval:
+                    ## whatever is pending is part of what resync_db finds
+                    self.pending = {}
+                    self.moved_from = {}
+                    first_event = last_event = None
+                    self.reconcile()
+                    last_reconcile = time.time()
+        finally:
+            if self.pending or self.moved_from:
+                self.flush()
+            IX.save_posting_snapshot()
+
+    def stop(self):
+        self._stop.set()
+
+    def close(self):
+        self.inotify.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--basedir', default=os.getcwd())
+    parser.add_argument('--reconcile_interval', type=float, default=IndexWatcher.RECONCILE_INTERVAL,
+                        help='seconds between full resyncs that catch events inotify missed')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    INDEXFILEPATH = "_index.db"
+    IX.init_db(INDEXFILEPATH)
+    indexer = IX.Indexer(args.basedir)
+    watcher = IndexWatcher(
+        indexer, reconcile_interval=args.reconcile_interval, verbose=args.verbose,
+        ignore=[INDEXFILEPATH + suffix for suffix in ('', '-journal', '-wal', '-shm', '.postings')])
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
@@ -1,13 +1,14 @@
-import sys, platform, os
-import hashlib
-import operator
+import sys, platform, os, threading, time
 
 from PyQt4.QtGui import QApplication
 from PyQt4.QtCore import QDir, Qt
 from PyQt4.Qt import QVariant, QAbstractTableModel
 from PyQt4 import QtCore, QtGui
 
+import sqlalchemy as sqla
+
 import Indexing as IX
+import Thumbnails
 
 PLATFORM_NAME = platform.system()
 if PLATFORM_NAME == "Windows":
@@ -21,35 +22,306 @@ else:
     print("cannot detect platform. open operation will not be supported")
     OPEN_CMD = None
 
-class InstantSearchLineEdit(QtGui.QLineEdit):
-
-    def __init__(self, parent, target_table):
+def is_refinement(ltoken_old, ltoken_new):
+    ## anything matching all of ltoken_new also matches all of ltoken_old
+    ## when every old token is part of some new token, e.g. "inv" -> "invo"
+    return all(any(old in new for new in ltoken_new) for old in ltoken_old)
+
+class SearchWorker(QtCore.QObject):
+    """
+    runs searches on its own thread (and so its own IX.db_session).
+
+    every request carries a generation number; the controller bumps
+    self.latest on each keystroke, and any request that is no longer the
+    latest is dropped. a search only fetches the first page of its
+    IX.ResultPager, the table model fetches the rest as it is scrolled to.
+    the pager's facets aggregate over every match, so they are computed
+    after the first page went out, and sent on their own
+    """
+    resultsReady = QtCore.pyqtSignal(int, object, object)
+    ## generation, list of (tag text, count)
+    facetsReady = QtCore.pyqtSignal(int, object)
+
+    def __init__(self):
+        super(SearchWorker, self).__init__()
+        self.latest = 0
+
+    def isStale(self, generation):
+        return generation != self.latest
+
+    @QtCore.pyqtSlot(int, object, object)
+    def search(self, generation, ltoken, options):
+        if self.isStale(generation):
+            return
+        try:
+            pager = IX.ResultPager(IX.BlobEntry.OP_AND, ltoken, **options)
+            rows = pager.fetch()
+            if self.isStale(generation):
+                return
+            self.resultsReady.emit(generation, pager, rows)
+            facets = pager.facets()
+        finally:
+            ## don't hold on to a connection between searches
+            IX.db_session.remove()
+        if not self.isStale(generation):
+            self.facetsReady.emit(generation, facets)
+
+class SearchController(QtCore.QObject):
+    """
+    debounces the search box and runs its queries on a SearchWorker thread,
+    so typing never waits on the database
+    """
+    DEBOUNCE_MS = 150
+
+    requestSearch = QtCore.pyqtSignal(int, object, object)
+    ## list of (tag text, count) for the shown results
+    facetsReady = QtCore.pyqtSignal(object)
+
+    def __init__(self, line_edit, target_table):
+        super(SearchController, self).__init__(line_edit)
+        self.lineEdit = line_edit
         self.table = target_table
         self.model = target_table.model()
-        super(QtGui.QLineEdit, self).__init__(parent)
+        self.generation = 0
+        self.pendingTokens = None
+        self.lastTokens = None
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(self.DEBOUNCE_MS)
+        self.timer.timeout.connect(self.startSearch)
+
+        self.thread = QtCore.QThread(self)
+        self.worker = SearchWorker()
+        self.worker.moveToThread(self.thread)
+        self.requestSearch.connect(self.worker.search)
+        self.worker.resultsReady.connect(self.showResults)
+        self.worker.facetsReady.connect(self.showFacets)
+        self.thread.start()
+        QtGui.QApplication.instance().aboutToQuit.connect(self.shutdown)
+
+        line_edit.textChanged.connect(self.scheduleSearch)
+
+    def scheduleSearch(self, *argv):
+        self.generation += 1
+        ## anything queued or running is stale from here on
+        self.worker.latest = self.generation
+        self.timer.start()
+
+    def startSearch(self):
+        ltoken = [token for token in str(self.lineEdit.displayText()).split() if len(token) > 1]
+        if not ltoken:
+            return
+        sort_key, descending = self.model.sortOrder
+        options = dict(sort_key=sort_key, descending=descending)
+        if self.lastTokens is not None and is_refinement(self.lastTokens, ltoken) \
+                and not self.model.canFetchMore():
+            ## narrowing a fully loaded result: only its ids need checking
+            options['within'] = [row.id for row in self.model.ls_data]
+        self.pendingTokens = ltoken
+        self.requestSearch.emit(self.generation, ltoken, options)
+
+    def showResults(self, generation, pager, rows):
+        if generation != self.generation:
+            return
+        self.lastTokens = self.pendingTokens
+        self.model.setResults(pager, rows)
 
-    def keyPressEvent(self, event):
-        QtGui.QLineEdit.keyPressEvent(self, event)
+    def showFacets(self, generation, facets):
+        if generation != self.generation:
+            return
+        self.facetsReady.emit(facets)
 
-        ## to address strange behavior (bug?)
-        ## http://stackoverflow.com/questions/3498829/how-to-get-this-qtablewidget-to-display-items
-        self.table.setSortingEnabled(False)
-        ltoken = filter(lambda token: len(token)>1, str(self.displayText()).split())
-        if not ltoken: return
+    def refresh(self):
+        ## the index changed: run the search again in full, since the new
+        ## matches aren't among the ids a refinement would narrow down
+        if self.lastTokens is None:
+            return
+        self.lastTokens = None
+        self.scheduleSearch()
+
+    def shutdown(self):
+        self.worker.latest = -1
+        self.thread.quit()
+        self.thread.wait()
+
+class ReindexWorker(QtCore.QObject):
+    """
+    loads the posting index and reindexes $base_dir on a thread of its own,
+    so the window opens at once against the index as it is. the GUI's own
+    writes wait on IX.write_lock for the batch being written, if any.
+
+    stop() cancels the reindex at the next file walked. the thread is a
+    daemon, and either way the bulk reindex's checkpoint lets the next
+    start continue where this one stopped
+    """
+    progressed = QtCore.pyqtSignal(object)
+    finished = QtCore.pyqtSignal(object)
+
+    def __init__(self, base_dir, posting_snapshot=None):
+        super(ReindexWorker, self).__init__()
+        self.base_dir = base_dir
+        self.posting_snapshot = posting_snapshot
+        self.progress = IX.ReindexProgress(self.progressed.emit, interval=0.5)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        result = None
+        try:
+            if self.posting_snapshot:
+                IX.enable_posting_index(self.posting_snapshot)
+            indexer = IX.Indexer(self.base_dir)
+            indexer.reindex(bulk=True, progress=self.progress)
+            result = indexer.bulk_writer.report()
+        except IX.ReindexCancelled:
+            return
+        except Exception as e:
+            result = "reindex failed: %s" % e
+        finally:
+            IX.db_session.remove()
+        self.finished.emit(result)
+
+    def stop(self, timeout=2.0):
+        self.progress.cancel()
+        self.thread.join(timeout)
+
+class TagCompleter(QtGui.QCompleter):
+    """
+    pops up IX.suggest_tags completions for the tag being typed in a
+    QLineEdit or QPlainTextEdit. the text is split into tags on $separator,
+    only the last one is completed, and tags already typed aren't suggested
+    """
+
+    def __init__(self, widget, separator):
+        super(TagCompleter, self).__init__(widget)
+        self.separator = separator
+        self.isPlainText = isinstance(widget, QtGui.QPlainTextEdit)
+        self.inserting = False
+        self.listModel = QtGui.QStringListModel(self)
+        self.setModel(self.listModel)
+        self.setWidget(widget)
+        self.setCompletionMode(QtGui.QCompleter.UnfilteredPopupCompletion)
+        self.activated[str].connect(self.insertCompletion)
+        if self.isPlainText:
+            widget.textChanged.connect(self.updateSuggestions)
+        else:
+            widget.textEdited.connect(self.updateSuggestions)
+
+    def text(self):
+        if self.isPlainText:
+            return str(self.widget().toPlainText())
+        return str(self.widget().text())
+
+    def setText(self, text):
+        self.inserting = True
+        try:
+            if self.isPlainText:
+                self.widget().setPlainText(text)
+                self.widget().moveCursor(QtGui.QTextCursor.End)
+            else:
+                self.widget().setText(text)
+        finally:
+            self.inserting = False
+
+    def splitText(self):
+        head, _, last = self.text().rpartition(self.separator)
+        return head.rstrip(), last.strip()
+
+    def updateSuggestions(self, *argv):
+        ## setPlainText on selection changes isn't typing
+        if self.inserting or not self.widget().hasFocus():
+            return
+        head, token = self.splitText()
+        lsuggestion = []
+        if token:
+            ltyped = [text.strip() for text in head.lower().split(self.separator)]
+            lsuggestion = IX.suggest_tags(token, exclude=ltyped)
+        self.listModel.setStringList([text for text, _ in lsuggestion])
+        if lsuggestion:
+            self.complete()
+        else:
+            self.popup().hide()
 
-        lres = IX.BlobEntry.findall(IX.BlobEntry.OP_AND, ltoken)
-        self.model.ls_data = lres
+    def insertCompletion(self, text):
+        head, _ = self.splitText()
+        joiner = self.separator.strip() + " "
+        self.setText(head and head + joiner + text or text)
 
-        self.table.setSortingEnabled(True)
+class InstantSearchLineEdit(QtGui.QLineEdit):
+
+    def __init__(self, parent, target_table):
+        self.table = target_table
+        self.model = target_table.model()
+        super(QtGui.QLineEdit, self).__init__(parent)
+        self.controller = SearchController(self, target_table)
+
+def render_qt_thumbnail(ifile, size):
+    ## QImage, unlike QPixmap, can be used off the GUI thread
+    image = QtGui.QImage.fromData(ifile.read())
+    if image.isNull():
+        raise IOError("cannot read image %s" % getattr(ifile, "name", ifile))
+    image = image.scaled(size, size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+    data = QtCore.QByteArray()
+    buf = QtCore.QBuffer(data)
+    buf.open(QtCore.QIODevice.WriteOnly)
+    image.save(buf, "PNG")
+    buf.close()
+    return bytes(data)
 
 class MyTableModel(QAbstractTableModel):
-    _headerkey = ("taglist", "path")
+    """
+    shows an IX.ResultPager's rows. only the rows scrolled into view are
+    fetched (canFetchMore / fetchMore), and sorting re-queries the pager
+    in the new order instead of sorting in memory
+
+    image files get a thumbnail from $thumbnailer, a Thumbnails.Thumbnailer,
+    when their row is first drawn; a placeholder shows until it is ready
+    """
+    _headerkey = ("tags", "path")
     _headertext = ("tags", "file")
 
-    def __init__(self, parent=None):
+    thumbnailReady = QtCore.pyqtSignal(int, object)
+
+    def __init__(self, parent=None, thumbnailer=None):
         QAbstractTableModel.__init__(self, parent)
         self.ls_data = []
-            
+        self.pager = None
+        ## (IX.ResultPager sort key, descending)
+        self.sortOrder = ("id", False)
+        self.thumbnailer = thumbnailer
+        ## blob id -> QPixmap, None while rendering, False if there is none
+        self.thumbnails = {}
+        self.placeholder = None
+        ## emitted from the thumbnailer's threads, handled on this one
+        self.thumbnailReady.connect(self.showThumbnail)
+
+    def setResults(self, pager, rows):
+        if (pager.sort_key, pager.descending) != self.sortOrder:
+            ## the sort order changed while the search was running
+            pager = pager.reordered(*self.sortOrder)
+            rows = pager.fetch()
+        if self.thumbnailer is not None:
+            self.thumbnailer.cancel_pending()
+        self.beginResetModel()
+        self.pager = pager
+        self.ls_data = rows
+        self.thumbnails = {}
+        self.endResetModel()
+
+    def canFetchMore(self, parent=QtCore.QModelIndex()):
+        return self.pager is not None and not self.pager.exhausted
+
+    def fetchMore(self, parent=QtCore.QModelIndex()):
+        rows = self.pager.fetch()
+        if not rows:
+            return
+        self.beginInsertRows(QtCore.QModelIndex(), len(self.ls_data), len(self.ls_data) + len(rows) - 1)
+        self.ls_data.extend(rows)
+        self.endInsertRows()
+
     def rowCount(self, *argv):
         return len(self.ls_data)
 
@@ -64,22 +336,57 @@ class MyTableModel(QAbstractTableModel):
         # returning QVariant() makes the edit box blank
         # adding the editrole drops to the last line
         # returning edit box with its current contents
+        elif role == Qt.DecorationRole and index.column() == 1:
+            return self.thumbnail(self.ls_data[index.row()])
         elif role != Qt.DisplayRole and role != Qt.EditRole:
             return QVariant()
         icol = index.column()
         fobj = self.ls_data[index.row()]
         if icol == 0:
-            return " ".join([str(t.text) for t in fobj.taglist[:3]])
+            return " ".join(fobj.taglist[:3])
         elif icol == 1:
-            return fobj.path
+            return fobj.path or ""
+
+    def thumbnail(self, fobj):
+        if self.thumbnailer is None or not fobj.path or not Thumbnails.is_image(fobj.path):
+            return QVariant()
+        if fobj.id not in self.thumbnails:
+            self.thumbnails[fobj.id] = None
+            self.thumbnailer.request(
+                fobj.id, os.path.join(IX.LocalFilePathHistoryEntry.RELATIVE_BASE_DIR or "", fobj.path),
+                self.thumbnailReady.emit)
+        pixmap = self.thumbnails[fobj.id]
+        if pixmap is None:
+            if self.placeholder is None:
+                self.placeholder = QtGui.QPixmap(self.thumbnailer.size, self.thumbnailer.size)
+                self.placeholder.fill(Qt.lightGray)
+            return self.placeholder
+        return pixmap or QVariant()
+
+    def showThumbnail(self, blob_id, path):
+        try:
+            self.thumbnailer.save_hashes()
+        except sqla.exc.SQLAlchemyError:
+            ## kept for the next thumbnail
+            IX.db_session.rollback()
+        if blob_id not in self.thumbnails:
+            ## from an earlier search
+            return
+        self.thumbnails[blob_id] = path is not None and QtGui.QPixmap(path) or False
+        for row, fobj in enumerate(self.ls_data):
+            if fobj.id == blob_id:
+                index = self.index(row, 1)
+                self.dataChanged.emit(index, index)
 
     def sort(self, Ncol, order):
-        self.emit(QtCore.SIGNAL("layoutAboutToBeChanged()"))
-        self.ls_data = sorted(self.ls_data, key = operator.attrgetter(self._headerkey[Ncol]))
-        if order == Qt.DescendingOrder:
-            self.ls_data.reverse()
-        self.emit(QtCore.SIGNAL("layoutChanged()"))
-        
+        self.sortOrder = (self._headerkey[Ncol], order == Qt.DescendingOrder)
+        if self.pager is None:
+            return
+        self.beginResetModel()
+        self.pager = self.pager.reordered(*self.sortOrder)
+        self.ls_data = self.pager.fetch()
+        self.endResetModel()
+
     def headerData(self, col, orientation, role):
         if role == Qt.DisplayRole:
             if orientation == Qt.Horizontal:
@@ -92,13 +399,20 @@ class MainApp(QtGui.QWidget):
     def __init__(self, ROOT_DIR, parent=None):
         super(MainApp, self).__init__(parent)
 
-        self.model = MyTableModel()
+        self.thumbnailer = Thumbnails.Thumbnailer(
+            Thumbnails.ThumbnailCache("_index.db.thumbnails"), render=render_qt_thumbnail)
+        QtGui.QApplication.instance().aboutToQuit.connect(self.thumbnailer.close)
+        self.model = MyTableModel(thumbnailer=self.thumbnailer)
 
         tv = self.tableView = QtGui.QTableView()
         tv.setModel(self.model)
         tv.doubleClicked.connect(self.openFileCommand)
         tv.selectionModel().selectionChanged.connect(self.updateTagDisplayCommand)
         tv.horizontalHeader().setStretchLastSection(True)
+        tv.setIconSize(QtCore.QSize(Thumbnails.THUMBNAIL_SIZE, Thumbnails.THUMBNAIL_SIZE))
+        tv.verticalHeader().setDefaultSectionSize(Thumbnails.THUMBNAIL_SIZE + 4)
+        tv.setSortingEnabled(True)
+        tv.sortByColumn(1, Qt.AscendingOrder)
         ## disable editing
         tv.setEditTriggers( QtGui.QTableWidget.NoEditTriggers )
 
@@ -107,6 +421,16 @@ class MainApp(QtGui.QWidget):
         self.searchInputEdit = InstantSearchLineEdit(self, self.tableView)
         self.searchInputEdit.setFocus(True)
 
+        ## tags the results carry; clicking one narrows the search to it
+        self.facetList = QtGui.QListWidget(self)
+        self.facetList.setMaximumWidth(200)
+        self.facetList.itemClicked.connect(self.refineSearchCommand)
+        self.searchInputEdit.controller.facetsReady.connect(self.showFacets)
+
+        self.resultsLayout = QtGui.QHBoxLayout()
+        self.resultsLayout.addWidget(self.tableView)
+        self.resultsLayout.addWidget(self.facetList)
+
         self.searchInputGrid = QtGui.QGridLayout()
         self.searchInputGrid.addWidget(self.searchInputLabel, 2, 0)
         self.searchInputGrid.addWidget(self.searchInputEdit, 2, 1)
@@ -115,6 +439,8 @@ class MainApp(QtGui.QWidget):
         self.tagEditLabel    = QtGui.QLabel(self)
         self.tagEditLabel.setText("tags in item(s)")
         self.tagEditButton = QtGui.QPushButton('apply changes', self)
+        self.searchCompleter = TagCompleter(self.searchInputEdit, " ")
+        self.tagEditCompleter = TagCompleter(self.tagEditText, ",")
         self.tagEditButton.clicked.connect(self.applyTagEditCommand)
 
         self.hashInfoText       = QtGui.QLineEdit(self)
@@ -143,14 +469,61 @@ class MainApp(QtGui.QWidget):
 
         self.layout = QtGui.QVBoxLayout(self)
         self.layout.addLayout(self.searchInputGrid)
-        self.layout.addWidget(self.tableView)
+        self.layout.addLayout(self.resultsLayout)
         self.layout.addWidget(self.tagEditLabel)
         self.layout.addWidget(self.tagEditText)
         self.layout.addWidget(self.tagEditButton)
         self.layout.addLayout(self.fileInfoGrid)
 
+        self.reindexProgress = QtGui.QProgressBar(self)
+        self.reindexProgress.setRange(0, 0)
+        self.reindexProgress.setFormat("opening index")
+        self.reindexProgress.setTextVisible(True)
+        self.layout.addWidget(self.reindexProgress)
+        self.lastRefresh = 0
+        self.reindexWorker = None
+
         QtGui.QShortcut(QtGui.QKeySequence("Ctrl+Q"), self, self.close)
 
+    ## seconds between searches re-run while a reindex adds files
+    REFRESH_INTERVAL = 5.0
+
+    def startReindex(self, worker):
+        self.reindexWorker = worker
+        worker.progressed.connect(self.showReindexProgress)
+        worker.finished.connect(self.reindexFinished)
+        QtGui.QApplication.instance().aboutToQuit.connect(worker.stop)
+        worker.start()
+
+    def showReindexProgress(self, progress):
+        self.reindexProgress.setRange(0, max(progress.files_changed, 1))
+        self.reindexProgress.setValue(progress.files_done)
+        self.reindexProgress.setFormat("indexing: %s" % progress)
+        ## new files show up in the results as batches commit, unless
+        ## that would pull the rows out from under a selection
+        if time.time() - self.lastRefresh >= self.REFRESH_INTERVAL \
+                and not self.tableView.selectionModel().hasSelection():
+            self.lastRefresh = time.time()
+            self.searchInputEdit.controller.refresh()
+
+    def reindexFinished(self, result):
+        self.reindexProgress.setRange(0, 1)
+        self.reindexProgress.setValue(1)
+        self.reindexProgress.setFormat(result or "index up to date")
+        self.searchInputEdit.controller.refresh()
+
+    def showFacets(self, facets):
+        self.facetList.clear()
+        for text, count in facets:
+            item = QtGui.QListWidgetItem("%s (%d)" % (text, count))
+            item.setData(Qt.UserRole, text)
+            self.facetList.addItem(item)
+
+    def refineSearchCommand(self, item):
+        text = str(item.data(Qt.UserRole))
+        ## the search box takes it as a refinement of the shown results
+        self.searchInputEdit.setText(str(self.searchInputEdit.text()).rstrip() + " " + text)
+
     def _system_open(self, filename):
         os.system(OPEN_CMD + " '" + filename.replace("'", "'\\''""'") + "'")
 
@@ -160,53 +533,57 @@ class MainApp(QtGui.QWidget):
         return IX.BlobEntry.get(id = tfile_id)
 
     def openDirCommand(self):
-        self._system_open(os.path.split(self.focusedFile.get_realpath())[0])
+        realpath = self.focusedFile is not None and self.focusedFile.get_realpath()
+        if realpath:
+            self._system_open(os.path.split(realpath)[0])
+
+    def getSelectedRows(self):
+        return sorted(set(idx.row() for idx in self.tableView.selectedIndexes()))
 
-    def getSelectedFileList(self):
-        dfile = {}
-        for idx in self.tableView.selectedIndexes():
-            if idx.row() in dfile: continue
-            dfile[idx.row()] = self.getFileAtRow(idx.row())
-        return dfile
+    def getSelectedBlobIds(self):
+        return [self.model.ls_data[row].id for row in self.getSelectedRows()]
 
-    def getSharedTagList(self, lfile):
-        return reduce(lambda s, t: set(s).intersection(t), [[str(t.text) for t in f.taglist] for f in lfile])
+    def getSharedTagList(self, lblob_id):
+        return IX.BlobEntry.shared_tags(lblob_id)
 
     def updateTagDisplayCommand(self):
-        dfile = self.getSelectedFileList()
-        if not dfile:
+        lrow = self.getSelectedRows()
+        if not lrow:
             self.tagEditLabel.setText("nothing selected")
-        elif len(dfile) is 1:
-            f = dfile.values()[0]
+        elif len(lrow) == 1:
+            f = self.getFileAtRow(lrow[0])
             self.focusAndShowFileInfo(f)
-            self.tagEditText.setPlainText(", ".join([str(t.text) for t in f.taglist]))
-            self.tagEditLabel.setText("tags in %s" % (f.path))
+            self.tagEditText.setPlainText(", ".join(self.getSharedTagList([f.id])))
+            self.tagEditLabel.setText("tags in %s" % self.model.ls_data[lrow[0]].path)
         else:
             ## show intersection of tags
-            self.tagEditLabel.setText("shared tags among %d files" % len(dfile))
-            self.tagEditText.setPlainText(", ".join(self.getSharedTagList(dfile.values())))
+            self.tagEditLabel.setText("shared tags among %d files" % len(lrow))
+            self.tagEditText.setPlainText(", ".join(self.getSharedTagList(self.getSelectedBlobIds())))
 
     def applyTagEditCommand(self):
-        dfile = self.getSelectedFileList()
-        if not dfile:
+        lblob_id = self.getSelectedBlobIds()
+        if not lblob_id:
             return
-        ltag_old = set(self.getSharedTagList(dfile.values()))
-        ltag_new = set([text.strip() for text in str(self.tagEditText.toPlainText()).decode("utf-8").lower().strip(",").split(",")])
-
-        ## ADD
-        ltagadd = map(IX.Tag.guaranteed_get, ltag_new.difference(ltag_old))
-        for f in dfile.values():
-            f.add_tag(*ltagadd)
-
-        ## DEL
-        ltagdel = map(IX.Tag.guaranteed_get, ltag_old.difference(ltag_new))
-        for f in dfile.values():
-            f.del_tag(*ltagdel)
-
+        ltag_old = set(self.getSharedTagList(lblob_id))
+        ltag_new = set([text.strip() for text in str(self.tagEditText.toPlainText()).lower().strip(",").split(",")])
+        ltag_new.discard("")
+        try:
+            IX.BlobEntry.bulk_tag(lblob_id, add=ltag_new - ltag_old, remove=ltag_old - ltag_new)
+        except sqla.exc.SQLAlchemyError as e:
+            ## e.g. another process holding the database's write lock
+            self.tagEditLabel.setText("could not apply changes: %s" % (getattr(e, "orig", None) or e))
+            return
+        self.updateTagDisplayCommand()
 
     def verifyShaCommand(self):
+        realpath = self.focusedFile is not None and self.focusedFile.get_realpath()
+        if not realpath:
+            return
         expected = str(self.hashInfoText.text()).strip()
-        measured = hashlib.sha1(open(self.focusedFile.get_realpath()).read()).hexdigest()
+        try:
+            measured, _ = IX.hash_file(realpath)
+        except (IOError, OSError):
+            measured = None
 
         if expected == measured:
             result_text = "matches"
@@ -218,13 +595,14 @@ class MainApp(QtGui.QWidget):
         self.hashInfoText.setStyleSheet("QLineEdit "+result_style)
 
     def focusAndShowFileInfo(self, f):
-        self.hashInfoText.setText(f.sha1)
+        chk = f.get_hash()
+        self.hashInfoText.setText(chk is not None and chk.value or "")
         self.focusedFile = f
 
         self.hashInfoLabel.setText("checksum:")
         self.hashInfoText.setStyleSheet("")
 
-        self.filePathText.setText(f.get_realpath())
+        self.filePathText.setText(f.get_realpath() or "")
 
     @QtCore.pyqtSlot(QtCore.QModelIndex)
     def openFileCommand(self, mindex):
@@ -232,9 +610,9 @@ class MainApp(QtGui.QWidget):
         if col == 0: # tag column
             pass
         else: # file column, open file
-            if OPEN_CMD:
-                f = self.getFileAtRow(mindex.row())
-                self._system_open(f.get_realpath())
+            realpath = OPEN_CMD and self.getFileAtRow(mindex.row()).get_realpath()
+            if realpath:
+                self._system_open(realpath)
 
 if __name__ == "__main__":
     import sys
@@ -242,13 +620,16 @@ if __name__ == "__main__":
     BASE_DIR = sys.argv[-1]
 
     IX.init_db("_index.db")
-    indexer = IX.Indexer(BASE_DIR)
-    indexer.reindex()
+    ## paths shown before the Indexer exists are relative to BASE_DIR too
+    IX.LocalFilePathHistoryEntry.RELATIVE_BASE_DIR = BASE_DIR
 
     app = QtGui.QApplication(sys.argv)
     app.setApplicationName('Um okay...')
 
     main = MainApp(BASE_DIR)
+    main.startReindex(ReindexWorker(BASE_DIR, posting_snapshot="_index.db.postings"))
+    ## after the reindex has stopped
+    app.aboutToQuit.connect(IX.save_posting_snapshot)
     ## main.resize(640, 800)
     ## main.move(app.desktop().screen().rect().center() - main.rect().center())
     main.show()
@@ -0,0 +1,257 @@
+"""
+time indexing and search over a generated file tree.
+
+python benchmark.py --files 20000 --output results.json
+python benchmark.py --files 20000 --baseline results.json
+
+the tree is generated from --seed, so runs with the same shape index the
+same files. with --baseline, metrics that got worse by more than
+--tolerance are listed and the exit status is 1. a baseline of another
+tree shape or reindex mode isn't compared against (exit status 2); one run
+on another Python or SQLAlchemy version only gets a warning
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Indexing as IX
+
+import io
+import json
+import math
+import platform
+import random
+import resource
+import shutil
+import tempfile
+import time
+from collections import namedtuple
+from os.path import join as pjoin
+
+import sqlalchemy as sqla
+
+
+class TreeShape(namedtuple('TreeShape', 'files depth fanout median_size size_sigma max_size tags duplicates seed')):
+    """
+    files: number of files
+    depth, fanout: directory levels, and subdirectories per directory
+    median_size, size_sigma, max_size: file sizes are lognormal around
+        median_size bytes, spread by size_sigma, and capped at max_size
+    tags: size of the word list directory and file names are made of,
+        which is what the indexer turns into tags
+    duplicates: fraction of files that are copies of an earlier file
+    seed: for the random generator
+    """
+    __slots__ = ()
+
+
+DEFAULT_SHAPE = TreeShape(
+    files=2000, depth=3, fanout=4, median_size=4096, size_sigma=1.5, max_size=1 << 22,
+    tags=200, duplicates=0.1, seed=0)
+
+SYLLABLES = ['ka', 'lo', 'mi', 'nu', 're', 'sa', 'to', 'vi', 'ze', 'an', 'el', 'or', 'us', 'ix', 'em']
+
+
+def make_words(rng, nword):
+    words = set()
+    while len(words) < nword:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def make_tree(root, shape):
+    """
+    fill the directory $root with files of TreeShape $shape
+
+    returns the word list the names were made of
+    """
+    rng = random.Random(shape.seed)
+    words = make_words(rng, shape.tags)
+    ldir = [root]
+    level = [root]
+    for _ in range(shape.depth):
+        next_level = []
+        for dirpath in level:
+            for name in rng.sample(words, min(shape.fanout, len(words))):
+                subdir = pjoin(dirpath, name)
+                os.mkdir(subdir)
+                next_level.append(subdir)
+        ldir.extend(next_level)
+        level = next_level
+
+    lpath = []
+    for i in range(shape.files):
+        name = '%s_%s_%d.%s' % (rng.choice(words), rng.choice(words), i, rng.choice(('txt', 'jpg', 'pdf', 'dat')))
+        path = pjoin(rng.choice(ldir), name)
+        if lpath and rng.random() < shape.duplicates:
+            shutil.copyfile(rng.choice(lpath), path)
+        else:
+            size = min(shape.max_size, int(rng.lognormvariate(math.log(shape.median_size), shape.size_sigma)))
+            with open(path, 'wb') as ofile:
+                ofile.write(rng.getrandbits(8 * size).to_bytes(size, 'little') if size else b'')
+        lpath.append(path)
+    return words
+
+
+def percentile(lvalue, pct):
+    ## nearest rank
+    lvalue = sorted(lvalue)
+    return lvalue[max(0, int(math.ceil(pct / 100.0 * len(lvalue))) - 1)]
+
+
+def peak_rss_kb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    ## bytes on macOS, kilobytes elsewhere
+    return sys.platform == 'darwin' and usage // 1024 or usage
+
+
+def timed(func, *args, **kw):
+    time_start = time.perf_counter()
+    rtn = func(*args, **kw)
+    return time.perf_counter() - time_start, rtn
+
+
+def time_queries(words, op, nquery, rng):
+    ## latencies in ms of $nquery findall calls with 1 to 3 random words
+    lms = []
+    for _ in range(nquery):
+        ltoken = [word[:rng.randint(2, len(word))] for word in rng.sample(words, rng.randint(1, 3))]
+        elapsed, _ = timed(lambda: list(IX.BlobEntry.findall(op, ltoken)))
+        lms.append(elapsed * 1000)
+    return lms
+
+
+def run(shape, root, queries=200, reindex_kw=None):
+    """
+    generate a tree of $shape under $root, index it and time each phase
+
+    returns {metric: value}. metrics ending in _per_s are better higher,
+    the rest better lower
+    """
+    metrics = {}
+    basedir = tempfile.mkdtemp(dir=root, prefix='ixbench-')
+    db_path = pjoin(root, os.path.basename(basedir) + '.db')
+    try:
+        elapsed, words = timed(make_tree, basedir, shape)
+        metrics['generate_s'] = elapsed
+
+        IX.init_db(db_path)
+        indexer = IX.Indexer(basedir)
+        elapsed, nfile = timed(indexer.reindex, **(reindex_kw or {}))
+        metrics['reindex_cold_s'] = elapsed
+        metrics['reindex_cold_files_per_s'] = nfile / elapsed
+        metrics['reindex_noop_s'], _ = timed(indexer.reindex, **(reindex_kw or {}))
+        metrics['resync_s'], _ = timed(indexer.resync_db)
+        metrics['db_bytes'] = os.path.getsize(db_path)
+
+        rng = random.Random(shape.seed)
+        for opname, op in (('and', IX.BlobEntry.OP_AND), ('or', IX.BlobEntry.OP_OR)):
+            ## the first query builds the tag search index
+            IX.BlobEntry.findall(op, words[0])
+            lms = time_queries(words, op, queries, rng)
+            for pct in (50, 90, 99):
+                metrics['findall_%s_p%d_ms' % (opname, pct)] = percentile(lms, pct)
+
+        ofile = io.StringIO()
+        elapsed, nrow = timed(IX.export_index, ofile)
+        metrics['dump_rows_per_s'] = nrow / elapsed
+        metrics['dump_bytes_per_s'] = len(ofile.getvalue().encode('utf-8')) / elapsed
+        metrics['peak_rss_kb'] = peak_rss_kb()
+    finally:
+        shutil.rmtree(basedir)
+        ## close the connections first, so sqlite isn't left writing the
+        ## WAL files being deleted
+        IX.db_session.remove()
+        IX.db_session.get_bind().dispose()
+        for suffix in ('', '-journal', '-wal', '-shm', '.postings'):
+            if os.path.exists(db_path + suffix):
+                os.unlink(db_path + suffix)
+    return metrics
+
+
+## results keys that have to match the baseline's for the metrics to be
+## comparable, and ones that only get a warning
+REQUIRED_MATCH = ('shape', 'reindex')
+WARN_MATCH = ('python', 'sqlalchemy')
+
+
+def mismatches(results, baseline, keys):
+    """
+    list the (key, baseline value, value) of the $keys that differ between
+    $results and $baseline
+    """
+    return [(key, baseline.get(key), results.get(key))
+            for key in keys if baseline.get(key) != results.get(key)]
+
+
+def compare(metrics, baseline, tolerance):
+    """
+    list the (metric, baseline value, value) in $metrics worse than in
+    $baseline by more than the fraction $tolerance
+    """
+    lregression = []
+    for key, value in sorted(metrics.items()):
+        expected = baseline.get(key)
+        if not expected or key in ('generate_s', 'db_bytes'):
+            continue
+        if key.endswith('_per_s'):
+            worse = value < expected * (1 - tolerance)
+        else:
+            worse = value > expected * (1 + tolerance)
+        if worse:
+            lregression.append((key, expected, value))
+    return lregression
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    for field, default in DEFAULT_SHAPE._asdict().items():
+        parser.add_argument('--' + field, type=type(default), default=default)
+    parser.add_argument('--root', default=tempfile.gettempdir(),
+                        help='directory to generate the tree and index in (default: %(default)s)')
+    parser.add_argument('--queries', type=int, default=200,
+                        help='findall calls per operator')
+    parser.add_argument('--bulk', action='store_true')
+    parser.add_argument('--workers', type=int, default=0)
+    parser.add_argument('--output',
+                        help='write the results as JSON to this file, else STDOUT')
+    parser.add_argument('--baseline',
+                        help='results JSON of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fraction a metric may get worse by before it counts as a regression')
+    args = parser.parse_args()
+
+    shape = TreeShape(**dict((field, getattr(args, field)) for field in TreeShape._fields))
+    results = {
+        'shape': shape._asdict(),
+        'reindex': {'bulk': args.bulk, 'workers': args.workers},
+        'python': platform.python_version(),
+        'sqlalchemy': sqla.__version__,
+        'platform': platform.platform(),
+        'time': time.time(),
+        'metrics': run(shape, args.root, queries=args.queries,
+                       reindex_kw=dict(bulk=args.bulk, workers=args.workers)),
+    }
+    if args.output:
+        with open(args.output, 'w') as ofile:
+            json.dump(results, ofile, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as ifile:
+            baseline = json.load(ifile)
+        for key, expected, value in mismatches(results, baseline, WARN_MATCH):
+            print('warning: baseline was run with %s %s, not %s' % (key, expected, value), file=sys.stderr)
+        lmismatch = mismatches(results, baseline, REQUIRED_MATCH)
+        for key, expected, value in lmismatch:
+            print('MISMATCH %s: %s -> %s' % (key, expected, value), file=sys.stderr)
+        if lmismatch:
+            sys.exit(2)
+        lregression = compare(results['metrics'], baseline['metrics'], args.tolerance)
+        for key, expected, value in lregression:
+            print('REGRESSION %s: %.4g -> %.4g' % (key, expected, value), file=sys.stderr)
+        sys.exit(lregression and 1 or 0)
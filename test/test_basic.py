@@ -3,6 +3,9 @@ import sys
 sys.path.append('..')
 
 import Indexing as IX
+import Server
+import Thumbnails
+import unittest
 from unittest import TestCase
 
 import os
@@ -12,6 +15,7 @@ import time
 import tempfile
 import random
 import shutil
+import hashlib
 import faker
 
 from nose.tools import \
@@ -60,6 +64,673 @@ class TestIndexer(TestCase):
         assert_equal(len(self.fs.file_list), nproc)
         assert_equal(0, self.ix.reindex())
 
+    def test_reindex_bulk(self):
+        nproc = self.ix.reindex(bulk=True, batch_size=4)
+        assert_equal(len(self.fs.file_list), nproc)
+        assert_equal(len(self.fs.file_list), self.ix.bulk_writer.nfiles)
+        assert_equal([], self.ix.bulk_writer.failed)
+        assert_equal(len(self.fs.file_list),
+                     IX.db_session.query(IX.LocalFilePathHistoryEntry).count())
+        assert_equal(0, self.ix.reindex(bulk=True))
+
+    def test_reindex_pipelined(self):
+        nproc = self.ix.reindex(workers=3, queue_size=2)
+        assert_equal(len(self.fs.file_list), nproc)
+        assert_equal(len(self.fs.file_list),
+                     IX.db_session.query(IX.LocalFilePathHistoryEntry).count())
+        assert_equal(0, self.ix.reindex(workers=3))
+
+    def test_reindex_resume(self):
+        class Interrupted(Exception):
+            pass
+
+        def interrupt(progress):
+            if progress.files_done == 5:
+                raise Interrupted()
+
+        try:
+            self.ix.reindex(bulk=True, batch_size=2, progress=IX.ReindexProgress(interrupt, interval=0))
+        except Interrupted:
+            pass
+        checkpoint = IX.ScanCheckpoint.get(base_dir=self.fs.BASEDIR)
+        assert_equal(4, checkpoint.files_done)
+
+        progress = IX.ReindexProgress()
+        nproc = self.ix.reindex(bulk=True, progress=progress)
+        ## files after the checkpoint, and the uncommitted batch before it
+        assert_equal(len(self.fs.file_list) - 4, progress.files_seen)
+        assert_equal(len(self.fs.file_list) - 4, nproc)
+        assert_equal(True, progress.walk_finished)
+        assert_equal(None, IX.ScanCheckpoint.get(base_dir=self.fs.BASEDIR))
+        assert_equal(len(self.fs.file_list), IX.db_session.query(IX.LocalFilePathHistoryEntry).count())
+
+    def test_reindex_cancel(self):
+        def cancel_after(n):
+            def callback(progress):
+                if progress.files_seen >= n:
+                    progress.cancel()
+            return callback
+        ## cancelled mid-walk, with nothing done to report progress on
+        self.ix.reindex(bulk=True, batch_size=2)
+        progress = IX.ReindexProgress()
+        progress.cancel()
+        with self.assertRaises(IX.ReindexCancelled):
+            self.ix.reindex(bulk=True, progress=progress)
+        ## mid-reindex: the committed batches stay, and the next one resumes
+        self.tearDown()
+        self.setUp()
+        progress = IX.ReindexProgress(cancel_after(5), interval=0)
+        with self.assertRaises(IX.ReindexCancelled):
+            self.ix.reindex(bulk=True, batch_size=2, progress=progress)
+        assert_equal(True, IX.ScanCheckpoint.get(base_dir=self.fs.BASEDIR).files_done >= 4)
+        self.ix.reindex(bulk=True)
+        assert_equal(len(self.fs.file_list), IX.db_session.query(IX.LocalFilePathHistoryEntry).count())
+
+    def test_bulk_tag_during_reindex(self):
+        import threading
+        for i in range(200):
+            self.fs.make_filler_file(self.fs.BASEDIR)
+        self.ix.reindex(bulk=True, batch_size=len(self.fs.file_list))
+        lblob_id = [id for id, in IX.db_session.query(IX.BlobEntry.id)]
+        IX.db_session.commit()
+        for i in range(300):
+            self.fs.make_filler_file(self.fs.BASEDIR)
+
+        def reindex():
+            try:
+                IX.Indexer(self.fs.BASEDIR).reindex(bulk=True, batch_size=5)
+            finally:
+                IX.db_session.remove()
+        thread = threading.Thread(target=reindex)
+        thread.start()
+        ntag = 0
+        while thread.is_alive():
+            ## reads first, as the GUI does, so the session holds a snapshot
+            IX.BlobEntry.shared_tags(lblob_id[:3])
+            IX.BlobEntry.bulk_tag(lblob_id[:3], add=['edit%d' % ntag])
+            ntag += 1
+        thread.join()
+        assert_equal(511, IX.db_session.query(IX.LocalFilePathHistoryEntry).count())
+        assert_equal(['edit%d' % i for i in range(ntag)],
+                     sorted([text for text in IX.BlobEntry.shared_tags(lblob_id[:3])
+                             if text.startswith('edit')], key=lambda text: int(text[4:])))
+
+    def test_stats(self):
+        IX.stats.reset()
+        self.ix.reindex(bulk=True)
+        snapshot = IX.stats.snapshot()
+        assert_equal(len(self.fs.file_list), snapshot['counters']['files_indexed'])
+        assert_equal(sum(os.path.getsize(path) for path in self.fs.file_list), snapshot['counters']['bytes_read'])
+        for name in ('walk', 'stat', 'read', 'hash', 'tokenize', 'db_write', 'db_commit', 'sql'):
+            assert_equal(True, name in snapshot['phases'])
+        IX.stats.reset()
+        self.ix.reindex(bulk=True)
+        assert_equal(len(self.fs.file_list), IX.stats.counters['files_skipped'])
+        assert_equal(1.0, IX.stats.hit_rate('dfile'))
+
+    def test_lazy_cache(self):
+        self.ix.reindex(bulk=True)
+        ix = IX.Indexer(self.fs.BASEDIR)
+        assert_equal((None, None), (ix._dfile, ix._dtag))
+        relpath = IX.LocalFilePathHistoryEntry.get_relpath(self.fs.file_list[0])
+        assert_equal(True, ix.lookup(relpath, os.stat(self.fs.file_list[0]))[1])
+        assert_equal(len(self.fs.file_list), len(ix._dfile))
+        assert_equal(None, ix._dtag)
+        ## a reindex on another thread loads the caches there
+        import threading
+        thread = threading.Thread(target=lambda: (ix.reindex(), IX.db_session.remove()))
+        thread.start()
+        thread.join()
+        assert_equal(len(self.fs.file_list), len(ix.dfile))
+
+    def test_scan_prefetch(self):
+        expected = list(IX.scan_tree(self.fs.BASEDIR))
+        assert_equal(expected, list(IX.scan_tree(self.fs.BASEDIR, prefetch=3)))
+        relpath = os.path.relpath(expected[4][0], self.fs.BASEDIR)
+        assert_equal(expected[5:], list(IX.scan_tree(self.fs.BASEDIR, resume_after=relpath, prefetch=3)))
+
+    def check_storage(self, storage, lpath):
+        ix = IX.Indexer(storage=storage)
+        assert_equal(len(lpath), ix.reindex(workers=2))
+        for path in lpath:
+            with storage.open(path) as ifile:
+                expected = IX.get_hash_entry_type().get_hash(ifile.read())
+            file = IX.LocalFilePathHistoryEntry.get(path=path.lstrip('/'))
+            assert_equal(expected, file.blob.ensure_hash().value)
+        assert_equal(0, ix.reindex(bulk=True))
+        assert_equal(1, len(ix.find_duplicates()))
+
+    def test_memory_storage(self):
+        storage = IX.MemoryStorage({
+            '/a.txt': b'alpha',
+            '/b/c.txt': b'charlie',
+            '/b/d/e.txt': b'echo',
+            '/b/d/f.txt': b'alpha',
+        }, prefetch=2)
+        self.check_storage(storage, sorted(storage.files))
+
+    def test_memory_storage_lazy_hash(self):
+        storage = IX.MemoryStorage({'/a.txt': b'alpha', '/b.txt': b'bravo!'})
+        ix = IX.Indexer(storage=storage)
+        ix.reindex(lazy_hash=True)
+        a = IX.LocalFilePathHistoryEntry.get(path='a.txt')
+        ## unique size: indexed without a hash
+        assert_equal(None, a.blob.get_hash())
+        assert_equal(b'alpha', a.blob.get_content(storage))
+
+        storage.write('/copy.txt', b'alpha')
+        ix.reindex(lazy_hash=True)
+        copy = IX.LocalFilePathHistoryEntry.get(path='copy.txt')
+        assert_equal(a.blob_id, copy.blob_id)
+        assert_equal(IX.get_hash_entry_type().get_hash(b'alpha'), a.blob.get_hash().value)
+
+    @unittest.skipIf(IX.pyfs is None, "PyFilesystem is not installed")
+    def test_fs_storage(self):
+        from fs.memoryfs import MemoryFS
+        memfs = MemoryFS()
+        memfs.makedirs('/b/d')
+        for path, content in (('/a.txt', b'alpha'), ('/b/c.txt', b'charlie'), ('/b/d/f.txt', b'alpha')):
+            memfs.writebytes(path, content)
+        self.check_storage(IX.FSStorage(memfs, prefetch=2), ['/a.txt', '/b/c.txt', '/b/d/f.txt'])
+
+    def test_reindex_changed_file(self):
+        self.ix.reindex()
+        changed = self.fs.file_list[0]
+        with open(changed, 'a') as ofile:
+            ofile.write('more content')
+        os.utime(changed, ns=(0, 12345))
+        assert_equal(1, self.ix.reindex())
+        relpath = IX.LocalFilePathHistoryEntry.get_relpath(changed)
+        file = IX.LocalFilePathHistoryEntry.get(path=relpath)
+        assert_equal(12345, file.mtime_ns)
+        assert_equal(os.stat(changed).st_size, file.blob.size)
+        assert_equal(0, self.ix.reindex())
+
+    def test_find_duplicates(self):
+        copy = self.fs.file_list[0] + '.copy'
+        shutil.copy(self.fs.file_list[0], copy)
+        groups = self.ix.find_duplicates()
+        assert_equal(1, len(groups))
+        assert_equal(sorted([self.fs.file_list[0], copy]), groups[0].paths)
+        assert_equal(os.stat(copy).st_size, groups[0].reclaimable)
+
+    def test_cascade_hashes_samples_before_full_hash(self):
+        ## same size, same head and tail, different middle
+        sample_size = 4
+        paths = []
+        for middle in ('aaaa', 'bbbb', 'bbbb'):
+            paths.append(tempfile.mktemp(dir=self.fs.BASEDIR))
+            with open(paths[-1], 'w') as ofile:
+                ofile.write('head' + middle + 'tail')
+        ## same size, different tail: never fully hashed
+        other = tempfile.mktemp(dir=self.fs.BASEDIR)
+        with open(other, 'w') as ofile:
+            ofile.write('headbbbbliat')
+        digests = IX.cascade_hashes([(p, 12) for p in paths + [other]], sample_size=sample_size)
+        assert_equal(sorted(paths), sorted(digests))
+        assert_equal(digests[paths[1]], digests[paths[2]])
+        assert_equal(IX.hash_file(paths[0])[0], digests[paths[0]])
+
+    def test_reindex_lazy_hash(self):
+        copy = self.fs.file_list[0] + '.copy'
+        shutil.copy(self.fs.file_list[0], copy)
+        assert_equal(len(self.fs.file_list) + 1, self.ix.reindex(lazy_hash=True))
+        get_file = lambda path: IX.LocalFilePathHistoryEntry.get(
+            path=IX.LocalFilePathHistoryEntry.get_relpath(path))
+        assert_equal(get_file(copy).blob_id, get_file(self.fs.file_list[0]).blob_id)
+        ## files without a hash get one on demand
+        for path in self.fs.file_list:
+            with open(path, 'rb') as ifile:
+                expected = IX.get_hash_entry_type().get_hash(ifile.read())
+            assert_equal(expected, get_file(path).blob.ensure_hash().value)
+
+    def test_reindex_lazy_then_full(self):
+        self.ix.reindex(lazy_hash=True)
+        get_file = lambda path: IX.LocalFilePathHistoryEntry.get(
+            path=IX.LocalFilePathHistoryEntry.get_relpath(path))
+        ## copies found by a reindex that hashes every file still join the
+        ## blobs of the lazily indexed originals
+        for path, kw in zip(self.fs.file_list, (dict(), dict(bulk=True), dict(workers=2))):
+            copy = path + '.copy'
+            shutil.copy(path, copy)
+            IX.db_session.remove()
+            ix = IX.Indexer(self.fs.BASEDIR)
+            assert_equal(1, ix.reindex(**kw))
+            assert_equal(get_file(path).blob_id, get_file(copy).blob_id)
+        assert_equal(len(self.fs.file_list), IX.db_session.query(IX.BlobEntry).count())
+
+    def test_hash_file(self):
+        for filepath in self.fs.file_list:
+            with open(filepath, 'rb') as ifile:
+                content = ifile.read()
+            expected = (IX.get_hash_entry_type().get_hash(content), len(content))
+            assert_equal(expected, IX.hash_file(filepath))
+            assert_equal(expected, IX.hash_file(filepath, chunk_size=7))
+            assert_equal(expected, IX.hash_file(filepath, chunk_size=7, use_mmap=True))
+        empty = tempfile.mktemp(dir=self.fs.BASEDIR)
+        open(empty, 'w').close()
+        assert_equal((IX.get_hash_entry_type().get_hash(b''), 0), IX.hash_file(empty, use_mmap=True))
+
+    def test_hash_algorithms(self):
+        filepath = self.fs.file_list[0]
+        with open(filepath, 'rb') as ifile:
+            content = ifile.read()
+        assert_equal(hashlib.sha256(content).hexdigest(), IX.Sha256Entry.get_hash(content))
+        digests, size = IX.hash_file_multi(filepath, ['sha256', 'blake2b-128'], chunk_size=7)
+        assert_equal({'sha256': IX.Sha256Entry.get_hash(content),
+                      'blake2b-128': IX.Blake2bEntry.get_hash(content)}, digests)
+        assert_equal(len(content), size)
+
+        ## extra digests are linked to the blobs they were computed for
+        IX.init_db(self.db_path, extra_hash_algorithms=['sha256'])
+        ix = IX.Indexer(self.fs.BASEDIR)
+        ix.reindex(bulk=True)
+        file = IX.LocalFilePathHistoryEntry.get(path=IX.LocalFilePathHistoryEntry.get_relpath(filepath))
+        assert_equal(IX.Sha256Entry.get_hash(content), file.blob.get_hash('sha256').value)
+        assert_equal(IX.get_hash_entry_type().get_hash(content), file.blob.get_hash().value)
+        ## the algorithm blobs are identified by is fixed per index
+        with self.assertRaises(ValueError):
+            IX.init_db(self.db_path, hash_algorithm='sha1')
+
+    def test_legacy_sha1_migration(self):
+        ## indexes made before Sha256Entry computed sha256 hold sha1 there
+        self.ix.reindex(bulk=True)
+        IX.db_session.execute(IX.Setting.__table__.delete())
+        sha256 = IX.HashAlgorithm.ensure(name='sha256')
+        for link in IX.db_session.query(IX.BlobEntryHash):
+            content = link.blob.get_local_files()[0].get_hash(algorithm='sha1')[0]
+            IX.db_session.execute(IX.Sha256Entry.__table__.insert(), dict(id=link.hash_entry_id, value=content))
+            link.hash_algorithm_id = sha256.id
+        IX.db_session.execute(IX.get_hash_entry_type().__table__.delete())
+        IX.db_session.execute('DROP INDEX ix_blob__tag_tag_id_blob_entry_id')
+        IX.db_session.execute('ALTER TABLE local_file_path_history_entry DROP COLUMN time_scrubbed')
+        IX.db_session.commit()
+        IX.set_schema_version(IX.db_session.get_bind(), 0)
+
+        IX.init_db(self.db_path)
+        engine = IX.db_session.get_bind()
+        assert_equal(IX.SCHEMA_VERSION, IX.get_schema_version(engine))
+        assert_equal(True, 'ix_blob__tag_tag_id_blob_entry_id' in [
+            index['name'] for index in IX.sqla.inspect(engine).get_indexes('blob__tag')])
+        assert_equal('wal', engine.execute('PRAGMA journal_mode').scalar())
+        assert_equal('sha1', IX.index_hash_algorithm)
+        assert_equal(0, IX.db_session.query(IX.Sha256Entry).count())
+        ix = IX.Indexer(self.fs.BASEDIR)
+        copy = tempfile.mktemp(dir=self.fs.BASEDIR)
+        shutil.copy(self.fs.file_list[0], copy)
+        assert_equal(1, ix.reindex())
+        get_file = lambda path: IX.LocalFilePathHistoryEntry.get(
+            path=IX.LocalFilePathHistoryEntry.get_relpath(path))
+        assert_equal(get_file(self.fs.file_list[0]).blob_id, get_file(copy).blob_id)
+
+    def test_legacy_merged_blobs(self):
+        ## indexes made before blobs were matched by hash shared one blob
+        ## among all files of a size
+        paths = [pjoin(self.fs.BASEDIR, name) for name in ('alpha.txt', 'bravo.txt', 'alpha copy.txt')]
+        for path, content in zip(paths, (b'aaaa', b'bbbb', b'aaaa')):
+            with open(path, 'wb') as ofile:
+                ofile.write(content)
+        self.ix.reindex()
+        F = IX.LocalFilePathHistoryEntry
+        H = IX.BlobEntryHash
+        get_file = lambda path: F.get(path=F.get_relpath(path))
+        alpha, bravo = get_file(paths[0]), get_file(paths[1])
+        merged_id, bravo_id = alpha.blob_id, bravo.blob_id
+        alpha.blob.add_tag(IX.Tag.guaranteed_get('keepme'))
+        IX.db_session.query(H).filter_by(blob_id=bravo_id).update({H.blob_id: merged_id})
+        IX.db_session.execute(IX.Blob__Tag.update().where(IX.Blob__Tag.c.blob_entry_id == bravo_id).values(
+            blob_entry_id=merged_id))
+        bravo.blob_id = merged_id
+        IX.db_session.delete(IX.BlobEntry.get(id=bravo_id))
+        IX.db_session.commit()
+        IX.set_schema_version(IX.db_session.get_bind(), 4)
+
+        IX.init_db(self.db_path)
+        ix = IX.Indexer(self.fs.BASEDIR)
+        ## a split that fails half way leaves the blob as it was
+        IX.db_session.execute(
+            'CREATE TRIGGER interrupt BEFORE UPDATE OF blob_id ON %s BEGIN SELECT RAISE(ABORT, "interrupted"); END'
+            % F.__tablename__)
+        IX.db_session.commit()
+        with self.assertRaises(IX.sqla.exc.SQLAlchemyError):
+            ix.reindex()
+        IX.db_session.execute('DROP TRIGGER interrupt')
+        IX.db_session.commit()
+        assert_equal(2, IX.db_session.query(H).filter_by(blob_id=merged_id).count())
+        ## and so does one whose files can't all be read
+        os.rename(paths[1], paths[1] + '.away')
+        assert_equal(0, ix.split_merged_blobs())
+        assert_equal(2, IX.db_session.query(H).filter_by(blob_id=merged_id).count())
+        assert_equal('1', IX.Setting.get_value(IX.MERGED_BLOBS_SETTING))
+        os.rename(paths[1] + '.away', paths[1])
+
+        assert_equal(0, ix.reindex())
+        IX.db_session.expire_all()
+        alpha, bravo, copy = [get_file(path) for path in paths]
+        assert_equal(merged_id, alpha.blob_id)
+        assert_equal(merged_id, copy.blob_id)
+        assert_equal(True, bravo.blob_id != merged_id)
+        assert_equal(IX.get_hash_entry_type().get_hash(b'bbbb'), bravo.blob.get_hash().value)
+        assert_equal(1, IX.db_session.query(H).filter_by(blob_id=merged_id).count())
+        alpha_tags = [tag.text for tag in alpha.blob.tags]
+        bravo_tags = [tag.text for tag in bravo.blob.tags]
+        assert_equal([True, False], ['alpha' in alpha_tags, 'bravo' in alpha_tags])
+        assert_equal([False, True], ['alpha' in bravo_tags, 'bravo' in bravo_tags])
+        assert_equal([True, True], ['keepme' in alpha_tags, 'keepme' in bravo_tags])
+        assert_equal(None, IX.Setting.get_value(IX.MERGED_BLOBS_SETTING))
+
+    def test_findall_matches_like(self):
+        self.ix.reindex(bulk=True)
+        ## tags created after the search index is built are picked up too
+        IX.BlobEntry.findall(IX.BlobEntry.OP_OR, 'zz')
+        blob = IX.db_session.query(IX.BlobEntry).first()
+        blob.tags.append(IX.Tag.guaranteed_get('ZzNewTag'))
+        IX.db_session.commit()
+        ltoken_list = [['ix'], ['zznew'], ['ZZNEW'], ['ixtest', 'tmp'], ['nosuchtag'], ['e', 'a'], ['ix', 'nosuchtag']]
+        for ltoken in ltoken_list:
+            for op in (IX.BlobEntry.OP_AND, IX.BlobEntry.OP_OR):
+                assert_equal(
+                    [b.id for b in IX.BlobEntry.findall_like(op, ltoken, exclude='zznew')],
+                    [b.id for b in IX.BlobEntry.findall(op, ltoken, exclude='zznew')])
+        assert_equal([blob.id], [b.id for b in IX.BlobEntry.findall(IX.BlobEntry.OP_AND, 'newtag')])
+
+    def test_posting_index(self):
+        self.ix.reindex(bulk=True)
+        snapshot_path = self.db_path + '.postings'
+        queries = [(op, ltoken, exclude)
+                   for op in (IX.BlobEntry.OP_AND, IX.BlobEntry.OP_OR)
+                   for ltoken in (['ix'], ['ixtest', 'tmp'], ['e', 'a'], ['nosuchtag'], ['zznew'])
+                   for exclude in ((), ['a'])]
+        expected = [[b.id for b in IX.BlobEntry.findall(*query)] for query in queries]
+        IX.enable_posting_index(snapshot_path)
+        assert_equal(expected, [[b.id for b in IX.BlobEntry.findall(*query)] for query in queries])
+
+        ## kept up to date by add_tag / del_tag, and by the snapshot
+        blob = IX.db_session.query(IX.BlobEntry).first()
+        tag = IX.Tag.guaranteed_get('zznewtag')
+        blob.add_tag(tag)
+        assert_equal([blob.id], [b.id for b in IX.BlobEntry.findall(IX.BlobEntry.OP_AND, 'zznew')])
+        IX.save_posting_snapshot()
+        reloaded = IX.TagPostingIndex.load(snapshot_path)
+        assert_equal(IX.tag_posting_index.postings, reloaded.postings)
+        blob.del_tag(tag)
+        assert_equal([], IX.BlobEntry.findall(IX.BlobEntry.OP_AND, 'zznew'))
+        ## the stale snapshot is noticed and rebuilt
+        assert_equal(IX.tag_posting_index.postings, IX.TagPostingIndex.load(snapshot_path).postings)
+        os.unlink(snapshot_path)
+
+    def test_bulk_tag(self):
+        self.ix.reindex(bulk=True)
+        IX.enable_posting_index()
+        lblob_id = [b.id for b in IX.db_session.query(IX.BlobEntry).order_by(IX.BlobEntry.id)]
+        selected = lblob_id[:4]
+        IX.BlobEntry.bulk_tag(selected[:2], add=['zzshared'])
+        added, removed = IX.BlobEntry.bulk_tag(selected, add=['zzshared', 'zzother'])
+        assert_equal(2 + 4, len(added))
+        assert_equal([], removed)
+        assert_equal(['zzother', 'zzshared'], [t for t in IX.BlobEntry.shared_tags(selected) if t.startswith('zz')])
+        assert_equal(selected, [b.id for b in IX.BlobEntry.findall(IX.BlobEntry.OP_AND, 'zzshared')])
+        ## no duplicate rows for pairs that already existed
+        assert_equal(4, IX.db_session.execute(
+            'SELECT count(*) FROM blob__tag JOIN tag ON tag.id = tag_id WHERE text = "zzshared"').scalar())
+
+        added, removed = IX.BlobEntry.bulk_tag(selected[1:], remove=['zzshared'])
+        assert_equal(3, len(removed))
+        assert_equal(['zzother'], [t for t in IX.BlobEntry.shared_tags(selected) if t.startswith('zz')])
+        assert_equal(selected[:1], [b.id for b in IX.BlobEntry.findall(IX.BlobEntry.OP_AND, 'zzshared')])
+        assert_equal(IX.TagPostingIndex.build().postings, IX.tag_posting_index.postings)
+        assert_equal([], IX.BlobEntry.shared_tags([]))
+
+        ## shared_tags leaves no transaction open, so tags written by
+        ## another thread, e.g. a reindex, show up right away
+        import threading
+        thread = threading.Thread(target=lambda: (
+            IX.BlobEntry.bulk_tag(selected, add=['zzlater']), IX.db_session.remove()))
+        thread.start()
+        thread.join()
+        assert_equal(['zzlater', 'zzother'], [t for t in IX.BlobEntry.shared_tags(selected) if t.startswith('zz')])
+
+        ## selections larger than one IN (...) list
+        B = IX.BlobEntry.__table__
+        IX.db_session.execute(B.insert(), [dict(size=0) for _ in range(600)])
+        IX.db_session.commit()
+        lblob_id = [b.id for b in IX.db_session.query(IX.BlobEntry).order_by(IX.BlobEntry.id)]
+        IX.BlobEntry.bulk_tag(lblob_id, add=['zzmany'])
+        IX.BlobEntry.bulk_tag(lblob_id[-1:], remove=['zzmany'])
+        assert_equal(['zzmany'], IX.BlobEntry.shared_tags(lblob_id[:-1]))
+        assert_equal([], IX.BlobEntry.shared_tags(lblob_id))
+
+    def test_tag_suggester(self):
+        self.ix.reindex(bulk=True)
+        suggester = IX.get_tag_suggester()
+        lsuggestion = suggester.suggest('ix', limit=3)
+        assert_equal(('ixtest', len(self.fs.file_list)), lsuggestion[0])
+        assert_equal(['ixtest'], [text for text, _ in IX.suggest_tags('IXT')])
+        assert_equal([], suggester.suggest('ixt', exclude=['ixtest']))
+
+        ## new tags and tag counts from a reindex and from bulk_tag
+        with open(pjoin(self.fs.BASEDIR, 'zzsuggest zzsuggestalt'), 'w') as ofile:
+            ofile.write('new')
+        self.ix.reindex(bulk=True)
+        lblob_id = [b.id for b in IX.db_session.query(IX.BlobEntry)][:3]
+        IX.BlobEntry.bulk_tag(lblob_id, add=['zzsuggestalt'])
+        IX.BlobEntry.bulk_tag(lblob_id[:1], remove=['zzsuggestalt'])
+        IX.Tag.guaranteed_get('zzsuggestnone')
+        expected = IX.TagSuggester.load()
+        assert_equal(expected.suggest('zz'), suggester.suggest('zz'))
+        assert_equal('zzsuggestalt', suggester.suggest('zzs')[0][0])
+
+    def test_result_facets(self):
+        self.ix.reindex(bulk=True)
+        lblob_id = [b.id for b in IX.db_session.query(IX.BlobEntry).order_by(IX.BlobEntry.id)]
+        IX.BlobEntry.bulk_tag(lblob_id[:3], add=['zzpick'])
+        IX.BlobEntry.bulk_tag(lblob_id[:2], add=['zzmore'])
+        IX.BlobEntry.bulk_tag([lblob_id[0], lblob_id[5]], add=['zzsolo'])
+
+        lfacet = IX.ResultPager(IX.BlobEntry.OP_AND, ['zzpick']).facets(limit=100)
+        counts = {}
+        for blob in IX.BlobEntry.findall(IX.BlobEntry.OP_AND, ['zzpick']):
+            for tag in blob.tags:
+                counts[tag.text] = counts.get(tag.text, 0) + 1
+        expected = sorted([(text, n) for text, n in counts.items() if n < 3 and 'zzpick' not in text],
+                          key=lambda facet: (-facet[1], facet[0]))
+        assert_equal(expected, lfacet)
+        assert_equal(True, ('zzmore', 2) in lfacet and ('zzsolo', 1) in lfacet)
+        assert_equal(lfacet[:1], IX.ResultPager(IX.BlobEntry.OP_AND, ['zzpick']).facets(limit=1))
+        assert_equal([], IX.ResultPager(IX.BlobEntry.OP_OR, ['nosuchtag']).facets())
+
+    def test_query_service(self):
+        import io
+        self.ix.reindex(bulk=True)
+        service = Server.QueryService(self.db_path)
+        service.warm()
+        IX.stats.reset()
+        result = service.findall(['ixtest'], facets=5)
+        assert_equal(len(self.fs.file_list), result['count'])
+        assert_equal(result, service.findall(['ixtest'], facets=5))
+        assert_equal(0.5, IX.stats.hit_rate('query_cache'))
+
+        relpath = IX.LocalFilePathHistoryEntry.get_relpath(self.fs.file_list[0])
+        blob = service.lookup(path=relpath)
+        assert_equal([relpath], blob['paths'])
+        assert_equal(blob, service.lookup(hash=blob['hashes'][IX.index_hash_algorithm].upper()))
+        assert_equal(None, service.lookup(path='no/such/file'))
+
+        ## writes through the service, and by anyone else, drop cached results
+        generation = service.cache.generation
+        assert_equal({'added': 1, 'removed': 0}, service.edit_tags([blob['id']], add=['zzserved']))
+        assert_equal(['zzserved'], [t for t in service.lookup(path=relpath)['tags'] if t.startswith('zz')])
+        service.check_writes()
+        assert_equal(generation + 1, service.cache.generation)
+        IX.BlobEntry.bulk_tag([blob['id']], remove=['zzserved'])
+        service.check_writes()
+        assert_equal(generation + 2, service.cache.generation)
+        assert_equal([], [t for t in service.lookup(path=relpath)['tags'] if t.startswith('zz')])
+
+        service.DUMP_CHUNK_ROWS = 4
+        ofile = io.StringIO()
+        IX.export_index(ofile, 'csv')
+        assert_equal(ofile.getvalue(), ''.join(service.dump('csv')))
+
+    @unittest.skipIf(Server.flask is None, "flask is not installed")
+    def test_server_app(self):
+        self.ix.reindex(bulk=True)
+        client = Server.make_app(Server.QueryService(self.db_path)).test_client()
+        result = client.get('/findall?q=ixtest&facets=3').get_json()
+        assert_equal(len(self.fs.file_list), result['count'])
+        assert_equal(400, client.get('/findall?q=ixtest&op=xor').status_code)
+        blob_id = result['rows'][0]['id']
+        assert_equal({'added': 1, 'removed': 0}, client.post('/tags', json={'blobs': [blob_id], 'add': ['zzhttp']}).get_json())
+        assert_equal([blob_id], [row['id'] for row in client.get('/findall?q=zzhttp').get_json()['rows']])
+        ## what a cross-origin form could send
+        body = '{"blobs": [%d], "add": ["zzform"]}' % blob_id
+        assert_equal(415, client.post('/tags', data=body, content_type='text/plain').status_code)
+        assert_equal([], client.get('/findall?q=zzform').get_json()['rows'])
+        assert_equal(len(self.fs.file_list) + 1, len(client.get('/dump').get_data(as_text=True).splitlines()))
+
+    def test_thumbnail_cache(self):
+        cache_dir = tempfile.mkdtemp(dir=self.fs.BASEDIR)
+        cache = Thumbnails.ThumbnailCache(cache_dir, max_bytes=25)
+        for key in ('a', 'b'):
+            cache.put(key, b'x' * 10)
+        cache.get('a')
+        cache.put('c', b'x' * 10)
+        ## b was the least recently used
+        assert_equal([None, 20], [cache.get('b'), cache.total_bytes])
+        assert_equal(['a', 'c'], sorted(Thumbnails.ThumbnailCache(cache_dir).entries))
+
+    def test_thumbnailer(self):
+        import threading
+        image = pjoin(self.fs.BASEDIR, 'scan.png')
+        copy = pjoin(self.fs.BASEDIR, 'copy of scan.png')
+        for path in (image, copy):
+            with open(path, 'wb') as ofile:
+                ofile.write(b'not really a png')
+        self.ix.reindex()
+        lrendered = []
+
+        def render(ifile, size):
+            lrendered.append(ifile.name)
+            return b'thumbnail %d' % size
+
+        thumbnailer = Thumbnails.Thumbnailer(
+            Thumbnails.ThumbnailCache(tempfile.mkdtemp(dir=self.fs.BASEDIR)), render=render, size=16)
+        try:
+            blob_id = IX.LocalFilePathHistoryEntry.get(path=IX.LocalFilePathHistoryEntry.get_relpath(image)).blob_id
+            path = thumbnailer.thumbnail(blob_id, image)
+            ## the copy is the same blob, and the cache is by content hash
+            assert_equal(path, thumbnailer.thumbnail(blob_id, copy))
+            assert_equal([image], lrendered)
+
+            done = threading.Event()
+            lresult = []
+            thumbnailer.request(blob_id, copy, lambda *argv: (lresult.append(argv), done.set()))
+            thumbnailer.request(blob_id + 1000, self.fs.file_list[0], None)
+            assert_equal(True, done.wait(5))
+            assert_equal([(blob_id, path)], lresult)
+        finally:
+            thumbnailer.close()
+
+    def test_thumbnailer_storage(self):
+        storage = IX.MemoryStorage({'/scan.png': b'png bytes', '/b.txt': b'bravo'})
+        IX.Indexer(storage=storage).reindex(lazy_hash=True)
+        blob_id = IX.LocalFilePathHistoryEntry.get(path='scan.png').blob_id
+        lrendered = []
+
+        def render(ifile, size):
+            lrendered.append(ifile.read())
+            return b'thumbnail'
+
+        thumbnailer = Thumbnails.Thumbnailer(
+            Thumbnails.ThumbnailCache(tempfile.mkdtemp(dir=self.fs.BASEDIR)), render=render,
+            storage=storage, workers=0)
+        path = thumbnailer.thumbnail(blob_id, '/scan.png')
+        assert_equal([b'png bytes'], lrendered)
+        digest = IX.get_hash_entry_type().get_hash(b'png bytes')
+        assert_equal(True, os.path.basename(path).startswith('%s-%s-' % (IX.index_hash_algorithm, digest)))
+        ## the digest is only written by the thread that asks for it
+        assert_equal(None, IX.BlobEntry.get(id=blob_id).get_hash())
+        thumbnailer.save_hashes()
+        assert_equal(digest, IX.BlobEntry.get(id=blob_id).get_hash().value)
+
+        ## only files that can't be read or decoded are given up on
+        def render(ifile, size):
+            raise error
+        thumbnailer.render = render
+        storage.write('/other.png', b'other bytes')
+        IX.Indexer(storage=storage).reindex()
+        other_id = IX.LocalFilePathHistoryEntry.get(path='other.png').blob_id
+        error = RuntimeError('database is locked')
+        with self.assertRaises(RuntimeError):
+            thumbnailer.thumbnail(other_id, '/other.png')
+        assert_equal(set(), thumbnailer.failed)
+        error = IOError('not an image')
+        assert_equal(None, thumbnailer.thumbnail(other_id, '/other.png'))
+        assert_equal(set([other_id]), thumbnailer.failed)
+
+    def test_findall_within(self):
+        self.ix.reindex()
+        lblob = IX.BlobEntry.findall(IX.BlobEntry.OP_AND, 'ix')
+        within = [blob.id for blob in lblob[:3]]
+        assert_equal(within, [blob.id for blob in IX.BlobEntry.findall(IX.BlobEntry.OP_AND, 'ixtest', within=within)])
+        assert_equal([], IX.BlobEntry.findall(IX.BlobEntry.OP_OR, 'ix', within=[]))
+
+    def test_result_pager(self):
+        self.ix.reindex()
+        lblob = IX.BlobEntry.findall(IX.BlobEntry.OP_AND, 'ixtest')
+        pager = IX.ResultPager(IX.BlobEntry.OP_AND, 'ixtest', page_size=4)
+        assert_equal(len(lblob), pager.count())
+        assert_equal(4, len(pager.fetch()))
+        assert_equal(len(lblob), 4 + len(list(pager)))
+        assert_equal([], pager.fetch())
+
+        for sort_key, attr in (('size', lambda row: row.size),
+                               ('path', lambda row: row.path),
+                               ('tags', lambda row: row.taglist[0])):
+            lrow = list(IX.ResultPager(IX.BlobEntry.OP_AND, 'ixtest', sort_key=sort_key,
+                                       descending=True, page_size=3))
+            assert_equal(sorted(blob.id for blob in lblob), sorted(row.id for row in lrow))
+            assert_equal(sorted(map(attr, lrow), reverse=True), list(map(attr, lrow)))
+        row = next(iter(IX.ResultPager(IX.BlobEntry.OP_AND, 'ixtest')))
+        assert_equal(sorted(tag.text for tag in IX.BlobEntry.get(id=row.id).tags), row.taglist)
+
+    def test_export_index(self):
+        self.ix.reindex()
+        lrow = list(IX.iter_export_rows(batch_size=4))
+        lblob = IX.db_session.query(IX.BlobEntry).order_by(IX.BlobEntry.id).all()
+        assert_equal([(blob.ensure_hash().value, blob.size, blob.get_local_files()[0].path,
+                       sorted(tag.text for tag in blob.tags)) for blob in lblob],
+                     [(row.hash, row.size, row.path, row.taglist) for row in lrow])
+
+        import io, csv, json
+        for format in IX.EXPORT_FORMATS:
+            ofile = io.StringIO()
+            assert_equal(len(lrow), IX.export_index(ofile, format))
+            lines = ofile.getvalue().splitlines()
+            if format == 'jsonl':
+                assert_equal(lrow[0].taglist, json.loads(lines[0])['tags'])
+            elif format == 'csv':
+                assert_equal(len(lrow) + 1, len(list(csv.reader(lines))))
+            else:
+                assert_equal(lrow[0].path, lines[1].split('\t')[3])
+
+        ## old indexes linked a blob to a digest once per file, even the same one
+        link = IX.db_session.query(IX.BlobEntryHash).first()
+        for value in (link.get_hash().value, 'f' * len(link.get_hash().value)):
+            IX.BlobEntryHash(blob_id=link.blob_id, hash_algorithm_id=link.hash_algorithm_id,
+                             hash_entry_id=IX.get_hash_entry_type().ensure(value=value).id).save()
+        assert_equal(lrow, list(IX.iter_export_rows()))
+
+    def test_blob_realpath(self):
+        self.ix.reindex()
+        path = self.fs.file_list[0]
+        blob = IX.LocalFilePathHistoryEntry.get(path=IX.LocalFilePathHistoryEntry.get_relpath(path)).blob
+        assert_equal(path, blob.get_realpath())
+        os.unlink(path)
+        self.ix.resync_db()
+        IX.db_session.expire_all()
+        assert_equal(None, blob.get_realpath())
+
     def test_resync_db(self):
         self.ix.reindex()
         # delete a random file
@@ -70,9 +741,148 @@ class TestIndexer(TestCase):
         assert_equal(len(status['del']), 1)
         deleted, _ = status['del'][0]
         assert_equal(deleted, to_delete)
+        assert_equal(False, IX.LocalFilePathHistoryEntry.get(path=os.path.relpath(to_delete, self.fs.BASEDIR)).file_exists)
+
+    def test_resync_db_moves(self):
+        self.ix.reindex()
+        renamed, copied = self.fs.file_list[:2]
+        blob_renamed = IX.LocalFilePathHistoryEntry.get(path=os.path.relpath(renamed, self.fs.BASEDIR)).blob_id
+        blob_renamed = IX.BlobEntry.get(id=blob_renamed)
+        blob_renamed.add_tag(IX.Tag.guaranteed_get('keepme'))
+
+        os.rename(renamed, renamed + '.moved')
+        ## a move across filesystems: new inode, same content
+        shutil.copy(copied, copied + '.copied')
+        os.unlink(copied)
+        added = self.fs.make_filler_file(self.fs.BASEDIR)
+
+        status = self.ix.resync_db()
+        assert_equal([], status['del'])
+        assert_equal([(None, added)], status['add'])
+        assert_equal(sorted([(renamed, renamed + '.moved'), (copied, copied + '.copied')]),
+                     sorted(status['mov']))
+        moved = IX.LocalFilePathHistoryEntry.get(path=os.path.relpath(renamed + '.moved', self.fs.BASEDIR))
+        assert_equal(blob_renamed.id, moved.blob_id)
+        assert_equal(True, 'keepme' in [tag.text for tag in moved.blob.tags])
+        assert_equal({}, self.ix.resync_db())
+
+    def test_reindex_restored(self):
+        for kw in (dict(), dict(bulk=True), dict(workers=2), dict(lazy_hash=True)):
+            IX.init_db(self.db_path)
+            ix = IX.Indexer(self.fs.BASEDIR)
+            ix.reindex(**kw)
+            restored = self.fs.file_list[0]
+            F = IX.LocalFilePathHistoryEntry
+            blob_id = F.get(path=os.path.relpath(restored, self.fs.BASEDIR)).blob_id
+            os.rename(restored, restored + '.away')
+            ix.resync_db()
+            os.rename(restored + '.away', restored)
+
+            assert_equal(1, ix.reindex(**kw))
+            IX.db_session.expire_all()
+            file = F.get(path=os.path.relpath(restored, self.fs.BASEDIR))
+            assert_equal(True, file.file_exists)
+            assert_equal(blob_id, file.blob_id)
+            assert_equal(0, ix.reindex(**kw))
+            IX.db_session.remove()
+            IX.db_session.get_bind().dispose()
+            os.unlink(self.db_path)
+
+    def test_watcher(self):
+        import Watcher
+        self.ix.reindex()
+        watcher = Watcher.IndexWatcher(self.ix)
+        watcher.watch_tree(self.fs.BASEDIR)
+
+        def sync():
+            while True:
+                levent = watcher.inotify.read(timeout=0.2)
+                if not levent:
+                    break
+                watcher.handle(levent)
+            watcher.flush()
+
+        def get(path):
+            return IX.LocalFilePathHistoryEntry.get(path=os.path.relpath(path, self.fs.BASEDIR))
+
+        renamed, deleted = self.fs.file_list[:2]
+        blob_id = get(renamed).blob_id
+        os.rename(renamed, renamed + '.moved')
+        os.unlink(deleted)
+        added = self.fs.make_filler_file(self.fs.BASEDIR)
+        somedir = os.path.dirname(self.fs.file_list[-1])
+        os.rename(somedir, somedir + '.moved')
+        sync()
+
+        IX.db_session.expire_all()
+        assert_equal(blob_id, get(renamed + '.moved').blob_id)
+        assert_equal(False, get(renamed).file_exists)
+        assert_equal(False, get(deleted).file_exists)
+        assert_equal(True, get(added).file_exists)
+        for path in self.fs.file_list[-3:]:
+            assert_equal(False, get(path).file_exists)
+            assert_equal(True, get(somedir + '.moved' + path[len(somedir):]).file_exists)
+        ## nothing left for a full resync to find
+        assert_equal({}, self.ix.resync_db())
+
+        ## out of the watched tree and back
+        roundtrip = self.fs.file_list[2]
+        blob_id = get(roundtrip).blob_id
+        outside = pjoin(tempfile.mkdtemp(dir=os.path.dirname(self.fs.BASEDIR)), 'outside')
+        os.rename(roundtrip, outside)
+        sync()
+        IX.db_session.expire_all()
+        assert_equal(False, get(roundtrip).file_exists)
+        os.rename(outside, roundtrip)
+        shutil.rmtree(os.path.dirname(outside))
+        sync()
+        IX.db_session.expire_all()
+        assert_equal(True, get(roundtrip).file_exists)
+        assert_equal(blob_id, get(roundtrip).blob_id)
+        assert_equal({}, self.ix.resync_db())
+        watcher.close()
+
+    def test_scrub(self):
+        IX.init_db(self.db_path, extra_hash_algorithms=['sha256'])
+        ix = IX.Indexer(self.fs.BASEDIR)
+        ix.reindex(bulk=True)
+        corrupted, deleted = self.fs.file_list[:2]
+        ## same size and mtime, different content
+        stat = os.stat(corrupted)
+        with open(corrupted, 'r+b') as ofile:
+            ofile.write(b'X')
+        os.utime(corrupted, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.unlink(deleted)
+
+        report = ix.scrub(workers=2, bytes_per_sec=1e6, batch_size=4)
+        relpath = lambda path: os.path.relpath(path, self.fs.BASEDIR)
+        assert_equal([relpath(deleted)], report.missing)
+        assert_equal(sorted([IX.index_hash_algorithm, 'sha256']),
+                     [mismatch['algorithm'] for mismatch in report.mismatched])
+        assert_equal(set([(relpath(corrupted), False)]),
+                     set((mismatch['path'], mismatch['stat_changed']) for mismatch in report.mismatched))
+        assert_equal(len(self.fs.file_list) - 2, report.files_ok)
+        assert_equal(None, IX.ScanCheckpoint.get(base_dir=ix.SCRUB_CHECKPOINT_PREFIX + self.fs.BASEDIR))
+
+        ## files that checked out are not due again, the two that didn't
+        ## were never scrubbed, however recent their mtime
+        report = ix.scrub(older_than_days=1)
+        assert_equal(0, report.files_ok)
+        assert_equal(1, report.files_checked)
+        assert_equal([relpath(deleted)], report.missing)
+        ## scrubbing leaves the mtimes --dump reports alone
+        for row in IX.iter_export_rows():
+            if row.path != relpath(deleted):
+                assert_equal(os.stat(pjoin(self.fs.BASEDIR, row.path)).st_mtime, row.time_verified)
 
     def tearDown(self):
         self.fs.destroy()
-        os.unlink(self.db_path)
+        ## enable_posting_index() is process wide
+        IX.tag_posting_index = None
+        IX.db_session.remove()
+        IX.db_session.get_bind().dispose()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.db_path + suffix):
+                os.unlink(self.db_path + suffix)
 
 